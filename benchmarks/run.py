@@ -0,0 +1,290 @@
+"""
+Benchmark of pipeline stages on synthetic inputs.
+
+Each stage is run in its own (forked) process, so peak memory of one stage doesn't hide another.
+Wall time, CPU time and memory of each stage are written as JSON:
+
+    python benchmarks/run.py --workdir /tmp/michigan_bench --output bench.json
+    python benchmarks/run.py --stages modis_geo_location,fusion_init --repeat 3
+
+Stages which need optional packages (<ovl_plugins>, <boreali>, <sklearn>) are reported as skipped if the
+packages are not installed. Caches of the package are kept in <workdir>/cache (<MICHIGAN_CACHE>).
+
+The <import> stage is a test of lazy imports: it fails (and the script exits with 1) if importing a module
+of the package loads any of <HEAVY_MODULES> or takes longer than <--max-import-s>:
+
+    python benchmarks/run.py --stages import
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import pkgutil
+import argparse
+import platform
+import datetime
+import traceback
+import subprocess
+from multiprocessing import Process, Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def memory_status():
+    """
+    :return: dict, current and peak resident set size of the process (MB)
+    """
+    status = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+                name, value = line.split(':')
+                status[name] = int(value.split()[0]) / 1024.
+    return {'rss_mb': status.get('VmRSS'), 'peak_rss_mb': status.get('VmHWM')}
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def measure(setup, run, inputs, queue):
+    """
+    Child process: prepare the stage (not measured), run it and send measurements to <queue>
+    """
+    result = {'status': 'ok'}
+    try:
+        state = setup(inputs) if setup is not None else None
+        start_memory = memory_status()
+        wall, cpu = time.time(), cpu_time()
+        run(inputs, state)
+        result.update(wall_s=time.time() - wall, cpu_s=cpu_time() - cpu,
+                      start_rss_mb=start_memory['rss_mb'], peak_rss_mb=memory_status()['peak_rss_mb'])
+    except Exception:
+        result.update(status='failed', error=traceback.format_exc().strip().splitlines()[-1])
+    queue.put(result)
+
+
+def run_stage(setup, run, inputs):
+    queue = Queue()
+    process = Process(target=measure, args=(setup, run, inputs, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+# Heavy dependencies which should be imported only by stages which need them
+HEAVY_MODULES = ['matplotlib', 'gdal', 'osgeo', 'nansat', 'boreali', 'sklearn', 'scipy', 'ovl_plugins']
+
+
+def import_time(module, max_import_s=None):
+    """
+    Time of importing <module> in a fresh interpreter and heavy dependencies loaded by the import
+    :param module: str
+    :param max_import_s: float, max time of the import. None means no limit
+    :return: dict, status is 'failed' if any heavy dependency is loaded or the import is too slow
+    """
+    code = ('import sys, time; t = time.time(); import %s; print(time.time() - t); '
+            'print(",".join(m for m in %r if m in sys.modules))' % (module, HEAVY_MODULES))
+    start = time.time()
+    try:
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        return {'status': 'failed', 'error': e.output.decode('utf-8').strip().splitlines()[-1]}
+
+    lines = output.decode('utf-8').splitlines()
+    result = {'status': 'ok', 'wall_s': time.time() - start, 'import_s': float(lines[-2]),
+              'heavy_modules': [m for m in lines[-1].split(',') if m]}
+    if result['heavy_modules']:
+        result.update(status='failed', error='%s imports %s' % (module, ', '.join(result['heavy_modules'])))
+    elif max_import_s is not None and result['import_s'] > max_import_s:
+        result.update(status='failed', error='%s is imported in %.2f s' % (module, result['import_s']))
+    return result
+
+
+# Stages: name -> (setup, run). <inputs> are paths to synthetic data, the domain and the output directory
+
+def clear_warp_cache(inputs):
+    shutil.rmtree(os.path.join(os.environ['MICHIGAN_CACHE'], 'warp'), ignore_errors=True)
+
+
+def stage_geo_location(inputs, state):
+    from michigan.dataprep import Data
+    Data(inputs['modis'], domain=inputs['domain']).modis_geo_location(save_path=inputs['output'])
+
+
+def stage_geo_location_beta(inputs, state):
+    from michigan.dataprep import Data
+    Data(inputs['modis'], domain=inputs['domain']).modis_geo_location_beta(save_path=inputs['output'])
+
+
+def stage_stich(inputs, state):
+    from michigan.dataprep import Data
+    from michigan.sentinel2 import find_granules
+    data = Data(inputs['sentinel2'], domain=inputs['domain'])
+    granules = find_granules(inputs['sentinel2'], data.granules)
+    data.stich(inputs['domain'], sorted(data.wavelengths['sentinel2'].keys()), granules)
+
+
+def stage_s2_downscale(inputs, state):
+    from michigan.dataprep import Data
+    Data(inputs['sentinel2'], domain=inputs['domain']).s2_downscale(save_path=inputs['output'])
+
+
+def reprojected(inputs):
+    return (os.path.join(inputs['output'], os.path.split(inputs['modis'])[1] + '_reprojected.nc'),
+            os.path.join(inputs['output'], os.path.split(inputs['sentinel2'])[1] + '_reprojected.nc'))
+
+
+def stage_fusion_init(inputs, state):
+    from michigan.fusion import Fusion
+    m_file, s_file = reprojected(inputs)
+    Fusion(m_file, s_file, domain=inputs['domain'], mask=inputs['mask'])
+
+
+def setup_fusion(inputs):
+    from michigan.fusion import Fusion
+    m_file, s_file = reprojected(inputs)
+    return Fusion(m_file, s_file, domain=inputs['domain'], mask=inputs['mask'])
+
+
+def stage_fusion(inputs, fusion):
+    fusion.fusion(m_wavelengths='1x1km_bands')
+
+
+def stage_fusion_network(inputs, fusion):
+    fusion.fusion(m_wavelengths='1x1km_bands', multi_output=True)
+
+
+def setup_michigan(inputs):
+    from michigan.michigan import MichiganProcessing
+    return MichiganProcessing(reprojected(inputs)[0], domain=inputs['domain'])
+
+
+def stage_boreali(inputs, processing):
+    processing.boreali_processing()
+
+
+def stage_boreali_compact(inputs, processing):
+    processing.boreali_processing(compact=True)
+
+
+def stage_classification(inputs, processing):
+    processing.bottom_classification(5)
+
+
+# name, setup, run, optional packages required by the stage
+STAGES = [
+    ('modis_geo_location', clear_warp_cache, stage_geo_location, []),
+    ('modis_geo_location_beta', clear_warp_cache, stage_geo_location_beta, []),
+    ('stich', None, stage_stich, []),
+    ('s2_downscale', None, stage_s2_downscale, []),
+    ('fusion_init', None, stage_fusion_init, []),
+    ('fusion', setup_fusion, stage_fusion, ['ovl_plugins']),
+    ('fusion_network', setup_fusion, stage_fusion_network, ['sklearn']),
+    ('boreali_processing', setup_michigan, stage_boreali, ['boreali']),
+    ('boreali_processing_compact', setup_michigan, stage_boreali_compact, ['boreali']),
+    ('bottom_classification', setup_michigan, stage_classification, ['sklearn']),
+]
+
+
+def missing_packages(packages):
+    """
+    :param packages: list, names of top level packages
+    :return: list, packages which can't be imported. They are looked up without importing
+    """
+    return [package for package in packages if pkgutil.find_loader(package) is None]
+
+IMPORTS = ['michigan.dataprep', 'michigan.fusion', 'michigan.michigan', 'michigan.catalog', 'michigan.instrument']
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark of michigan pipeline stages on synthetic data')
+    parser.add_argument('--workdir', default='./michigan_bench', help='directory for synthetic inputs and outputs')
+    parser.add_argument('--output', default=None, help='path to JSON file with results (default: stdout)')
+    parser.add_argument('--stages', default=None, help='comma separated names of stages (default: all)')
+    parser.add_argument('--scale', type=float, default=0.25, help='resolution of the domain relative to sbd_dom')
+    parser.add_argument('--s2-coarsen', type=int, default=1, help='pixel sizes of synthetic Sentinel-2 bands '
+                                                                  'relative to the real 10, 20 and 60 m')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of each stage')
+    parser.add_argument('--no-mask', action='store_true', help='run Fusion without the water mask '
+                                                               '(it needs MODIS water mask data)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-import-s', type=float, default=1.0, help='max time of import of a module, s')
+    args = parser.parse_args(args)
+
+    names = [stage[0] for stage in STAGES] + ['import']
+    selected = names if args.stages is None else args.stages.split(',')
+    unknown = set(selected) - set(names)
+    if unknown:
+        parser.error('unknown stages: %s' % ', '.join(sorted(unknown)))
+
+    report = {
+        'started': datetime.datetime.utcnow().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'scale': args.scale,
+        'repeat': args.repeat,
+        'stages': [],
+    }
+
+    if 'import' in selected:
+        for module in IMPORTS:
+            for i in range(args.repeat):
+                result = import_time(module, max_import_s=args.max_import_s)
+                result.update(stage='import', module=module, run=i)
+                report['stages'].append(result)
+                if result['status'] != 'ok':
+                    sys.stderr.write('import %s failed: %s\n' % (module, result['error']))
+
+    workdir = os.path.abspath(args.workdir)
+    stages = [stage for stage in STAGES if stage[0] in selected]
+    if stages:
+        import synthetic
+        start = time.time()
+        inputs = synthetic.make_all(workdir, scale=args.scale, s2_coarsen=args.s2_coarsen, seed=args.seed)
+        report['synthetic_s'] = time.time() - start
+        inputs.update(output=os.path.join(workdir, 'output'), mask=not args.no_mask)
+        if not os.path.isdir(inputs['output']):
+            os.makedirs(inputs['output'])
+
+        # Relative paths of the package (bathymetry) point into the working directory. Stages are run in
+        # forked processes which import the package, so they take the cache directory from the environment
+        os.environ['MICHIGAN_CACHE'] = os.path.join(workdir, 'cache')
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for name, setup, run, requires in stages:
+                missing = missing_packages(requires)
+                if missing:
+                    report['stages'].append({'stage': name, 'status': 'skipped',
+                                             'error': 'requires %s' % ', '.join(missing)})
+                    sys.stderr.write('%-28s skipped: %s is not installed\n' % (name, ', '.join(missing)))
+                    continue
+                for i in range(args.repeat):
+                    result = run_stage(setup, run, inputs)
+                    result.update(stage=name, run=i)
+                    report['stages'].append(result)
+                    sys.stderr.write('%-28s %s %s\n' % (name, result['status'],
+                                                         '%.2f s' % result['wall_s'] if 'wall_s' in result
+                                                         else result.get('error', '')))
+        finally:
+            os.chdir(cwd)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    return 1 if any(result['status'] != 'ok' for result in report['stages'] if result['stage'] == 'import') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
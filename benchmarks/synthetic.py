@@ -0,0 +1,197 @@
+"""
+Synthetic inputs shaped like the real ones: MODIS L2 swath with lat/lon, Sentinel-2 SAFE product
+with four granules of JP2 bands and a bathymetry grid. Everything is generated offline.
+"""
+import os
+
+import numpy as np
+import gdal
+import osr
+from nansat import Nansat, Domain
+
+# Sandy Bear Dunes region (see <michigan.dataprep.Data.sbd_dom>)
+BBOX = (-86.3, 44.6, -85.2, 45.3)
+
+MODIS_NAME = 'A2016247184000.L2_LAC_OC.nc'
+S2_NAME = 'S2A_OPER_PRD_MSIL1C_PDMC_20160904T205606_R126_V20160903T164322_20160903T164911.SAFE'
+GRANULE_NAME = 'S2A_OPER_MSI_L1C_TL_SGS__20160903T203402_A006361_T%s_N02.04'
+S2_BANDS = ['01', '02', '03', '04', '05', '06', '07', '08', '8A', '09', '10', '11', '12']
+# Pixel size of each band in meters as in real L1C products
+S2_RESOLUTIONS = {'01': 60, '02': 10, '03': 10, '04': 10, '05': 20, '06': 20, '07': 20, '08': 10, '8A': 20,
+                  '09': 60, '10': 60, '11': 20, '12': 20}
+MODIS_WAVELENGTHS = [412, 443, 469, 488, 531, 547, 555, 645, 667, 678]
+UTM_16N = 32616
+
+
+def smooth_field(shape, random, scale=20.):
+    """
+    :param shape: tuple
+    :param random: <numpy.random.RandomState> object
+    :param scale: float, size of features in pixels
+    :return: numpy array, float32 smooth random field in [0, 1]
+    """
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float32) / scale
+    field = np.zeros(shape, dtype=np.float32)
+    for k in range(4):
+        a, b, c = random.rand(3) * 2 * np.pi
+        field += np.sin(rows * np.cos(a) * (k + 1) + cols * np.sin(a) * (k + 1) + b) * np.cos(c)
+    field -= field.min()
+    return field / max(field.max(), 1e-6)
+
+
+def make_domain(scale=0.25):
+    """
+    :param scale: float, part of resolution of <Data.sbd_dom>
+    :return: <nansat.domain.Domain> object over the region
+    """
+    cols, rows = int(2033 * scale), int(1300 * scale)
+    return Domain('+proj=latlong +datum=WGS84 +ellps=WGS84 +no_defs', '-lle %f %f %f %f -ts %d %d'
+                  % (BBOX + (cols, rows)))
+
+
+def make_modis(path, shape=(400, 300), seed=0):
+    """
+    MODIS L2 swath (about 1 km pixels, slightly rotated) around the region with <lat>, <lon> and <Rrs_*> bands
+    :param path: str, directory
+    :param shape: tuple, rows and columns of the swath
+    :param seed: int
+    :return: str, path to file
+    """
+    random = np.random.RandomState(seed)
+    rows, cols = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float64)
+    # ~1 km pixels, swath is rotated by ~10 degrees
+    lat = 46.3 - rows * 0.009 + cols * 0.0016
+    lon = -87.3 + cols * 0.0125 + rows * 0.0022
+
+    n = Nansat(domain=Domain(lon=lon, lat=lat))
+    n.add_band(lat.astype(np.float32), parameters={'name': 'lat'})
+    n.add_band(lon.astype(np.float32), parameters={'name': 'lon'})
+
+    field = smooth_field(shape, random)
+    # clouds and land are marked as in L2 files
+    flagged = smooth_field(shape, random, scale=7.) > 0.85
+    for i, wavelength in enumerate(MODIS_WAVELENGTHS):
+        rrs = (0.002 + 0.008 * field * (1 - i / 12.)).astype(np.float32)
+        rrs[flagged] = -0.015534
+        n.add_band(rrs, parameters={'name': 'Rrs_%d' % wavelength, 'wavelength': wavelength})
+
+    n.set_metadata('time_coverage_start', '2016-09-03T18:40:00.000Z')
+    ofile = os.path.join(path, MODIS_NAME)
+    n.export(ofile)
+    return ofile
+
+
+def _jp2_driver():
+    """
+    :return: <gdal.Driver> object, JPEG2000 driver or GTiff if GDAL is built without JPEG2000.
+    Files keep the <.jp2> extension in both cases, GDAL opens them by content
+    """
+    for name in ('JP2OpenJPEG', 'JP2ECW', 'JP2KAK', 'JPEG2000'):
+        driver = gdal.GetDriverByName(name)
+        if driver is not None:
+            return driver
+    return gdal.GetDriverByName('GTiff')
+
+
+def make_sentinel2(path, coarsen=1, seed=0):
+    """
+    Sentinel-2 L1C SAFE product with four granules (2 x 2, overlapping) covering the region.
+    Bands have pixel sizes of the real product (10, 20 and 60 m, see <S2_RESOLUTIONS>)
+    :param path: str, directory
+    :param coarsen: int, pixel sizes of all bands are multiplied by it (1 gives the real sizes)
+    :param seed: int
+    :return: str, path to SAFE directory
+    """
+    random = np.random.RandomState(seed)
+    utm = osr.SpatialReference()
+    utm.ImportFromEPSG(UTM_16N)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    if hasattr(wgs84, 'SetAxisMappingStrategy'):
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        utm.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transformation = osr.CoordinateTransformation(wgs84, utm)
+    corners = np.array(transformation.TransformPoints([(BBOX[0], BBOX[1]), (BBOX[0], BBOX[3]),
+                                                       (BBOX[2], BBOX[1]), (BBOX[2], BBOX[3])]))
+    x_min, y_min = corners[:, 0].min() - 5000, corners[:, 1].min() - 5000
+    x_max, y_max = corners[:, 0].max() + 5000, corners[:, 1].max() + 5000
+    # granules overlap as the real ones
+    x_size = (x_max - x_min) * 0.55
+    y_size = (y_max - y_min) * 0.55
+    finest = min(S2_RESOLUTIONS.values()) * coarsen
+
+    driver = _jp2_driver()
+    mem = gdal.GetDriverByName('MEM')
+    safe = os.path.join(path, S2_NAME)
+    tiles = [('16TEQ', x_min, y_min + y_size), ('16TFQ', x_max - x_size, y_min + y_size),
+             ('16TER', x_min, y_max), ('16TFR', x_max - x_size, y_max)]
+
+    for tile, x0, y0 in tiles:
+        gdir = os.path.join(safe, 'GRANULE', GRANULE_NAME % tile)
+        img_dir = os.path.join(gdir, 'IMG_DATA')
+        if not os.path.isdir(img_dir):
+            os.makedirs(img_dir)
+
+        # One field (features of 3 km) at the finest resolution, coarser bands take every n-th pixel of it
+        field = smooth_field((int(y_size / finest), int(x_size / finest)), random, scale=3000. / finest)
+        for i, band in enumerate(S2_BANDS):
+            resolution = S2_RESOLUTIONS[band] * coarsen
+            step = resolution // finest
+            width, height = int(x_size / resolution), int(y_size / resolution)
+            data = (200 + 1500 * field[::step, ::step][:height, :width] * (1 - i / 20.)).astype(np.uint16)
+            ds = mem.Create('', width, height, 1, gdal.GDT_UInt16)
+            ds.SetProjection(utm.ExportToWkt())
+            ds.SetGeoTransform((x0, resolution, 0, y0, 0, -resolution))
+            ds.GetRasterBand(1).WriteArray(data)
+            bfile = os.path.join(img_dir, '%s_B%s.jp2' % ((GRANULE_NAME % tile).replace('_N02.04', ''), band))
+            driver.CreateCopy(bfile, ds)
+
+    return safe
+
+
+def make_bathymetry(path, shape=(140, 220), seed=0):
+    """
+    Bathymetry grid (negative depth over water, positive height over land) as
+    <requirements/michigan_lld.grd> inside of <path>
+    :param path: str, directory
+    :param shape: tuple
+    :param seed: int
+    :return: str, path to file
+    """
+    random = np.random.RandomState(seed)
+    lon_min, lat_min, lon_max, lat_max = BBOX[0] - 0.5, BBOX[1] - 0.5, BBOX[2] + 0.5, BBOX[3] + 0.5
+    cols = np.linspace(0, 1, shape[1])[None, :]
+    # Land in the east, depth grows to the west
+    h = (cols - 0.7) * 120 + smooth_field(shape, random) * 10
+
+    ofile = os.path.join(path, 'requirements', 'michigan_lld.grd')
+    if not os.path.isdir(os.path.dirname(ofile)):
+        os.makedirs(os.path.dirname(ofile))
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds = gdal.GetDriverByName('GTiff').Create(ofile, shape[1], shape[0], 1, gdal.GDT_Float32)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((lon_min, (lon_max - lon_min) / shape[1], 0, lat_max, 0, -(lat_max - lat_min) / shape[0]))
+    ds.GetRasterBand(1).WriteArray(h.astype(np.float32))
+    ds = None
+    return ofile
+
+
+def make_all(path, scale=0.25, s2_coarsen=1, seed=0):
+    """
+    :param path: str, working directory
+    :param scale: float, resolution of the domain relative to <Data.sbd_dom>
+    :param s2_coarsen: int, see <coarsen> of <make_sentinel2>
+    :param seed: int
+    :return: dict, paths to inputs and the domain
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    return {
+        'domain': make_domain(scale),
+        'modis': make_modis(path, seed=seed),
+        'sentinel2': make_sentinel2(path, coarsen=s2_coarsen, seed=seed),
+        'bathymetry': make_bathymetry(path, seed=seed),
+    }
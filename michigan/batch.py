@@ -0,0 +1,537 @@
+"""
+Batch processing of many scenes by one stage of the pipeline:
+
+    python -m michigan.batch geolocation --input '/nfs0/data_ocolor/michigan/modis/A2016*.nc' --output-dir out
+    python -m michigan.batch downscale --manifest s2_files.txt --output-dir out --processes 4
+    python -m michigan.batch fusion --from-catalog --input-dir out --output-dir out
+    python -m michigan.batch boreali --input 'out/*_fused.nc' --output-dir out
+
+Scenes are processed by a pool of processes. Scenes with a valid output are skipped and the state of each
+scene is kept in the catalog, so a crashed run is restarted where it stopped.
+
+Several nodes can process the same list of scenes if they share a work queue directory
+(see <michigan/workqueue.py>), each scene is claimed by one worker:
+
+    python -m michigan.batch geolocation --input '...' --output-dir /nfs0/.../out --queue /nfs0/.../queue
+
+With <--prefetch> inputs of the next scenes are copied to local scratch while the current scene is processed
+and outputs are exported and moved to <--output-dir> asynchronously (see <michigan/pipeline.py>).
+
+With <--cores> the fusion stage fuses bands of <--processes> scenes at once in parallel within one core budget
+(see <michigan/scheduler.py>):
+
+    python -m michigan.batch fusion --from-catalog --input-dir out --output-dir out --processes 4 --cores 16
+"""
+import os
+import sys
+import shutil
+import tempfile
+import glob
+import time
+import argparse
+import functools
+import traceback
+from multiprocessing import Pool
+
+from catalog import Catalog
+from workqueue import WorkQueue, task_key
+from pipeline import Pipeline, ScratchLoader, move_output
+
+# Stages: name -> suffix of output file
+STAGES = {
+    'geolocation': '_reprojected.nc',
+    'geolocation_beta': '_mumm_reprojected.nc',
+    'downscale': '_reprojected.nc',
+    'fusion': '_fused.nc',
+    'boreali': '_boreali.nc',
+}
+
+# MODIS bands which are reprojected by the geolocation stages and fused by the fusion stage
+MODIS_BANDS = 'reprojection'
+
+# Options of the fusion stage which are keyword arguments of <Fusion.__init__>, other options go to <Fusion.fusion>
+FUSION_INIT_OPTIONS = ('smooth', 'skip', 'log', 'mask', 'cut', 'negative_px', 'h_mask', 'prepare_m', 'prepare_s',
+                       'tiled', 'tile_dir')
+
+
+def output_path(stage, inputs, output_dir):
+    """
+    :param stage: str, name of stage
+    :param inputs: tuple, paths to input files (MODIS and Sentinel-2 files for fusion)
+    :param output_dir: str
+    :return: str, path to output file of the scene
+    """
+    return os.path.join(output_dir, os.path.split(inputs[0].rstrip('/'))[1] + STAGES[stage])
+
+
+def is_valid(path, verify=False):
+    """
+    Outputs are written under temporary names and renamed, so an existing non-empty file is complete.
+    :param path: str
+    :param verify: bool, also open the file by GDAL
+    :return: bool
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return False
+
+    if verify:
+        import gdal
+        ds = gdal.Open(path)
+        if ds is None or (ds.RasterCount == 0 and not ds.GetSubDatasets()):
+            return False
+
+    return True
+
+
+def process(stage, inputs, output_dir, options=None, deferred=None):
+    """
+    Run <stage> for one scene
+    :param stage: str
+    :param inputs: tuple, paths to input files
+    :param output_dir: str
+    :param options: dict, keyword arguments of the stage method
+    :param deferred: list, if given the output is not exported, the export is appended to it as a function
+    (see <run_prefetch>)
+    :return: str, path to output file
+    """
+    options = dict(options or {})
+    ofile = output_path(stage, inputs, output_dir)
+
+    if stage in ('geolocation', 'geolocation_beta', 'downscale'):
+        from dataprep import Data
+        data = Data(inputs[0])
+        data.deferred = deferred
+        if stage == 'downscale':
+            data.s2_downscale(save_path=output_dir, **options)
+        else:
+            options.setdefault('wavelengths_set', MODIS_BANDS)
+            if stage == 'geolocation':
+                data.modis_geo_location(save_path=output_dir, **options)
+            else:
+                data.modis_geo_location_beta(save_path=output_dir, **options)
+    elif stage == 'fusion':
+        from fusion import Fusion
+        from export import export_nansat
+        init_options = dict((key, options.pop(key)) for key in FUSION_INIT_OPTIONS if key in options)
+        options.setdefault('m_wavelengths', MODIS_BANDS)
+        with Fusion(inputs[0], inputs[1], **init_options) as fusion:
+            if init_options.get('tiled'):
+                # Fused bands are backed by the stores of <fusion>, they are exported before its <close>
+                fusion.fusion_tiled(ofile=ofile, **options)
+            elif options.get('cores') is not None:
+                fusion.fusion(ofile=ofile, **options)
+            elif deferred is not None:
+                deferred.append(functools.partial(export_nansat, fusion.fusion(**options)[1], ofile))
+            else:
+                fusion.fusion(ofile=ofile, **options)
+    elif stage == 'boreali':
+        from michigan import MichiganProcessing
+        from export import export_nansat, BAND_SETS
+        if deferred is not None:
+            bands = options.pop('export_bands', BAND_SETS['boreali'])
+            n = MichiganProcessing(inputs[0]).boreali_processing(**options)
+            deferred.append(functools.partial(export_nansat, n, ofile, bands=bands))
+        else:
+            MichiganProcessing(inputs[0]).boreali_processing(ofile=ofile, **options)
+    else:
+        raise ValueError('Unknown stage <%s>' % stage)
+
+    return ofile
+
+
+def run_task(task):
+    """
+    Worker of <run_batch>
+    :param task: tuple, stage, inputs, output directory, options, work queue settings (root and lease time)
+    or None
+    :return: tuple, inputs, state ('done', 'skipped' or 'failed'), output path or error, wall time
+    """
+    stage, inputs, output_dir, options, queue = task
+    start = time.time()
+
+    if queue is None:
+        try:
+            ofile = process(stage, inputs, output_dir, options)
+        except Exception:
+            return inputs, 'failed', traceback.format_exc().strip().splitlines()[-1], time.time() - start
+        return inputs, 'done', ofile, time.time() - start
+
+    lease = WorkQueue(*queue).claim(task_key(stage, *inputs))
+    if lease is None:
+        return inputs, 'skipped', 'claimed by another worker', time.time() - start
+    # Another worker could finish the scene before its lease was released
+    ofile = output_path(stage, inputs, output_dir)
+    if is_valid(ofile):
+        lease.release(done=True)
+        return inputs, 'skipped', ofile, time.time() - start
+
+    # The output is written into a private directory and published only if the lease is still ours
+    work_dir = tempfile.mkdtemp(prefix='.michigan_', dir=output_dir)
+    try:
+        local_ofile = process(stage, inputs, work_dir, options)
+        if not lease.valid():
+            lease.release(done=False)
+            return inputs, 'skipped', 'lease lost', time.time() - start
+        os.rename(local_ofile, ofile)
+    except Exception:
+        lease.release(done=False)
+        return inputs, 'failed', traceback.format_exc().strip().splitlines()[-1], time.time() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    lease.release(done=True)
+    return inputs, 'done', ofile, time.time() - start
+
+
+class Claimed(Exception):
+    """
+    The scene is claimed by another worker of the work queue
+    """
+
+
+class LeaseLost(Exception):
+    """
+    The lease of the scene was stolen by another worker, the output is not published
+    """
+
+
+def run_prefetch(stage, scenes, output_dir, options=None, queue=None, scratch_dir=None, depth=2,
+                 memory_limit_mb=None):
+    """
+    Process scenes one by one in this process while inputs of the next scenes are copied onto local
+    scratch and outputs of the previous ones are exported and moved into <output_dir> by the writer thread
+    :param stage: str
+    :param scenes: list of tuples, inputs of each scene
+    :param output_dir: str
+    :param options: dict, keyword arguments of the stage method
+    :param queue: tuple, root and lease time of the work queue or None
+    :param scratch_dir: str, local directory
+    :param depth: int, number of prefetched scenes
+    :param memory_limit_mb: float, ceiling of size of prefetched inputs on scratch
+    :return: generator of tuples, inputs, state, output path or error
+    """
+    if stage == 'downscale':
+        from dataprep import Data
+        # Only granules and bands of the domain are copied from SAFE products
+        loader = ScratchLoader(scratch_dir, granules=Data.granules, bands=sorted(Data.wavelengths['sentinel2']))
+    else:
+        loader = ScratchLoader(scratch_dir)
+    leases = {}
+
+    def load(inputs):
+        if queue is not None:
+            lease = WorkQueue(*queue).claim(task_key(stage, *inputs))
+            if lease is None:
+                raise Claimed('claimed by another worker')
+            if is_valid(output_path(stage, inputs, output_dir)):
+                lease.release(done=True)
+                raise Claimed('finished by another worker')
+            leases[inputs] = lease
+        return loader(inputs)
+
+    def work(inputs, local):
+        # Outputs are kept apart from inputs which are removed right after processing
+        local_output = tempfile.mkdtemp(prefix='michigan_output_', dir=scratch_dir)
+        # Exports are done by <write> in the writer thread while the next scene is processed
+        deferred = []
+        try:
+            return process(stage, local, local_output, options, deferred=deferred), deferred
+        except Exception:
+            shutil.rmtree(local_output, ignore_errors=True)
+            raise
+
+    def write(inputs, result):
+        local_ofile, deferred = result
+        try:
+            for export in deferred:
+                export()
+        except Exception:
+            shutil.rmtree(os.path.dirname(local_ofile), ignore_errors=True)
+            raise
+        lease = leases.get(inputs)
+        if lease is not None and not lease.valid():
+            shutil.rmtree(os.path.dirname(local_ofile), ignore_errors=True)
+            raise LeaseLost('lease lost')
+        ofile = move_output(local_ofile, output_dir)
+        shutil.rmtree(os.path.dirname(local_ofile), ignore_errors=True)
+        return ofile
+
+    pipeline = Pipeline(load, work, write, depth=depth, memory_limit_mb=memory_limit_mb,
+                        cleanup=ScratchLoader.cleanup)
+    for inputs, state, result in pipeline.run(scenes):
+        lease = leases.pop(inputs, None)
+        if lease is not None:
+            lease.release(done=state == 'done')
+        if state == 'failed' and (result.startswith('Claimed') or result.startswith('LeaseLost')):
+            state = 'skipped'
+        yield inputs, state, result
+
+
+def run_scheduled(scenes, output_dir, options=None, cores=8, group=4):
+    """
+    Fusion of groups of <group> scenes in this process. Bands of all scenes of a group are fused in parallel
+    by <michigan.scheduler.FusionScheduler> within the budget of <cores>
+    :param scenes: list of tuples, MODIS and Sentinel-2 inputs of each scene
+    :param output_dir: str
+    :param options: dict, keyword arguments of <Fusion.__init__>, <m_wavelengths>, <iterations> and <threads>
+    :param cores: int, total core budget
+    :param group: int, number of scenes fused at once
+    :return: generator of tuples, inputs, state, output path or error
+    """
+    from fusion import Fusion
+    from scheduler import FusionScheduler
+
+    options = dict(options or {})
+    init_options = dict((key, options.pop(key)) for key in FUSION_INIT_OPTIONS if key in options)
+    if init_options.get('tiled'):
+        raise ValueError('Scheduled fusion works with full hires cubes, it can not be used with tiled=True')
+    m_wavelengths = options.pop('m_wavelengths', MODIS_BANDS)
+
+    for start in range(0, len(scenes), group):
+        scheduler = FusionScheduler(cores=cores, tile_dir=init_options.get('tile_dir'), **options)
+        opened = []
+        scheduled = []
+        try:
+            for inputs in scenes[start:start + group]:
+                try:
+                    opened.append(Fusion(inputs[0], inputs[1], **init_options))
+                    # The hires cube is moved into a store, only one cube at a time is kept in memory
+                    scheduler.add_scene(opened[-1], m_wavelengths)
+                except Exception:
+                    yield inputs, 'failed', traceback.format_exc().strip().splitlines()[-1]
+                    continue
+                scheduled.append(inputs)
+
+            if not scheduled:
+                continue
+
+            ofiles = [output_path('fusion', inputs, output_dir) for inputs in scheduled]
+            try:
+                scheduler.run(ofiles=ofiles)
+            except Exception:
+                error = traceback.format_exc().strip().splitlines()[-1]
+                for inputs in scheduled:
+                    yield inputs, 'failed', error
+                continue
+
+            for inputs, ofile in zip(scheduled, ofiles):
+                yield inputs, 'done', ofile
+        finally:
+            for fusion in opened:
+                fusion.close()
+
+
+def collect_inputs(stage, patterns=None, manifest=None, catalog=None, domain=None, input_dir='./output'):
+    """
+    :param stage: str
+    :param patterns: list, glob patterns of input files
+    :param manifest: str, path to text file with one scene per line (MODIS and Sentinel-2 paths separated
+    by whitespace for fusion)
+    :param catalog: <michigan.catalog.Catalog> object. Scenes (pairs for fusion) are taken from it
+    :param domain: <nansat.domain.Domain> object or tuple (lon_min, lat_min, lon_max, lat_max), filter of
+    catalog scenes
+    :param input_dir: str, directory with outputs of the geolocation and downscale stages. Fusion of catalog
+    pairs takes these outputs instead of raw MODIS L2 and SAFE products
+    :return: list of tuples, inputs of each scene
+    """
+    scenes = []
+    for pattern in patterns or []:
+        scenes += [(path,) for path in sorted(glob.glob(pattern))]
+
+    if manifest is not None:
+        with open(manifest) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    scenes.append(tuple(line.split()))
+
+    if catalog is not None:
+        if stage == 'fusion':
+            for date, m_path, s_path in catalog.pairs(domain=domain):
+                pair = (output_path('geolocation', (m_path,), input_dir),
+                        output_path('downscale', (s_path,), input_dir))
+                missing = [path for path in pair if not is_valid(path)]
+                if missing:
+                    print >> sys.stderr, 'skipped %s %s: not reprojected (%s)' % (m_path, s_path, ', '.join(missing))
+                    continue
+                scenes.append(pair)
+        elif stage in ('geolocation', 'geolocation_beta'):
+            scenes += [(path,) for date, path in catalog.scenes('modis', domain=domain)]
+        elif stage == 'downscale':
+            scenes += [(path,) for date, path in catalog.scenes('sentinel2', domain=domain)]
+
+    # Keep the first occurrence of each scene
+    seen = set()
+    unique = []
+    for scene in scenes:
+        if scene not in seen:
+            seen.add(scene)
+            unique.append(scene)
+    return unique
+
+
+def run_batch(stage, scenes, output_dir, catalog, processes=4, options=None, force=False, verify=False,
+              queue=None, lease_seconds=600, prefetch=False, scratch_dir=None, depth=2, memory_limit_mb=None,
+              cores=None):
+    """
+    :param stage: str
+    :param scenes: list of tuples, inputs of each scene
+    :param output_dir: str
+    :param catalog: <michigan.catalog.Catalog> object, keeps state of each scene
+    :param processes: int
+    :param options: dict, keyword arguments of the stage method
+    :param force: bool, process scenes with valid outputs too. It can't be used with <queue>
+    :param verify: bool, open existing outputs to check them
+    :param queue: str, directory of the work queue shared by several nodes or None
+    :param lease_seconds: float, expiry time of leases of the work queue
+    :param prefetch: bool, process scenes in this process with prefetching of inputs onto local scratch
+    (see <run_prefetch>) instead of the pool
+    :param scratch_dir: str, local directory for prefetching
+    :param depth: int, number of prefetched scenes
+    :param memory_limit_mb: float, ceiling of size of prefetched inputs
+    :param cores: int, core budget of the fusion stage. If given, <processes> scenes are fused at once in this
+    process by <run_scheduled> instead of the pool
+    :return: dict, number of done, skipped and failed scenes
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    if force and queue is not None:
+        # Done markers of the queue would skip the scenes anyway, other nodes rely on them
+        raise ValueError('force can not be used with a work queue, remove its <done> directory instead')
+
+    if cores is not None and (stage != 'fusion' or queue is not None or prefetch):
+        raise ValueError('cores can be used only by the fusion stage without a work queue and prefetching')
+
+    if queue is not None:
+        # The directories of the queue are created once by the parent
+        WorkQueue(queue, lease_seconds)
+        queue = (queue, lease_seconds)
+
+    summary = {'done': 0, 'skipped': 0, 'failed': 0}
+    tasks = []
+    for inputs in scenes:
+        ofile = output_path(stage, inputs, output_dir)
+        if not force and is_valid(ofile, verify=verify):
+            catalog.set_state(inputs[0], stage, 'done', ofile)
+            summary['skipped'] += 1
+            continue
+        catalog.set_state(inputs[0], stage, 'queued', ofile)
+        tasks.append((stage, inputs, output_dir, options, queue))
+
+    def record(inputs, state, result, wall=None):
+        summary[state] += 1
+        if state == 'done':
+            catalog.set_state(inputs[0], stage, state, result)
+            print '%s %s%s' % (state, inputs[0], '' if wall is None else ' %.1f s' % wall)
+        elif state == 'skipped':
+            catalog.set_state(inputs[0], stage, state, output_path(stage, inputs, output_dir))
+            print '%s %s: %s' % (state, inputs[0], result)
+        else:
+            catalog.set_state(inputs[0], stage, state, output_path(stage, inputs, output_dir))
+            print >> sys.stderr, '%s %s: %s' % (state, inputs[0], result)
+
+    if prefetch:
+        for inputs, state, result in run_prefetch(stage, [task[1] for task in tasks], output_dir, options=options,
+                                                  queue=queue, scratch_dir=scratch_dir, depth=depth,
+                                                  memory_limit_mb=memory_limit_mb):
+            record(inputs, state, result)
+        return summary
+
+    if cores is not None:
+        for inputs, state, result in run_scheduled([task[1] for task in tasks], output_dir, options=options,
+                                                   cores=cores, group=processes):
+            record(inputs, state, result)
+        return summary
+
+    # One task per worker process: memory of a scene is released when the process exits
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        for inputs, state, result, wall in pool.imap_unordered(run_task, tasks):
+            record(inputs, state, result, wall)
+    finally:
+        pool.close()
+        pool.join()
+
+    return summary
+
+
+def parse_options(items):
+    """
+    :param items: list, KEY=VALUE strings. Values are parsed as Python literals if possible
+    :return: dict
+    """
+    import ast
+    options = {}
+    for item in items or []:
+        key, value = item.split('=', 1)
+        try:
+            options[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            options[key] = value
+    return options
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Batch processing of MODIS and Sentinel-2 scenes')
+    parser.add_argument('stage', choices=sorted(STAGES))
+    parser.add_argument('--input', action='append', help='glob pattern of input files (can be repeated)')
+    parser.add_argument('--manifest', help='text file with one scene per line')
+    parser.add_argument('--from-catalog', action='store_true', help='take scenes (pairs for fusion) from catalog')
+    parser.add_argument('--catalog', default='./michigan_catalog.sqlite', help='path to catalog database')
+    parser.add_argument('--output-dir', default='./output')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('LON_MIN', 'LAT_MIN', 'LON_MAX', 'LAT_MAX'),
+                        help='take only --from-catalog scenes which overlap this box')
+    parser.add_argument('--input-dir', help='outputs of geolocation and downscale for --from-catalog fusion '
+                                            '(default: --output-dir)')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--cores', type=int, default=None, help='core budget of fusion of --processes scenes at '
+                                                                'once (threads of each band: --option threads=N)')
+    parser.add_argument('--option', action='append', help='KEY=VALUE keyword argument of the stage method')
+    parser.add_argument('--force', action='store_true', help='process scenes with existing outputs')
+    parser.add_argument('--verify', action='store_true', help='open existing outputs to check them')
+    parser.add_argument('--queue', help='work queue directory shared by several nodes')
+    parser.add_argument('--lease-seconds', type=float, default=600, help='expiry time of work queue leases')
+    parser.add_argument('--prefetch', action='store_true', help='overlap reading of next scenes with processing')
+    parser.add_argument('--scratch-dir', help='local directory for prefetched inputs')
+    parser.add_argument('--depth', type=int, default=2, help='number of prefetched scenes')
+    parser.add_argument('--memory-limit', type=float, default=None, help='ceiling of prefetched inputs, MB')
+    parser.add_argument('--cache', help='directory of cached swath lookups and bathymetry (default: $MICHIGAN_CACHE '
+                                        'or ~/.cache/michigan)')
+    parser.add_argument('--stage-cache', help='directory of cached outputs of stages (see michigan.stagecache)')
+    parser.add_argument('--stage-cache-mb', type=float, default=None, help='max size of the stage cache, MB')
+    return parser
+
+
+def main(args=None):
+    parser = build_parser()
+    args = parser.parse_args(args)
+    if args.force and args.queue:
+        parser.error('--force can not be used with --queue, remove %s instead' % os.path.join(args.queue, 'done'))
+    if args.cache:
+        os.environ['MICHIGAN_CACHE'] = args.cache
+    if args.stage_cache:
+        # Workers import the stage modules and configure the cache from the environment
+        os.environ['MICHIGAN_STAGE_CACHE'] = args.stage_cache
+        if args.stage_cache_mb is not None:
+            os.environ['MICHIGAN_STAGE_CACHE_MB'] = str(args.stage_cache_mb)
+    catalog = Catalog(args.catalog)
+    try:
+        scenes = collect_inputs(args.stage, patterns=args.input, manifest=args.manifest,
+                                catalog=catalog if args.from_catalog else None,
+                                domain=tuple(args.bbox) if args.bbox else None,
+                                input_dir=args.input_dir or args.output_dir)
+        summary = run_batch(args.stage, scenes, args.output_dir, catalog, processes=args.processes,
+                            options=parse_options(args.option), force=args.force, verify=args.verify,
+                            queue=args.queue, lease_seconds=args.lease_seconds, prefetch=args.prefetch,
+                            scratch_dir=args.scratch_dir, depth=args.depth, memory_limit_mb=args.memory_limit,
+                            cores=args.cores)
+    finally:
+        catalog.close()
+
+    print 'done: %(done)d, skipped: %(skipped)d, failed: %(failed)d' % summary
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import os
+import re
+import glob
+import time
+import sqlite3
+import datetime
+
+from geolocation import domain_bbox
+from sentinel2 import Granule
+
+# Glob patterns of products for each sensor inside of data root directory
+PATTERNS = {
+    'modis': 'A*.nc',
+    'sentinel2': 'S2*',
+    'sentinel3': 'S3*',
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scenes (
+    path TEXT PRIMARY KEY,
+    sensor TEXT NOT NULL,
+    date TEXT NOT NULL,
+    start_time TEXT,
+    lon_min REAL,
+    lat_min REAL,
+    lon_max REAL,
+    lat_max REAL,
+    granules TEXT,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS scenes_sensor_date ON scenes (sensor, date);
+CREATE TABLE IF NOT EXISTS states (
+    path TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    output TEXT,
+    updated REAL,
+    PRIMARY KEY (path, stage)
+);
+'''
+
+
+def get_modis_time(mfile):
+    """
+    :param mfile: str, MODIS L2 file name (e.g. A2016187190000.L2_LAC_OC.nc)
+    :return: <datetime.datetime> object, start of acquisition
+    """
+    f = os.path.split(mfile)[-1]
+    f_year, f_day = int(f[1:5]), int(f[5:8])
+    f_time = datetime.datetime(f_year, 1, 1) + datetime.timedelta(f_day - 1)
+    if re.match(r'\d{6}', f[8:14]):
+        f_time = f_time.replace(hour=int(f[8:10]), minute=int(f[10:12]), second=int(f[12:14]))
+    return f_time
+
+
+def get_sentinel_time(sfile):
+    """
+    :param sfile: str, Sentinel-2/3 product name
+    :return: <datetime.datetime> object, start of acquisition
+    """
+    f = os.path.split(os.path.normpath(sfile))[-1]
+    # Old S2 names have processing time first and acquisition time after <_V>
+    stamp = re.search(r'_V(\d{8}T\d{6})', f) or re.search(r'_(\d{8}T\d{6})', f)
+    if stamp is None:
+        raise ValueError('No acquisition time in the name of %s' % sfile)
+    return datetime.datetime.strptime(stamp.group(1), '%Y%m%dT%H%M%S')
+
+
+def get_s3_footprint(sfile):
+    """
+    Footprint of a Sentinel-3 SAFE product from its manifest or, if there is no footprint in the manifest,
+    from <geo_coordinates.nc>
+    :param sfile: str, path to Sentinel-3 product (*.SEN3 directory)
+    :return: tuple, lon_min, lat_min, lon_max, lat_max or None if the footprint is unknown
+    """
+    manifest = os.path.join(sfile, 'xfdumanifest.xml')
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            pos_list = re.search(r'<gml:posList>([^<]+)</gml:posList>', f.read())
+        if pos_list is not None:
+            # pairs of <lat lon>
+            coords = [float(c) for c in pos_list.group(1).split()]
+            lats, lons = coords[0::2], coords[1::2]
+            if lats:
+                return min(lons), min(lats), max(lons), max(lats)
+
+    geo_file = os.path.join(sfile, 'geo_coordinates.nc')
+    if os.path.exists(geo_file):
+        from nansat import Nansat
+
+        n = Nansat(geo_file)
+        lat, lon = n['latitude'], n['longitude']
+        valid = (lon >= -180) & (lon <= 180) & (lat >= -90) & (lat <= 90)
+        if valid.any():
+            return (float(lon[valid].min()), float(lat[valid].min()),
+                    float(lon[valid].max()), float(lat[valid].max()))
+
+    return None
+
+
+class Catalog:
+    """
+    On-disk (SQLite) index of MODIS L2 files and Sentinel-2/3 SAFE products.
+    Products are opened only when they are indexed for the first time or changed.
+    """
+
+    def __init__(self, db_path='./michigan_catalog.sqlite'):
+        """
+        :param db_path: str, path to SQLite database. It should be on a local disk, not on NFS
+        """
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, path, sensor):
+        """
+        Index new and changed products of <sensor> in directory <path> and remove vanished ones
+        :param path: str, path to files storage
+        :param sensor: str, name of sensor: <modis>, <sentinel2>, <sentinel3>
+        :return: int, number of (re)indexed products
+        """
+        files_list = sorted(glob.glob(os.path.join(path, PATTERNS[sensor])))
+        known = dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            'SELECT path, mtime, size FROM scenes WHERE sensor = ?', (sensor,)))
+
+        indexed = 0
+        for fpath in files_list:
+            stat = os.stat(fpath)
+            if known.get(fpath) == (stat.st_mtime, stat.st_size):
+                continue
+
+            try:
+                record = self.describe(fpath, sensor)
+            except ValueError as e:
+                print 'Skipping %s: %s' % (fpath, e)
+                continue
+            self.db.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (fpath, sensor, record['date'], record['start_time'],
+                             record['lon_min'], record['lat_min'], record['lon_max'], record['lat_max'],
+                             record['granules'], stat.st_mtime, stat.st_size))
+            indexed += 1
+
+        root = os.path.join(path, '')
+        present = set(files_list)
+        vanished = [(fpath,) for fpath in known if fpath.startswith(root) and fpath not in present]
+        self.db.executemany('DELETE FROM scenes WHERE path = ?', vanished)
+        self.db.commit()
+        return indexed
+
+    def describe(self, fpath, sensor):
+        """
+        :param fpath: str, path to product
+        :param sensor: str, name of sensor
+        :return: dict, acquisition time, footprint bbox and granules of the product
+        """
+        record = {'lon_min': None, 'lat_min': None, 'lon_max': None, 'lat_max': None, 'granules': None}
+
+        if sensor == 'modis':
+            from nansat import Nansat
+
+            start_time = get_modis_time(fpath)
+            n = Nansat(fpath)
+            metadata = n.get_metadata()
+            try:
+                record.update(lon_min=float(metadata['geospatial_lon_min']),
+                              lat_min=float(metadata['geospatial_lat_min']),
+                              lon_max=float(metadata['geospatial_lon_max']),
+                              lat_max=float(metadata['geospatial_lat_max']))
+            except KeyError:
+                lat, lon = n['lat'], n['lon']
+                valid = (lon >= -180) & (lon <= 180) & (lat >= -90) & (lat <= 90)
+                record.update(lon_min=float(lon[valid].min()), lat_min=float(lat[valid].min()),
+                              lon_max=float(lon[valid].max()), lat_max=float(lat[valid].max()))
+
+        else:
+            start_time = get_sentinel_time(fpath)
+
+        if sensor == 'sentinel2':
+            s2_user = re.match(r'S2A_USER', os.path.split(fpath)[-1]) is not None
+            gdirs = sorted(glob.glob(os.path.join(fpath, 'GRANULE', '*')))
+            granules = []
+            lons = []
+            lats = []
+            for gdir in gdirs:
+                tile = re.search(r'_T(\d\d[A-Z]{3})(_|$)', os.path.split(gdir)[-1])
+                if tile is None:
+                    continue
+                granules.append(tile.group(1))
+                granule = Granule(gdir, s2_user=s2_user)
+                if '01' in granule.band_files:
+                    lon, lat, projection = granule.footprint()
+                    lons += list(lon)
+                    lats += list(lat)
+
+            record['granules'] = ','.join(sorted(set(granules)))
+            if lons:
+                record.update(lon_min=min(lons), lat_min=min(lats), lon_max=max(lons), lat_max=max(lats))
+
+        if sensor == 'sentinel3':
+            bbox = get_s3_footprint(fpath)
+            if bbox is not None:
+                record.update(zip(('lon_min', 'lat_min', 'lon_max', 'lat_max'), bbox))
+
+        record['date'] = start_time.date().isoformat()
+        record['start_time'] = start_time.isoformat()
+        return record
+
+    def scenes(self, sensor, domain=None, date=None):
+        """
+        :param sensor: str, name of sensor
+        :param domain: <nansat.domain.Domain> object or tuple (lon_min, lat_min, lon_max, lat_max)
+        :param date: <datetime.date> object or str (YYYY-MM-DD)
+        :return: list of tuples, (date, path)
+        """
+        query = 'SELECT date, path FROM scenes WHERE sensor = ?'
+        args = [sensor]
+        if date is not None:
+            query += ' AND date = ?'
+            args.append(str(date))
+        if domain is not None:
+            query += ' AND ' + self._overlap('scenes')
+            args += self._bbox(domain)
+
+        return self.db.execute(query + ' ORDER BY date, path', args).fetchall()
+
+    def pairs(self, domain=None, lores='modis', hires='sentinel2', granules=None):
+        """
+        Same-day pairs of low and high resolution scenes which overlap <domain>
+        :param domain: <nansat.domain.Domain> object or tuple (lon_min, lat_min, lon_max, lat_max)
+        :param lores: str, sensor of low resolution scenes
+        :param hires: str, sensor of high resolution scenes
+        :param granules: list, names of granules which should be present in the high resolution scene
+        :return: list of tuples, (date, low resolution path, high resolution path)
+        """
+        query = ('SELECT m.date, m.path, s.path, s.granules FROM scenes m JOIN scenes s ON m.date = s.date '
+                 'WHERE m.sensor = ? AND s.sensor = ?')
+        args = [lores, hires]
+        if domain is not None:
+            bbox = self._bbox(domain)
+            query += ' AND ' + self._overlap('m') + ' AND ' + self._overlap('s')
+            args += bbox + bbox
+
+        pairs = []
+        for date, m_path, s_path, s_granules in self.db.execute(query + ' ORDER BY m.date, m.path', args):
+            if granules is not None and not set(granules).issubset((s_granules or '').split(',')):
+                continue
+            pairs.append((date, m_path, s_path))
+
+        return pairs
+
+    def set_state(self, path, stage, state, output=None):
+        """
+        :param path: str, path to product
+        :param stage: str, name of processing stage (e.g. 'geolocation', 'downscale', 'fusion', 'boreali')
+        :param state: str, e.g. 'done', 'failed'
+        :param output: str, path to output of the stage
+        """
+        self.db.execute('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?)',
+                        (path, stage, state, output, time.time()))
+        self.db.commit()
+
+    def get_state(self, path, stage):
+        """
+        :return: tuple, (state, output) or None if the product was not processed by <stage>
+        """
+        return self.db.execute('SELECT state, output FROM states WHERE path = ? AND stage = ?',
+                               (path, stage)).fetchone()
+
+    @staticmethod
+    def _bbox(domain):
+        """
+        :return: list, arguments of <_overlap> condition
+        """
+        if isinstance(domain, tuple):
+            lon_min, lat_min, lon_max, lat_max = domain
+        else:
+            lon_min, lat_min, lon_max, lat_max = domain_bbox(domain)
+        return [lon_max, lon_min, lat_max, lat_min]
+
+    @staticmethod
+    def _overlap(table):
+        return ('%(t)s.lon_min <= ? AND %(t)s.lon_max >= ? AND %(t)s.lat_min <= ? AND %(t)s.lat_max >= ?'
+                % {'t': table})
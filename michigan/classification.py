@@ -0,0 +1,223 @@
+import warnings
+
+import numpy as np
+
+from utils import atomic_path
+
+# Default depth bins (h_min, h_max) of bottom classification. None means no limit
+DEPTH_BINS = ((None, 30),)
+
+
+def in_bin(depth, depth_bin):
+    """
+    :param depth: numpy array
+    :param depth_bin: tuple, (h_min, h_max), None means no limit
+    :return: numpy array, bool mask of pixels inside of the bin (as in <Fusion.get_h_mask>)
+    """
+    h_min, h_max = depth_bin
+    inside = np.isfinite(depth)
+    if h_max is not None:
+        inside &= depth <= h_max
+    if h_min is not None:
+        inside &= depth >= h_min
+    return inside
+
+
+def scene_spectra(n, wavelengths, r_type='Rrs_'):
+    """
+    :param n: <nansat.nansat.Nansat> object
+    :param wavelengths: list
+    :param r_type: str, prefix of reflectance bands
+    :return: numpy array, float32 (bands, rows, cols)
+    """
+    return np.array([n[r_type + str(wavelength)] for wavelength in wavelengths], dtype=np.float32)
+
+
+def nearest_centroid(samples, centroids, block_size=100000):
+    """
+    :param samples: numpy array, (samples, bands)
+    :param centroids: numpy array, (clusters, bands)
+    :param block_size: int, number of samples processed at once
+    :return: numpy array, int labels
+    """
+    labels = np.empty(samples.shape[0], dtype=np.int32)
+    c_norm = (centroids ** 2).sum(axis=1)
+    for start in range(0, samples.shape[0], block_size):
+        block = samples[start:start + block_size]
+        distance = c_norm[None, :] - 2 * np.dot(block, centroids.T)
+        labels[start:start + block_size] = distance.argmin(axis=1)
+    return labels
+
+
+class BottomClassifier:
+    """
+    Bottom classification of Rrs spectra. Only valid (finite, inside of a depth bin) pixels are used.
+    Models of all depth bins are fitted incrementally (mini-batch k-means) in one pass over scenes
+    or by full k-means on one scene (<fit>), centroids can be saved and used for labelling of new scenes
+    by the nearest centroid.
+    """
+
+    def __init__(self, clusters, wavelengths, depth_bins=DEPTH_BINS, batch_size=10000, random_state=0):
+        """
+        :param clusters: int, number of bottom classes
+        :param wavelengths: list
+        :param depth_bins: list of tuples, (h_min, h_max)
+        :param batch_size: int, size of mini-batch
+        :param random_state: int
+        """
+        self.clusters = clusters
+        self.wavelengths = list(wavelengths)
+        self.depth_bins = [tuple(depth_bin) for depth_bin in depth_bins]
+        self.batch_size = batch_size
+        self.random_state = random_state
+        # Models are created on the first fit, a loaded classifier predicts without sklearn
+        self.models = {}
+        # Samples which are waiting for a batch of at least <clusters> samples
+        self.pending = dict((depth_bin, []) for depth_bin in self.depth_bins)
+        self.samples = dict((depth_bin, 0) for depth_bin in self.depth_bins)
+        self._centroids = None
+
+    @staticmethod
+    def valid_samples(spectra, depth, depth_bin):
+        """
+        :param spectra: numpy array, (bands, rows, cols)
+        :param depth: numpy array, (rows, cols)
+        :param depth_bin: tuple
+        :return: numpy arrays, bool mask of valid pixels and (valid pixels, bands) samples
+        """
+        valid = np.isfinite(spectra).all(axis=0) & in_bin(depth, depth_bin)
+        return valid, spectra[:, valid].T
+
+    def fit(self, spectra, depth):
+        """
+        Fit models of all depth bins by full k-means on one scene (as the original single scene classification).
+        Bins with fewer valid pixels than <clusters> are not fitted
+        :param spectra: numpy array, (bands, rows, cols)
+        :param depth: numpy array, (rows, cols)
+        :return: <BottomClassifier> object
+        """
+        from sklearn.cluster import KMeans
+
+        for depth_bin in self.depth_bins:
+            samples = self.valid_samples(spectra, depth, depth_bin)[1]
+            self.pending[depth_bin] = []
+            self.samples[depth_bin] = samples.shape[0]
+            self.models.pop(depth_bin, None)
+            if samples.shape[0] >= self.clusters:
+                self.models[depth_bin] = KMeans(n_clusters=self.clusters, random_state=self.random_state).fit(samples)
+
+        self._centroids = None
+        return self
+
+    def partial_fit(self, spectra, depth):
+        """
+        Update models of all depth bins by one scene
+        :param spectra: numpy array, (bands, rows, cols)
+        :param depth: numpy array, (rows, cols)
+        """
+        for depth_bin in self.depth_bins:
+            samples = self.valid_samples(spectra, depth, depth_bin)[1]
+            if self.pending[depth_bin]:
+                samples = np.concatenate(self.pending[depth_bin] + [samples])
+                self.pending[depth_bin] = []
+
+            for start in range(0, samples.shape[0], self.batch_size):
+                batch = samples[start:start + self.batch_size]
+                if batch.shape[0] < self.clusters:
+                    self.pending[depth_bin].append(batch)
+                    continue
+                self.model(depth_bin).partial_fit(batch)
+                self.samples[depth_bin] += batch.shape[0]
+
+        self._centroids = None
+
+    def model(self, depth_bin):
+        """
+        :param depth_bin: tuple
+        :return: <sklearn.cluster.MiniBatchKMeans> object of the bin
+        """
+        model = self.models.get(depth_bin)
+        if model is None or not hasattr(model, 'partial_fit'):
+            from sklearn.cluster import MiniBatchKMeans
+            # A model of <fit> is continued from its centroids
+            init = {} if model is None else {'init': model.cluster_centers_, 'n_init': 1}
+            self.models[depth_bin] = MiniBatchKMeans(n_clusters=self.clusters, batch_size=self.batch_size,
+                                                     random_state=self.random_state, **init)
+        return self.models[depth_bin]
+
+    def fit_files(self, files, depth, r_type='Rrs_'):
+        """
+        :param files: list, paths to scenes on the grid of <depth>. One scene is fitted by <fit>
+        :param depth: numpy array, bathymetry
+        :param r_type: str, prefix of reflectance bands
+        :return: <BottomClassifier> object
+        """
+        from nansat import Nansat
+
+        if len(files) == 1:
+            return self.fit(scene_spectra(Nansat(files[0]), self.wavelengths, r_type=r_type), depth)
+
+        for ifile in files:
+            self.partial_fit(scene_spectra(Nansat(ifile), self.wavelengths, r_type=r_type), depth)
+        return self
+
+    def centroids(self):
+        """
+        :return: dict, depth bin -> numpy array (clusters, bands). Bins without fitted model are skipped
+        """
+        if self._centroids is None:
+            self._centroids = dict((depth_bin, model.cluster_centers_)
+                                   for depth_bin, model in self.models.items()
+                                   if hasattr(model, 'cluster_centers_'))
+        return self._centroids
+
+    def predict(self, spectra, depth):
+        """
+        :param spectra: numpy array, (bands, rows, cols)
+        :param depth: numpy array, (rows, cols)
+        :return: dict, depth bin -> numpy array, int labels (rows, cols), -1 for not valid pixels
+        and bins without fitted model
+        """
+        centroids = self.centroids()
+        labels = {}
+        for depth_bin in self.depth_bins:
+            grid = np.full(depth.shape, -1, dtype=np.int32)
+            if depth_bin in centroids:
+                valid, samples = self.valid_samples(spectra, depth, depth_bin)
+                grid[valid] = nearest_centroid(samples, centroids[depth_bin])
+            else:
+                # Bins with fewer samples than clusters are never fitted
+                warnings.warn('Depth bin %s is not fitted (%d samples for %d clusters), all its pixels are '
+                              'labelled as -1' % (depth_bin, self.samples.get(depth_bin, 0) +
+                                                  sum(len(batch) for batch in self.pending.get(depth_bin, [])),
+                                                  self.clusters))
+            labels[depth_bin] = grid
+        return labels
+
+    def save(self, path):
+        """
+        :param path: str, path to npz file with centroids
+        """
+        centroids = self.centroids()
+        bins = [depth_bin for depth_bin in self.depth_bins if depth_bin in centroids]
+        arrays = dict(('centroids_%d' % i, centroids[depth_bin]) for i, depth_bin in enumerate(bins))
+        bins_arr = np.array([[np.nan if h is None else h for h in depth_bin] for depth_bin in bins],
+                            dtype=np.float64).reshape(-1, 2)
+
+        with atomic_path(path, '.tmp.npz') as tmp_path:
+            np.savez(tmp_path, wavelengths=np.array(self.wavelengths), depth_bins=bins_arr, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: str, path to npz file saved by <save>
+        :return: <BottomClassifier> object which can only predict
+        """
+        data = np.load(path)
+        bins = [tuple(None if np.isnan(h) else float(h) for h in depth_bin) for depth_bin in data['depth_bins']]
+        centroids = dict((depth_bin, data['centroids_%d' % i]) for i, depth_bin in enumerate(bins))
+        clusters = centroids[bins[0]].shape[0] if bins else 0
+
+        classifier = cls(clusters, data['wavelengths'].tolist(), depth_bins=bins)
+        classifier._centroids = centroids
+        return classifier
@@ -1,11 +1,16 @@
-from nansat import Nansat, Domain
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 import re
 import glob
-import gdal
-from nansat.nsr import NSR
+import functools
+
+from export import NCExport, export_nansat, BAND_SETS
+from geolocation import make_gcps, domain_bbox, swath_window
+from sentinel2 import Granule, find_granules, mosaic, read_band
+from warpcache import WarpCache, SwathLookup
+from instrument import stage
+from stagecache import code_version, from_environ
+from utils import LazyDomain, domain_key
 
 
 class Data:
@@ -19,7 +24,8 @@ class Data:
             'blue_and_red_off': [443, 469, 488, 531, 547, 555, 645, 667],  # Without 412 nm and 678 nm
             'red_off_full': [412, 443, 469, 488, 531, 547, 555],
             '1x1km_bands_412off': [443, 488, 531, 645, 678],  # Only 1x1 km spatial resolution bands without of 412 nm
-            '1x1km_bands_678off': [412, 443, 488, 531, 645]  # Only 1x1 km spatial resolution bands without of 678 nm
+            '1x1km_bands_678off': [412, 443, 488, 531, 645],  # Only 1x1 km spatial resolution bands without of 678 nm
+            'reprojection': [412, 443, 488, 531, 555, 645, 667, 678]  # Bands kept by reprojection of MODIS L2 files
 
         },
 
@@ -68,14 +74,40 @@ class Data:
     # <domain> is domain which covers Sandy Bear Dunes Region
     # To see region on a map see: https://github.com/korvinos/michigan/blob/master/michigan.geojson
     # To get characteristics of region see michigan.geojson
-    sbd_dom = Domain('+proj=latlong +datum=WGS84 +ellps=WGS84 +no_defs', '-lle -86.3 44.6 -85.2 45.3 -ts %s %s'
-                    % (x_resolution, y_resolution))
+    # The domain is built on first use
+    sbd_dom = LazyDomain('+proj=latlong +datum=WGS84 +ellps=WGS84 +no_defs', '-lle -86.3 44.6 -85.2 45.3 -ts %s %s'
+                         % (x_resolution, y_resolution))
 
     # <granules> is list of granules which covers Sandy Bear Dunes region.
     # To get more information about granules see:
     # https://sentinels.copernicus.eu/web/sentinel/user-guides/sentinel-2-msi/product-types
     granules = ['16TER', '16TFR', '16TEQ', '16TFQ']
 
+    # <s2_margin> is margin (degrees) around the domain for Sentinel-2 mosaic
+    s2_margin = 0.05
+
+    # <CACHE_PATH> is directory for cached intermediate data (swath lookups etc.).
+    # It is set by environment variable <MICHIGAN_CACHE>
+    CACHE_PATH = os.environ.get('MICHIGAN_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'michigan'))
+
+    # <gcp_margin> is margin (degrees) around the domain where GCPs are dense
+    gcp_margin = 0.5
+
+    # <crop_margin> is margin (degrees) around the domain. Only the part of MODIS swath inside of it is warped.
+    # None means that the full swath is warped
+    crop_margin = 0.2
+
+    # <warp_cache> keeps swath -> grid lookups of MODIS L2 files. It is shared by all objects of the process
+    warp_cache = WarpCache(os.path.join(CACHE_PATH, 'warp'))
+
+    # <stage_cache> keeps outputs of geolocation, downscaling and fusion (see <michigan.stagecache>).
+    # It is disabled (None) unless <MICHIGAN_STAGE_CACHE> is set
+    stage_cache = from_environ()
+
+    # <deferred> is a list which collects exports of outputs as functions instead of writing them,
+    # e.g. they are called by the writer thread of <michigan.pipeline.Pipeline> (see <write_output>)
+    deferred = None
+
     def __init__(self, ifile, domain=None):
         """
         :param ifile: str, file path  
@@ -89,6 +121,40 @@ class Data:
 
         self.ifile = ifile
 
+    def stage_key(self, name, inputs, code, **params):
+        """
+        :param name: str, name of the stage
+        :param inputs: list, paths to input files
+        :param code: list, modules, classes or functions which implement the stage
+        :param params: parameters of the stage
+        :return: str, key of the output in <stage_cache> or None if the cache is disabled
+        """
+        if self.stage_cache is None:
+            return None
+        return self.stage_cache.key(name, inputs, code_version(*code), domain_key(self.domain), **params)
+
+    def write_output(self, n, ofile, key=None, bands=None):
+        """
+        Export output of a stage and put it into <stage_cache>. If <deferred> is a list the export
+        is appended to it instead
+        :param n: <nansat.nansat.Nansat> object
+        :param ofile: str, path to output file
+        :param key: str, <stage_key> result or None
+        :param bands: list, names of bands for export. None means all bands
+        :return: <n>
+        """
+        export = functools.partial(self._write_output, n, ofile, key, bands)
+        if self.deferred is not None:
+            self.deferred.append(export)
+        else:
+            export()
+        return n
+
+    def _write_output(self, n, ofile, key, bands):
+        export_nansat(n, ofile, bands=bands)
+        if key is not None:
+            self.stage_cache.put(key, ofile)
+
     def modis_geo_location(self, wavelengths_set='1x1km_bands', save_path='./', gcp_count=40):
         """
         :param wavelengths_set: list, list of wavelengths 
@@ -96,179 +162,276 @@ class Data:
         :param gcp_count: str
         :return: <nansat.nansat.Nansat> object, an object with a new geo location 
         """
+        from nansat import Nansat
+
         file_name = os.path.split(self.ifile)[-1]
         print file_name
 
         if re.match(r'A', file_name) is None:
             raise IOError
 
-        n = Nansat(self.ifile, GCP_COUNT=gcp_count)
-        # Remove geo location
-        n.vrt.remove_geolocationArray()
-        n.vrt.tps = True
-        n.reproject_GCPs()
-        print n.time_coverage_start
+        ofile = os.path.join(save_path, os.path.split(self.ifile)[1] + '_reprojected.nc')
+        key = self.stage_key('geolocation', [self.ifile], [Data, SwathLookup, make_gcps, NCExport],
+                             wavelengths_set=wavelengths_set, gcp_count=gcp_count, gcp_margin=self.gcp_margin,
+                             crop_margin=self.crop_margin)
+        if key is not None and self.stage_cache.restore(key, ofile):
+            return Nansat(ofile)
 
-        # add index of pixels
-        index = np.arange(0, n.shape()[0] * n.shape()[1]).reshape(n.shape()).astype('int32')
-        n.add_band(index, parameters={'name': 'index'})
-        n.reproject(self.domain, addmask=False)
+        with stage('geolocation', scene=file_name):
+            m_file = Nansat(self.ifile)
+            lookup = self.modis_lookup(m_file, gcp_count=gcp_count)
+            print m_file.time_coverage_start
 
-        bands = ['Rrs_%s' % band for band in self.wavelengths['modis'][wavelengths_set]]
-        bands.insert(0, 'index')
+            bands = ['Rrs_%s' % band for band in self.wavelengths['modis'][wavelengths_set]]
 
-        n_export = Nansat(domain=self.domain)
-        for band in bands:
-            print band
-            band_arr = n[band]
-            n_export.add_band(band_arr, parameters={'name': band})
-            n_export.export(os.path.join(save_path, os.path.split(self.ifile)[1] + '_reprojected.nc'))
+            n_export = NCExport(self.domain, bands=BAND_SETS['modis'])
+            n_export.add_band(lookup.index(), parameters={'name': 'index'})
+            for band in bands:
+                print band
+                with stage('regrid', band=band):
+                    band_arr = lookup.regrid(m_file[band])
+                    n_export.add_band(band_arr, parameters={'name': band})
 
-        return n_export
+            # All bands are written by one pass
+            return self.write_output(n_export.n, ofile, key)
+
+    def modis_geo_location_beta(self, wavelengths_set='1x1km_bands', save_path='./', gcp_count=40, gcp_density=1):
+        """
+        :param wavelengths_set: list, list of wavelengths
+        :param save_path: str
+        :param gcp_count: int, number of GCPs along each dimension of the swath
+        :param gcp_density: int, GCPs over the domain are <gcp_density> times denser
+        :return: <nansat.nansat.Nansat> object, an object with a new geo location
+        """
+        from nansat import Nansat
+
+        ofile = os.path.join(save_path, os.path.split(self.ifile)[-1] + '_mumm_reprojected.nc')
+        key = self.stage_key('geolocation_beta', [self.ifile], [Data, SwathLookup, make_gcps, NCExport],
+                             wavelengths_set=wavelengths_set, gcp_count=gcp_count, gcp_density=gcp_density,
+                             gcp_margin=self.gcp_margin, crop_margin=self.crop_margin)
+        if key is not None and self.stage_cache.restore(key, ofile):
+            return Nansat(ofile)
+
+        with stage('geolocation', scene=os.path.split(self.ifile)[-1], beta=True):
+            m_file = Nansat(self.ifile)
+            lookup = self.modis_lookup(m_file, gcp_count=gcp_count, beta=True, gcp_density=gcp_density)
+            print m_file.time_coverage_start
+
+            bands = ['Rrs_%s' % band for band in self.wavelengths['modis'][wavelengths_set]]
+
+            n_export = NCExport(self.domain, bands=BAND_SETS['modis'])
+            n_export.add_band(lookup.index(), parameters={'name': 'index'})
+            for band in bands:
+                print band
+                with stage('regrid', band=band):
+                    band_arr = lookup.regrid(m_file[band])
+                    n_export.add_band(band_arr, parameters={'name': band})
+
+            # All bands are written by one pass
+            return self.write_output(n_export.n, ofile, key)
+
+    def modis_regrid(self, bands, gcp_count=40, beta=False, gcp_density=1):
+        """
+        Regrid any bands of MODIS L2 file (Rrs_*, chlor_a, aot_869, l2_flags, ...) onto <self.domain>.
+        The swath is warped only once (see <modis_lookup>), each band is taken by a vectorized gather.
+        :param bands: list, names of bands
+        :param gcp_count: int
+        :param beta: bool, use geolocation of <modis_geo_location_beta>
+        :param gcp_density: int, density of GCPs over the domain (only for <beta>)
+        :return: <nansat.nansat.Nansat> object, contains <index> band and all <bands>
+        """
+        from nansat import Nansat
 
-    def modis_geo_location_beta(self, wavelengths_set='1x1km_bands', save_path='./', gcp_count=40):
         m_file = Nansat(self.ifile)
+        lookup = self.modis_lookup(m_file, gcp_count=gcp_count, beta=beta, gcp_density=gcp_density)
+        print m_file.time_coverage_start
+
+        n_export = NCExport(self.domain)
+        n_export.add_band(lookup.index(), parameters={'name': 'index'})
+        for band in bands:
+            n_export.add_band(lookup.regrid(m_file[band]), parameters={'name': band})
+
+        return n_export.n
+
+    def modis_lookup(self, m_file, gcp_count=40, beta=False, gcp_density=1):
+        """
+        :param m_file: <nansat.nansat.Nansat> object, MODIS L2 swath with <lat> and <lon> bands
+        :param gcp_count: int
+        :param beta: bool, use GCPs from lat/lon arrays and TPS in stereographic projection
+        :param gcp_density: int, density of GCPs over the domain (only for <beta>)
+        :return: <michigan.warpcache.SwathLookup> object, swath pixel -> grid cell lookup
+        """
         latitude = m_file['lat']
         longitude = m_file['lon']
-        title = 'test'
-        GCP_COUNT = gcp_count
-        step0 = max(1, int(float(latitude.shape[0]) / GCP_COUNT))
-        step1 = max(1, int(float(latitude.shape[1]) / GCP_COUNT))
-        m_file.logger.debug('gcpCount: >%s<, %d %d %f %d %d',
-                            title, latitude.shape[0], latitude.shape[1], GCP_COUNT, step0, step1)
-        pixelStep = 1
-        lineStep = 1
-        dx = .5
-        dy = .5
-        gcps = []
-        k = 0
-        center_lon = 0
-        center_lat = 0
-        for i0 in range(0, latitude.shape[0], step0):
-            for i1 in range(0, latitude.shape[1], step1):
-                # create GCP with X,Y,pixel,line from lat/lon matrices
-                lon = float(longitude[i0, i1])
-                lat = float(latitude[i0, i1])
-                if (lon >= -180 and lon <= 180 and lat >= -90 and lat <= 90):
-                    gcp = gdal.GCP(lon, lat, 0, i1 * pixelStep + dx,
-                                   i0 * lineStep + dy)
-                    m_file.logger.debug('%d %d %d %f %f', k, gcp.GCPPixel, gcp.GCPLine, gcp.GCPX, gcp.GCPY)
-                    gcps.append(gcp)
-                    center_lon += gcp.GCPX
-                    center_lat += gcp.GCPY
-                    k += 1
+        key = WarpCache.key(latitude, longitude, self.domain, 'beta' if beta else 'tps', gcp_count, gcp_density,
+                            self.crop_margin)
+        lookup = self.warp_cache.get(key)
+
+        if lookup is None:
+            with stage('warp', gcp_count=gcp_count, beta=beta):
+                lookup = self.modis_warp(latitude, longitude, gcp_count, beta, gcp_density)
+            self.warp_cache.put(key, lookup)
+
+        return lookup
+
+    def modis_warp(self, latitude, longitude, gcp_count=40, beta=False, gcp_density=1):
+        """
+        Warp swath pixel numbers onto <self.domain>. If <crop_margin> is set only the window
+        of the swath which intersects the domain is used for GCPs and warping.
+        :param latitude: numpy array
+        :param longitude: numpy array
+        :param gcp_count: int
+        :param beta: bool, use TPS in stereographic projection
+        :param gcp_density: int, density of GCPs over the domain (only for <beta>)
+        :return: <michigan.warpcache.SwathLookup> object
+        """
+        from nansat import Nansat
+
+        y_off, x_off, y_size, x_size = 0, 0, latitude.shape[0], latitude.shape[1]
+
+        if self.crop_margin is not None:
+            window = swath_window(latitude, longitude, domain_bbox(self.domain, margin=self.crop_margin))
+            if window is None:
+                # The swath doesn't cover the domain at all
+                return SwathLookup(self.domain.shape(), latitude.shape, np.zeros(0, np.int32), np.zeros(0, np.int32))
+            y_off, x_off, y_size, x_size = window
+
+        if beta or self.crop_margin is not None:
+            n = self.modis_gcps(latitude, longitude, gcp_count, gcp_density=gcp_density,
+                                window=(y_off, x_off, y_size, x_size), stereo=beta)
+        else:
+            n = Nansat(self.ifile, GCP_COUNT=gcp_count)
+            # Remove geo location
+            n.vrt.remove_geolocationArray()
+            n.vrt.tps = True
+            n.reproject_GCPs()
+
+        # add index of pixels (numbers in the full swath), 0 is reserved for out-of-swath cells
+        rows, cols = np.mgrid[y_off:y_off + y_size, x_off:x_off + x_size]
+        index = (rows * latitude.shape[1] + cols + 1).astype('int32')
+        n.add_band(index, parameters={'name': 'index'})
+        n.reproject(self.domain, addmask=False)
+        return SwathLookup.from_index(n['index'], latitude.shape)
+
+    def modis_gcps(self, latitude, longitude, gcp_count, gcp_density=1, window=None, stereo=True):
+        """
+        :param latitude: numpy array, latitudes of the full swath
+        :param longitude: numpy array, longitudes of the full swath
+        :param gcp_count: int, number of GCPs along each dimension of the swath (or window)
+        :param gcp_density: int, GCPs over <self.domain> are <gcp_density> times denser
+        :param window: tuple, y_offset, x_offset, y_size, x_size of the used part of the swath
+        :param stereo: bool, reproject GCPs into stereographic projection centered on GCPs
+        :return: <nansat.nansat.Nansat> object, with GCPs from <latitude> and <longitude> and TPS
+        """
+        from nansat import Nansat
+        from nansat.nsr import NSR
+
+        m_file = Nansat(self.ifile)
+
+        if window is not None:
+            y_off, x_off, y_size, x_size = window
+            latitude = latitude[y_off:y_off + y_size, x_off:x_off + x_size]
+            longitude = longitude[y_off:y_off + y_size, x_off:x_off + x_size]
+            m_file.crop(x_off, y_off, x_size, y_size)
+
+        bbox = domain_bbox(self.domain, margin=self.gcp_margin)
+        gcps, center_lon, center_lat = make_gcps(latitude, longitude, gcp_count, bbox=bbox, density=gcp_density)
+        m_file.logger.debug('gcpCount: %d %d %d, density: %d, GCPs: %d',
+                            latitude.shape[0], latitude.shape[1], gcp_count, gcp_density, len(gcps))
 
         # append GCPs and lat/lon projection to the vsiDataset
         m_file.vrt.dataset.SetGCPs(gcps, NSR().wkt)
         m_file.vrt.remove_geolocationArray()
 
         # reproject GCPs
-        center_lon /= k
-        center_lat /= k
-        srs = '+proj=stere +datum=WGS84 +ellps=WGS84 +lon_0=%f +lat_0=%f +no_defs' % (center_lon, center_lat)
-        m_file.reproject_GCPs(srs)
+        if stereo:
+            srs = '+proj=stere +datum=WGS84 +ellps=WGS84 +lon_0=%f +lat_0=%f +no_defs' % (center_lon, center_lat)
+            m_file.reproject_GCPs(srs)
+        else:
+            m_file.reproject_GCPs()
 
         # use TPS for reprojection
         m_file.vrt.tps = True
-        print m_file.time_coverage_start
-
-        # add index of pixels
-        index = np.arange(0, m_file.shape()[0] * m_file.shape()[1]).reshape(m_file.shape()).astype('int32')
-        m_file.add_band(index, parameters={'name': 'index'})
-        m_file.reproject(Data.sbd_dom, addmask=False)
-
-        bands = ['Rrs_%s' % band for band in self.wavelengths['modis'][wavelengths_set]]
-        bands.insert(0, 'index')
+        return m_file
 
-        n_export = Nansat(domain=Data.sbd_dom)
-        for band in bands:
-            print band
-            band_arr = m_file[band]
-            n_export.add_band(band_arr, parameters={'name': band})
-            n_export.export(os.path.join(save_path, os.path.split(self.ifile)[-1] + '_mumm_reprojected.nc'))
-
-        return n_export
-
-    def stich(self, domain, bands, gdirs, s2_user=False):
+    def stich(self, domain, bands, gdirs, s2_user=False, processes=4):
         """
         :param domain: 
         :param bands: list
-        :param gdirs: list, list of directories paths 
+        :param gdirs: list, list of directories paths or <michigan.sentinel2.Granule> objects
         :param s2_user: bool, is it corrected file
+        :param processes: int, number of parallel workers for decoding and warping
         :return: 
         """
+        from nansat import Nansat
+
+        granules = [gdir if isinstance(gdir, Granule) else Granule(gdir, s2_user=s2_user) for gdir in gdirs]
+        # Each granule is opened once, all bands of all granules are warped in parallel
+        with stage('stitching', granules=len(granules), bands=len(bands)):
+            cube = mosaic(granules, domain, bands, processes=processes)
+
         # Create base nansat object which domain covers all four <granules>
         n_obj = Nansat(domain=domain)
-        for band in bands:
+        for band, band_arr in zip(bands, cube):
             print('Band:', band, self.wavelengths['sentinel2'][band])
-            # Generate 2d array which will have shape like <d> and filled by nan
-            band_arr = np.zeros(domain.shape()) + np.nan
-            for gdir in gdirs:
-                data_path = os.path.join(gdir, 'IMG_DATA', '*_B%s.jp2' % band)
-
-                if s2_user:
-                    data_path = os.path.join(gdir, 'IMG_DATA', 'R60m', '*_B%s_60m.jp2' % band)
-                try:
-                    bfile = glob.glob(data_path)[0]
-                    n = Nansat(bfile)
-                    # Reprojection of data according to domain; eResampleAlg 1 is Bilinear
-                    n.reproject(domain, eResampleAlg=1, addmask=False)
-                    # Get data array from nansat object
-                    bdata = n[1]
-                    band_arr[bdata > 0] = bdata[bdata > 0]
-                except IndexError:
-                    print "Data path <%s> doesn't exist" % data_path
-                    pass
-
             n_obj.add_band(band_arr, parameters={'name': 'Rrs_%s' % self.wavelengths['sentinel2'][band]})
 
         return n_obj
 
-    def s2_downscale(self, save_path='./'):
+    def s2_downscale(self, save_path='./', processes=4):
+        from nansat import Nansat, Domain
+
         file_name = os.path.split(self.ifile)[-1]
         print file_name
-        s2_user = False
 
         if re.match(r'S2A', file_name) is None:
             raise IOError
 
-        gdirs = []
-        for granule in self.granules:
-
-            gdirs += sorted(glob.glob(os.path.join(self.ifile, 'GRANULE', '*_T%s_*' % granule)))
-
-        # get lon/lat limits
-        # Lists for accumulation of lon/lat values from each granule
-        lons = []
-        lats = []
-
-        for gdir in gdirs:
-            data_path = os.path.join(gdir, 'IMG_DATA', '*_B01.jp2')
-
-            # We need other path pattern for corrected S2 data
-            if re.match(r'S2A_USER', file_name) is not None:
-                data_path = os.path.join(gdir, 'IMG_DATA', 'R60m', '*_B01_60m.jp2')
-                s2_user = True
-
-            # Find absolute path to relevant granule
-            b0file = glob.glob(data_path)[0]
-            # Get granule by nansat
-            n = Nansat(b0file)
-            lon, lat = n.get_corners()
-            # Add min/max values of long and lat to list
-            lons += list(lon)
-            lats += list(lat)
-
-        # Create domain according to max and min values of lon and lat
-        d = Domain(n.vrt.get_projection(), '-lle %f %f %f %f -tr 60 60' % (min(lons), min(lats), max(lons), max(lats)))
-        print('Domain created')
-
-        n_obj = self.stich(d, sorted(self.wavelengths['sentinel2'].keys()), gdirs, s2_user=s2_user)
-        n_obj.reproject(self.domain)
-        export_name = os.path.split(self.ifile)[1] + '_reprojected.nc'
-        n_obj.export(os.path.join(save_path, export_name))
+        ofile = os.path.join(save_path, os.path.split(self.ifile)[1] + '_reprojected.nc')
+        # We need other path pattern for corrected S2 data
+        s2_user = re.match(r'S2A_USER', file_name) is not None
+        granules = find_granules(self.ifile, self.granules, s2_user=s2_user)
+
+        # Decoding of JP2 granules is skipped if the mosaic of this SAFE is cached. The key is built on band
+        # files of the used granules, so a partial copy of the SAFE (see <michigan.pipeline.ScratchLoader>)
+        # has the same key
+        band_files = sorted(path for granule in granules for path in granule.band_files.values())
+        key = self.stage_key('downscale', band_files, [Data, Granule, export_nansat], product=file_name,
+                             granules=self.granules, pixel_size=self.pixel_size, s2_margin=self.s2_margin)
+        if key is not None and self.stage_cache.restore(key, ofile):
+            return Nansat(ofile)
+
+        with stage('downscale', scene=file_name):
+            # get lon/lat limits
+            # Lists for accumulation of lon/lat values from each granule
+            lons = []
+            lats = []
+
+            for granule in granules:
+                lon, lat, projection = granule.footprint()
+                # Add min/max values of long and lat to list
+                lons += list(lon)
+                lats += list(lat)
+
+            # Create domain according to max and min values of lon and lat.
+            # Only the part of granules which covers <self.domain> is decoded
+            lon_min, lat_min, lon_max, lat_max = domain_bbox(self.domain, margin=self.s2_margin)
+            lon_min, lat_min = max(min(lons), lon_min), max(min(lats), lat_min)
+            lon_max, lat_max = min(max(lons), lon_max), min(max(lats), lat_max)
+            if lon_min >= lon_max or lat_min >= lat_max:
+                raise IOError('Granules %s of %s do not overlap the domain'
+                              % (', '.join(os.path.basename(granule.gdir.rstrip('/')) for granule in granules),
+                                 file_name))
+            d = Domain(projection, '-lle %f %f %f %f -tr %d %d' % (lon_min, lat_min, lon_max, lat_max,
+                                                                   self.pixel_size, self.pixel_size))
+            print('Domain created')
+
+            n_obj = self.stich(d, sorted(self.wavelengths['sentinel2'].keys()), granules, processes=processes)
+            n_obj.reproject(self.domain)
+            return self.write_output(n_obj, ofile, key, bands=BAND_SETS['sentinel2'])
 
     def s2_make_granules(self, save_path='./'):
+        from nansat import Nansat, Domain
 
         if re.match(r'S2A', os.path.split(self.ifile)[-1]) is None:
             raise IOError
@@ -325,17 +488,17 @@ class Data:
 
         # Part II: Reprojection of granules
         # Generate 2d array which will have shape like #d annd fill by nan
-        s2array = np.zeros(d.shape()) + np.nan
+        s2array = np.full(d.shape(), np.nan, dtype=np.float32)
         # For each granule in granules list / gdirs
         for gdir in gdirs:
             # Get B01.jp2 image (granule) path
             b01file = glob.glob(os.path.join(gdir, 'IMG_DATA', '*_B01.jp2'))[0]
             ## print b01file
-            n = Nansat(b01file)
             # Reprojection of granule according #d, 0 is nearest neighbour
-            n.reproject(d, eResampleAlg=0)
-            # Get data array from nansat obj
-            b1 = n[1]
+            # Granule is decoded at resolution of #d
+            b1 = read_band(b01file, d, eResampleAlg=0)
+            if b1 is None:
+                continue
             # All areas in #s2array array will filled by vales from granule
             # As result, after loop we will get one object which contain data from all granules
             s2array[b1 > 0] = b1[b1 > 0]
@@ -345,6 +508,8 @@ class Data:
         # Why wm == 2 ?? From documentation: Create numpy array with watermask (water=1, land=0)
         s2array[wm == 2] = 0
 
+        import matplotlib.pyplot as plt
+
         # Create name of file
         qlfile = os.path.split(self.ifile)[1] + '_ql.png'
         # Save on disk full generated image: #s2array
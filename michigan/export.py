@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+
+from instrument import stage
+from utils import atomic_path
+
+# NetCDF4 with deflate compression. Variables are chunked (GDAL default for NC4)
+NC4_OPTIONS = ['FORMAT=NC4', 'COMPRESS=DEFLATE', 'ZLEVEL=4', 'CHUNKING=YES']
+
+# Wavelengths of all bands which can be kept by the stages (see <michigan.dataprep.Data.wavelengths>)
+MODIS_WAVELENGTHS = [412, 443, 469, 488, 531, 547, 555, 645, 667, 678]
+SENTINEL2_WAVELENGTHS = [443, 490, 560, 665, 705, 740, 783, 842, 865, 945, 1375, 1610, 2190]
+
+# Band sets which are exported by default for each product. Bands of a set which the product doesn't have
+# are skipped, other bands of the product (e.g. <swathmask> added by reprojection) are not exported
+BAND_SETS = {
+    'modis': ['index'] + ['Rrs_%d' % wavelength for wavelength in MODIS_WAVELENGTHS],
+    'sentinel2': ['Rrs_%d' % wavelength for wavelength in SENTINEL2_WAVELENGTHS],
+    'fusion': ['Rrs_%d' % wavelength for wavelength in MODIS_WAVELENGTHS],
+    'boreali': ['chl', 'tsm', 'doc', 'mse'],
+}
+
+# Parameters of bands which are kept when bands are converted by <export_nansat>
+BAND_PARAMETERS = ('name', 'long_name', 'standard_name', 'units', 'wavelength', 'wkv')
+
+
+class NCExport:
+    """
+    Collects bands on a domain and writes all of them into a NetCDF4 file by one pass.
+    All floating point bands are stored as <dtype> (float32 by default), integer bands (e.g. <index>)
+    keep their type.
+    """
+
+    def __init__(self, domain, bands=None, dtype=np.float32, options=NC4_OPTIONS):
+        """
+        :param domain: <nansat.domain.Domain> object (or <nansat.nansat.Nansat> object with the domain)
+        :param bands: list, names of bands which should be kept. None means all bands
+        :param dtype: numpy dtype for floating point bands
+        :param options: list, GDAL creation options of netCDF driver
+        """
+        from nansat import Nansat
+
+        self.n = Nansat(domain=domain)
+        self.bands = bands
+        self.dtype = dtype
+        self.options = options
+
+    def add_band(self, array, parameters):
+        """
+        :param array: numpy array
+        :param parameters: dict, parameters of band. <name> is required
+        """
+        if self.bands is not None and parameters['name'] not in self.bands:
+            return
+
+        if np.issubdtype(array.dtype, np.floating):
+            array = array.astype(self.dtype, copy=False)
+
+        self.n.add_band(array, parameters=parameters)
+
+    def export(self, ofile):
+        """
+        :param ofile: str, path to output file
+        :return: <nansat.nansat.Nansat> object
+        """
+        export_nansat(self.n, ofile, options=self.options)
+        return self.n
+
+
+def export_nansat(n, ofile, bands=None, options=NC4_OPTIONS, dtype=np.float32):
+    """
+    Write <n> into <ofile> by one pass (atomically, see <michigan.utils.atomic_path>).
+    Floating point bands of other types than <dtype> are converted as by <NCExport>
+    :param n: <nansat.nansat.Nansat> object
+    :param ofile: str, path to output file
+    :param bands: list, names of bands for export (e.g. <BAND_SETS> item), bands which <n> doesn't have are
+    skipped. None means all bands
+    :param options: list, GDAL creation options of netCDF driver
+    :param dtype: numpy dtype for floating point bands
+    """
+    import gdal
+
+    names = dict((metadata['name'], number) for number, metadata in n.bands().items())
+    if bands is None:
+        band_numbers = sorted(names.values())
+    else:
+        band_numbers = [names[band] for band in bands if band in names]
+
+    with stage('export', ofile=os.path.basename(ofile)):
+        # Bands are converted (and read into memory) only if their type differs from <dtype>
+        types = [gdal.GetDataTypeName(n.vrt.dataset.GetRasterBand(number).DataType) for number in band_numbers]
+        if any(name.startswith('Float') and name.lower() != np.dtype(dtype).name for name in types):
+            n_export = NCExport(n, dtype=dtype, options=options)
+            for number in band_numbers:
+                metadata = n.get_metadata(band_id=number)
+                n_export.add_band(n[number], parameters=dict((key, metadata[key]) for key in BAND_PARAMETERS
+                                                             if key in metadata))
+            n, band_numbers = n_export.n, None
+
+        with atomic_path(ofile) as tmp_file:
+            n.export(tmp_file, bands=band_numbers, options=options)
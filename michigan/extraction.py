@@ -0,0 +1,113 @@
+import csv
+
+import numpy as np
+
+
+def rrs_to_rrsw(rrs):
+    """
+    :param rrs: numpy array, remote sensing reflectance above water
+    :return: numpy array, remote sensing reflectance below water
+    """
+    return rrs / (0.52 + 1.7 * rrs)
+
+
+def point_pixels(n, points, latlon=False):
+    """
+    :param n: <nansat.nansat.Nansat> object
+    :param points: list of tuples, (y, x) pixel coordinates or (lat, lon) if <latlon>
+    :param latlon: bool
+    :return: numpy arrays, int rows and columns of points and bool mask of points inside of the grid
+    """
+    points = np.array(points, dtype=np.float64).reshape(-1, 2)
+    if latlon:
+        cols, rows = n.transform_points(points[:, 1], points[:, 0], DstToSrc=1)
+        rows, cols = np.floor(rows), np.floor(cols)
+    else:
+        rows, cols = points[:, 0], points[:, 1]
+
+    height, width = n.shape()
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    rows = np.where(inside, rows, 0).astype(int)
+    cols = np.where(inside, cols, 0).astype(int)
+    return rows, cols, inside
+
+
+def extract_points(n, points, wavelengths, latlon=False, depth=None, r_type='Rrs_', source=None):
+    """
+    Values of <wavelengths> bands in <points>. Each band is read only once.
+    :param n: <nansat.nansat.Nansat> object
+    :param points: list of tuples, (y, x) or (lat, lon) if <latlon>
+    :param wavelengths: list
+    :param latlon: bool
+    :param depth: numpy array, bathymetry on the grid of <n> or None
+    :param r_type: str, prefix of reflectance bands in <n>
+    :param source: str, name of file which is written to each row
+    :return: list of dicts, one row per point inside of the grid with <Rrs_*>, <Rrsw_*> and <depth>
+    """
+    rows, cols, inside = point_pixels(n, points, latlon=latlon)
+
+    values = {}
+    for wavelength in wavelengths:
+        rrs = n[r_type + str(wavelength)][rows, cols].astype(np.float64)
+        values['Rrs_%s' % wavelength] = rrs
+        values['Rrsw_%s' % wavelength] = rrs_to_rrsw(rrs)
+    if depth is not None:
+        values['depth'] = np.asarray(depth)[rows, cols].astype(np.float64)
+
+    table = []
+    for i in np.where(inside)[0]:
+        row = {'file': source, 'point': int(i), 'y': int(rows[i]), 'x': int(cols[i])}
+        if latlon:
+            row['lat'], row['lon'] = points[i]
+        for name in values:
+            row[name] = float(values[name][i])
+        table.append(row)
+    return table
+
+
+def extract(files, points, wavelengths, latlon=False, depth=None, r_type='Rrs_'):
+    """
+    Extraction of the same points from several scenes. Each file is opened once.
+    :param files: list, paths to files (e.g. fused or reprojected MODIS scenes on one domain)
+    :param points: list of tuples, (y, x) or (lat, lon) if <latlon>
+    :param wavelengths: list
+    :param latlon: bool
+    :param depth: numpy array, bathymetry on the grid of the files or None
+    :param r_type: str, prefix of reflectance bands
+    :return: list of dicts, rows of all files
+    """
+    from nansat import Nansat
+
+    table = []
+    for ifile in files:
+        table += extract_points(Nansat(ifile), points, wavelengths, latlon=latlon, depth=depth,
+                                r_type=r_type, source=ifile)
+    return table
+
+
+def spectra(table, wavelengths, r_type='Rrsw_'):
+    """
+    :param table: list of dicts, result of <extract>
+    :param wavelengths: list
+    :param r_type: str, 'Rrsw_' or 'Rrs_'
+    :return: numpy array, (rows, bands)
+    """
+    return np.array([[row[r_type + str(wavelength)] for wavelength in wavelengths] for row in table],
+                    dtype=np.float64).reshape(len(table), len(wavelengths))
+
+
+def write_csv(table, ofile):
+    """
+    :param table: list of dicts
+    :param ofile: str, path to csv file
+    """
+    names = set()
+    for row in table:
+        names.update(row)
+    first = [name for name in ('file', 'point', 'y', 'x', 'lat', 'lon', 'depth') if name in names]
+    columns = first + sorted(names - set(first))
+
+    with open(ofile, 'wb') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(table)
@@ -0,0 +1,247 @@
+import os
+import copy
+import pickle
+
+import numpy as np
+
+from utils import digest, atomic_path
+
+# Hidden layers of fusion network
+NN_STRUCTURE = (10, 7)
+
+
+def cell_means(hires, index, lores=None, min_pixels=1):
+    """
+    Average hires spectra (and lores values) inside each low resolution pixel
+    :param hires: numpy array, hires cube (bands, rows, cols)
+    :param index: numpy array, numbers of low resolution pixels on the same grid
+    :param lores: numpy array, low resolution bands (bands, rows, cols) on the same grid
+    :param min_pixels: int, minimal number of valid hires pixels in a low resolution pixel
+    :return: numpy arrays, numbers of low resolution pixels, features (cells, hires bands)
+    and targets (cells, lores bands) or None
+    """
+    valid = np.isfinite(hires).all(axis=0)
+    if lores is not None:
+        valid &= np.isfinite(lores).all(axis=0)
+
+    cells, inverse, counts = np.unique(index[valid], return_inverse=True, return_counts=True)
+    keep = counts >= min_pixels
+
+    features = np.empty((cells.size, hires.shape[0]), dtype=np.float64)
+    for band in range(hires.shape[0]):
+        features[:, band] = np.bincount(inverse, weights=hires[band][valid], minlength=cells.size) / counts
+
+    targets = None
+    if lores is not None:
+        targets = np.empty((cells.size, lores.shape[0]), dtype=np.float64)
+        for band in range(lores.shape[0]):
+            targets[:, band] = np.bincount(inverse, weights=lores[band][valid], minlength=cells.size) / counts
+        targets = targets[keep]
+
+    return cells[keep], features[keep], targets
+
+
+def compare_fused(fused, reference):
+    """
+    Agreement of fused bands of two fusion methods (e.g. <FusionNetwork> and <fuse> of ovl_plugins)
+    :param fused: numpy array, fused band (rows, cols)
+    :param reference: numpy array, the same band fused by the reference method
+    :return: dict, number of pixels valid in both, RMSE, RMSE normalized by std of <reference>, bias
+    and correlation
+    """
+    valid = np.isfinite(fused) & np.isfinite(reference)
+    if not valid.any():
+        return {'pixels': 0, 'rmse': np.nan, 'nrmse': np.nan, 'bias': np.nan, 'r': np.nan}
+
+    difference = fused[valid].astype(np.float64) - reference[valid]
+    rmse = np.sqrt(np.mean(difference ** 2))
+    std = reference[valid].std()
+    r = np.corrcoef(fused[valid], reference[valid])[0, 1] if valid.sum() > 1 else np.nan
+    return {'pixels': int(valid.sum()), 'rmse': rmse, 'nrmse': rmse / std if std > 0 else np.nan,
+            'bias': difference.mean(), 'r': r}
+
+
+class FusionNetwork:
+    """
+    Neural network which maps hires spectra averaged over low resolution pixels onto low resolution
+    values (one or several bands) and is applied to each hires pixel. Training can be continued on
+    a new scene (warm start). It is not the network of <fuse> of ovl_plugins, use
+    <michigan.fusion.Fusion.check_network> to compare both on a reference scene.
+    """
+
+    def __init__(self, nn_structure=NN_STRUCTURE, random_state=0):
+        """
+        :param nn_structure: tuple, sizes of hidden layers
+        :param random_state: int
+        """
+        from sklearn.neural_network import MLPRegressor
+
+        self.nn_structure = tuple(nn_structure)
+        self.model = MLPRegressor(hidden_layer_sizes=self.nn_structure, random_state=random_state)
+        # Total number of training iterations (epochs) over all scenes
+        self.iterations = 0
+        # Normalization is computed on the first scene and kept for warm start
+        self.x_mean = self.x_std = self.y_mean = self.y_std = None
+        # Number of predicted low resolution bands, known from the first <train> call even without valid cells
+        self.n_outputs = None
+
+    def _normalize(self, features, targets=None):
+        if self.x_mean is None:
+            self.x_mean, self.x_std = features.mean(axis=0), features.std(axis=0) + 1e-12
+            self.y_mean, self.y_std = targets.mean(axis=0), targets.std(axis=0) + 1e-12
+
+        x = (features - self.x_mean) / self.x_std
+        if targets is None:
+            return x
+        return x, (targets - self.y_mean) / self.y_std
+
+    def train(self, features, targets, iterations=20):
+        """
+        :param features: numpy array, (cells, hires bands)
+        :param targets: numpy array, (cells, lores bands)
+        :param iterations: int, number of passes over the training data
+        """
+        self.n_outputs = targets.shape[1]
+        # A scene without valid cells (e.g. clouds over the whole domain) is skipped
+        if features.shape[0] == 0:
+            return
+
+        x, y = self._normalize(features, targets)
+        if y.shape[1] == 1:
+            y = y.ravel()
+
+        for i in range(iterations):
+            self.model.partial_fit(x, y)
+            self.iterations += 1
+
+    def train_adaptive(self, features, targets, max_iterations=50, tol=0.01, patience=2, validation=0.2,
+                       random_state=0):
+        """
+        Train until validation error stops improving. A random part of low resolution pixels is held out,
+        the network with the best validation error is kept.
+        :param features: numpy array, (cells, hires bands)
+        :param targets: numpy array, (cells, lores bands)
+        :param max_iterations: int, max number of passes over the training data
+        :param tol: float, minimal relative improvement of validation RMSE
+        :param patience: int, number of iterations without improvement before stop
+        :param validation: float, part of cells held out for validation
+        :param random_state: int
+        :return: dict, iterations of the kept (best) network, number of trained iterations and
+        validation RMSE of the kept network
+        """
+        self.n_outputs = targets.shape[1]
+        if features.shape[0] == 0:
+            return {'iterations': 0, 'best_iteration': 0, 'trained_iterations': 0, 'rmse': np.nan}
+
+        holdout = np.random.RandomState(random_state).rand(features.shape[0]) < validation
+        if holdout.all() or not holdout.any():
+            self.train(features, targets, iterations=max_iterations)
+            return {'iterations': max_iterations, 'best_iteration': max_iterations,
+                    'trained_iterations': max_iterations, 'rmse': np.nan}
+
+        x, y = self._normalize(features, targets)
+        if y.shape[1] == 1:
+            y = y.ravel()
+
+        start = self.iterations
+        best_rmse = np.inf
+        best_model = self.model
+        best_iteration = 0
+        stall = 0
+        used = 0
+        for i in range(max_iterations):
+            self.model.partial_fit(x[~holdout], y[~holdout])
+            self.iterations += 1
+            used += 1
+
+            rmse = np.sqrt(np.mean((self.predict_features(features[holdout]) - targets[holdout]) ** 2))
+            if rmse < best_rmse * (1 - tol):
+                best_rmse, best_model, best_iteration = rmse, copy.deepcopy(self.model), used
+                stall = 0
+            else:
+                stall += 1
+                if stall >= patience:
+                    break
+
+        # Iterations after the best one are dropped with their model
+        self.model = best_model
+        self.iterations = start + best_iteration
+        return {'iterations': best_iteration, 'best_iteration': best_iteration, 'trained_iterations': used,
+                'rmse': best_rmse}
+
+    def predict_features(self, features):
+        """
+        :param features: numpy array, (samples, hires bands)
+        :return: numpy array, (samples, lores bands), nan if the network is not trained
+        """
+        if self.x_mean is None or features.shape[0] == 0:
+            n_outputs = self.n_outputs if self.y_mean is None else self.y_mean.size
+            prediction = np.empty((features.shape[0], n_outputs))
+            prediction.fill(np.nan)
+            return prediction
+
+        prediction = self.model.predict(self._normalize(features)).reshape(features.shape[0], -1)
+        return prediction * self.y_std + self.y_mean
+
+    def predict(self, hires):
+        """
+        :param hires: numpy array, hires cube (bands, rows, cols)
+        :return: numpy array, float32 fused bands (lores bands, rows, cols), nan where hires is not valid
+        or everywhere if the network is not trained
+        """
+        valid = np.isfinite(hires).all(axis=0)
+        prediction = self.predict_features(hires[:, valid].T)
+
+        fused = np.empty((prediction.shape[1],) + hires.shape[1:], dtype=np.float32)
+        fused.fill(np.nan)
+        fused[:, valid] = prediction.T
+        return fused
+
+
+class ModelStore:
+    """
+    Directory with trained fusion networks keyed by bands, hires wavelengths and network structure
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str, directory for pickled networks
+        """
+        self.path = path
+
+    @staticmethod
+    def key(bands, hires_bands, nn_structure, *options):
+        """
+        :param bands: list, names of low resolution bands which are predicted by the network
+        :param hires_bands: list, wavelengths of hires bands
+        :param nn_structure: tuple, sizes of hidden layers
+        :param options: any other parameters of hires preparation (e.g. log)
+        :return: str
+        """
+        return digest(tuple(bands), tuple(hires_bands), tuple(nn_structure), options)
+
+    def _path(self, key):
+        return os.path.join(self.path, 'network_%s.pkl' % key)
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: <FusionNetwork> object or None
+        """
+        if not os.path.exists(self._path(key)):
+            return None
+
+        with open(self._path(key), 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, key, network):
+        """
+        :param key: str
+        :param network: <FusionNetwork> object
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        with atomic_path(self._path(key)) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(network, f, protocol=2)
@@ -1,9 +1,74 @@
-from nansat import Nansat
+import os
+import tempfile
+from multiprocessing import Pool
+
 import numpy as np
-from scipy.ndimage.filters import gaussian_filter
 
-from ovl_plugins.fusion.fusion import fuse
 from dataprep import Data
+from export import NCExport, BAND_SETS
+from fusenet import FusionNetwork, ModelStore, NN_STRUCTURE, cell_means, compare_fused
+from utils import on_domain, domain_key, digest, atomic_path, pool_processes
+from instrument import stage, scene_name
+
+
+# Window size (sigma) of Gaussian smoothing of hires data
+SMOOTH_WS = 1
+
+
+def smooth_hires(hires_arr, negpix, ws=SMOOTH_WS):
+    """
+    :param hires_arr: numpy array, hires cube (bands, rows, cols)
+    :param negpix: numpy array, bool mask of pixels with negative low resolution values
+    :param ws: int, sigma of Gaussian filter
+    :return: numpy array
+    """
+    from scipy.ndimage.filters import gaussian_filter
+
+    hires_arr[:, negpix] = np.nan
+    # band by band smoothing needs memory only for one band
+    for band in hires_arr:
+        band[...] = gaussian_filter(band, ws)
+    return hires_arr
+
+
+def fuse_tile(args):
+    """
+    Worker of <Fusion.fusion_tiled>: fuse all bands inside one tile (with halo)
+    :param args: tuple, see <Fusion.fusion_tiled>
+    :return: tuple, core window of the tile (y0, y1, x0, x1) and fused float32 array (bands, rows, cols)
+    """
+    from ovl_plugins.fusion.fusion import fuse
+
+    (store, n_hires, lores_store, window, core, index_tile, negpix_tile, bands, smooth, log, iterations,
+     threads) = args
+    y0, y1, x0, x1 = window
+    hires = np.array(np.load(store, mmap_mode='r')[:n_hires, y0:y1, x0:x1])
+    lores_tiles = np.array(np.load(lores_store, mmap_mode='r')[:, y0:y1, x0:x1])
+
+    # The same order as in <Fusion.__init__>: smoothing, then log
+    if smooth:
+        hires = smooth_hires(hires, negpix_tile)
+
+    if log:
+        hires += 1
+        np.log10(hires, out=hires)
+
+    # core of the tile inside of the tile with halo
+    cy0, cy1, cx0, cx1 = core[0] - y0, core[1] - y0, core[2] - x0, core[3] - x0
+    fused = np.empty((len(bands), cy1 - cy0, cx1 - cx0), dtype=np.float32)
+    fused.fill(np.nan)
+
+    if not np.isfinite(hires).any():
+        return core, fused
+
+    for i, band in enumerate(bands):
+        if not np.isfinite(lores_tiles[i]).any():
+            continue
+        hires_fused = fuse(hires, lores_tiles[i], network_name=band, iterations=iterations, threads=threads,
+                           index=index_tile)
+        fused[i] = hires_fused[cy0:cy1, cx0:cx1]
+
+    return core, fused
 
 
 class Fusion(Data):
@@ -18,8 +83,11 @@ class Fusion(Data):
 
     cutsize = 2000
 
+    # <bottom_cache> keeps depth fields for each domain and bathymetry file. It is shared by all objects of the process
+    bottom_cache = {}
+
     def __init__(self, m_file, s_file, domain=None, smooth=False, skip=True, log=False, mask=True, cut=True,
-                 negative_px=True, h_mask=9999, prepare_m=False, prepare_s=False):
+                 negative_px=True, h_mask=9999, prepare_m=False, prepare_s=False, tiled=False, tile_dir=None):
         """
         :param s_file: str, path to Sentinel-2 file of <hiresfile>
         :param m_file: str, path to MODISa file or <loresfile>
@@ -28,24 +96,33 @@ class Fusion(Data):
         :param log: bool
         :param mask: bool
         :param cut: bool
+        :param tiled: bool, keep the full hires cube in a memory-mapped store for <fusion_tiled> instead of
+        cropping it. Smoothing and log are applied later to each tile
+        :param tile_dir: str, directory for the memory-mapped store. Default is <CACHE_PATH>
         """
+        from nansat import Nansat
 
         if not domain:
             self.domain = self.sbd_dom
+        else:
+            self.domain = domain
 
         self.m_file = m_file
 
         if prepare_m:
-            Data.__init__(self, m_file)
+            Data.__init__(self, m_file, self.domain)
             self.loresfile = self.modis_geo_location()
         else:
             self.loresfile = Nansat(m_file)
 
         # Open inputted files by Nansat
         # Load low resolution file - MODISa
-        self.loresfile.reproject(self.domain)
+        # Files made by <modis_geo_location> are already on the domain and don't need one more warp
+        if not on_domain(self.loresfile, self.domain):
+            self.loresfile.reproject(self.domain)
         if negative_px:
-            self.negpix = self.loresfile[2] < 0
+            # out-of-swath pixels are NaN in files made with the swath lookup
+            self.negpix = np.logical_not(self.loresfile[2] >= 0)
 
         self.index = self.loresfile['index']
 
@@ -54,48 +131,105 @@ class Fusion(Data):
         self.s_file = s_file
 
         if prepare_s:
-            Data.__init__(self, s_file)
+            Data.__init__(self, s_file, self.domain)
             hiresfile = self.s2_downscale()
         else:
             hiresfile = Nansat(s_file)
 
-        hiresfile.reproject(self.domain)
+        if not on_domain(hiresfile, self.domain):
+            hiresfile.reproject(self.domain)
 
         # Get numbers of of each band
         band_rrs_numbers = [hiresfile._get_band_number('Rrs_%s' % wavelength)
                             for wavelength in sorted(self.wavelengths['sentinel2'].values())]
-        # Create array form
-        hires_np_array = np.array([hiresfile[i] for i in band_rrs_numbers])
-        # remove out-of-swath
-        hires_np_array[:, hires_np_array[0] == 0] = np.nan
+        # Only the first 5 bands are used for fusion if <skip>, other bands are not loaded
+        n_bands = 5 if skip else len(band_rrs_numbers)
+        shape = (n_bands,) + tuple(self.domain.shape())
+        # Wavelengths of hires bands and their transformation identify trained fusion networks
+        self.hires_bands = sorted(self.wavelengths['sentinel2'].values())[:n_bands]
+        self.log = log
+
+        # Memory-mapped stores of tiled fusion, they are removed by <close>
+        self.stores = []
+        if tiled:
+            # The cube is filled band by band into memory-mapped store, it is never loaded into RAM as a whole
+            self.hires_store = self.create_store(tile_dir, shape)
+            hires_np_array = np.load(self.hires_store, mmap_mode='r+')
+        else:
+            hires_np_array = np.empty(shape, dtype=np.float32)
 
-        self.cut = cut
+        try:
+            with stage('load', scene=scene_name(s_file), bands=n_bands):
+                for i in range(n_bands):
+                    hires_np_array[i] = hiresfile[band_rrs_numbers[i]]
 
-        if mask:
-            hires_np_array = self.mask(hires_np_array, h_mask)
+            with stage('masking', scene=scene_name(s_file)):
+                # All mask criteria are combined into one plane and applied by one pass
+                # remove out-of-swath
+                bad_pixels = hires_np_array[0] == 0
 
-        if smooth and negative_px:
-            hires_np_array = self.smooth(hires_np_array)
+                if mask:
+                    if n_bands > 7:
+                        band7 = hires_np_array[7]
+                    else:
+                        band7 = hiresfile[band_rrs_numbers[7]]
+                    bad_pixels |= self.mask_plane(hires_np_array[0], band7, h_mask)
 
-        if skip:
-            hires_np_array = hires_np_array[0:5]
+                hires_np_array[:, bad_pixels] = np.nan
 
-        if log:
-            for hrn in range(len(hires_np_array)):
-                hires_np_array[hrn] = np.log10(hires_np_array[hrn] + 1)
+            self.cut = cut and not tiled
+            self.smooth_tiles = tiled and smooth and negative_px
+            self.log_tiles = tiled and log
 
-        if self.cut:
-            hires_np_array, self.negpix, self.index = self.crop(hires_np_array)
+            if smooth and negative_px and not tiled:
+                hires_np_array = self.smooth(hires_np_array)
+
+            if log and not tiled:
+                hires_np_array += 1
+                np.log10(hires_np_array, out=hires_np_array)
+
+            if self.cut:
+                hires_np_array, self.negpix, self.index = self.crop(hires_np_array)
+
+            if tiled:
+                hires_np_array.flush()
+        except Exception:
+            self.close()
+            raise
 
         self.hires = hires_np_array
 
     def get_bottom(self, bathymetry_path=BATHYMETRY_PATH):
-        bathymetry = Nansat(bathymetry_path)
-        bathymetry.reproject(self.domain)
-        # preparing of bottom field
-        h = bathymetry[1]
-        # all points there h >= 0 will marked as np.nan
-        h = np.where(h >= 0, np.nan, np.float32(h) * -1)
+        """
+        Depth field on <self.domain>. It is reprojected only once per domain and bathymetry file,
+        kept in memory for the process and on disk in <CACHE_PATH> as a memory-mappable float32 array
+        :param bathymetry_path: str
+        :return: numpy array, read-only float32 array of depth (m), land is np.nan
+        """
+        from nansat import Nansat
+
+        key = digest(os.path.abspath(bathymetry_path), os.path.getmtime(bathymetry_path), domain_key(self.domain))
+        h = self.bottom_cache.get(key)
+
+        if h is None:
+            cache_file = os.path.join(self.CACHE_PATH, 'bottom_%s.npy' % key)
+
+            if not os.path.exists(cache_file):
+                bathymetry = Nansat(bathymetry_path)
+                bathymetry.reproject(self.domain)
+                # preparing of bottom field
+                h = bathymetry[1]
+                # all points there h >= 0 will marked as np.nan
+                h = np.where(h >= 0, np.nan, np.float32(h) * -1).astype(np.float32)
+
+                if not os.path.isdir(self.CACHE_PATH):
+                    os.makedirs(self.CACHE_PATH)
+                with atomic_path(cache_file, '.tmp.npy') as tmp_file:
+                    np.save(tmp_file, h)
+
+            h = np.load(cache_file, mmap_mode='r')
+            self.bottom_cache[key] = h
+
         return h
 
     def get_land_mask(self, bathymetry_path=BATHYMETRY_PATH):
@@ -105,33 +239,216 @@ class Fusion(Data):
         return land_mask
 
     def get_h_mask(self, h_max, h_min=None, bathymetry_path=BATHYMETRY_PATH, mask_val=np.nan):
-        h_mask = self.get_bottom(bathymetry_path=bathymetry_path)
-        h_mask[h_mask > h_max] = mask_val
+        h = self.get_bottom(bathymetry_path=bathymetry_path)
+        h_mask = np.array(h)
+        h_mask[h > h_max] = mask_val
 
         if h_min is not None:
-            h_mask[h_mask < h_min] = mask_val
+            h_mask[h < h_min] = mask_val
 
         return h_mask
 
     def smooth(self, hires_arr):
-        ws = 1
-        hires_arr[:, self.negpix] = np.nan
-        hires_arr = gaussian_filter(hires_arr, (0, ws, ws))
-        return hires_arr
+        return smooth_hires(hires_arr, self.negpix)
 
     def mask(self, hires_arr, h_mask):
+        hires_arr[:, self.mask_plane(hires_arr[0], hires_arr[7], h_mask)] = np.nan
+        return hires_arr
+
+    def mask_plane(self, band0, band7, h_mask):
+        """
+        :param band0: numpy array, first band of hires cube
+        :param band7: numpy array, eighth band of hires cube (clouds)
+        :param h_mask: int, max depth. With 9999 only land (by bathymetry) is masked
+        :return: numpy array, bool plane of pixels which should be masked (land, deep water, clouds)
+        """
+        from scipy.ndimage.filters import gaussian_filter
+
         watter_mask = self.loresfile.watermask()[1]
         watter_mask_filtered = gaussian_filter(watter_mask.astype(np.float32), 1)
-        hires_arr[:, watter_mask_filtered > 1] = np.nan
-        if h_mask is not 9999:
-            hm = self.get_h_mask(h_mask)
-            # return hm
-            hires_arr[:, np.isnan(hm) == True] = np.nan
+        plane = watter_mask_filtered > 1
+        # Land of the bathymetry is masked for any <h_mask>
+        plane |= np.isnan(self.get_h_mask(h_mask))
 
         # mask clouds
-        hires_arr[:, hires_arr[7] > self.bMax] = np.nan
-        hires_arr[:, hires_arr[0] < self.bMin] = np.nan
-        return hires_arr
+        plane |= band7 > self.bMax
+        plane |= band0 < self.bMin
+        return plane
+
+    def create_store(self, tile_dir, shape, prefix='hires_', dtype=np.float32):
+        """
+        :param tile_dir: str, directory for the store. Default is <CACHE_PATH>
+        :param shape: tuple, shape of the cube
+        :param prefix: str, prefix of the file name
+        :param dtype: numpy dtype of the cube
+        :return: str, path to .npy file which can be memory-mapped. It is removed by <close>
+        """
+        tile_dir = tile_dir or self.CACHE_PATH
+        if not os.path.isdir(tile_dir):
+            os.makedirs(tile_dir)
+
+        fd, store = tempfile.mkstemp(suffix='.npy', prefix=prefix, dir=tile_dir)
+        os.close(fd)
+        self.stores.append(store)
+        np.lib.format.open_memmap(store, mode='w+', dtype=dtype, shape=shape)
+        return store
+
+    def share(self, m_wavelengths='full', tile_dir=None):
+        """
+        Move the hires cube, the low resolution bands and the index into memory-mapped stores, so worker
+        processes of <michigan.scheduler.FusionScheduler> map them instead of getting pickled copies.
+        <self.hires> becomes a copy-on-write view of its store, the in-memory cube is released
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :param tile_dir: str, directory for the stores. Default is <CACHE_PATH>
+        :return: list of band names, <michigan.export.NCExport> object with low resolution bands (backed by
+        the store) and tuple of paths to the hires, low resolution, index and fused stores. The stores are
+        removed by <close>
+        """
+        if getattr(self, 'hires_store', None) is not None:
+            raise ValueError('Shared stores are made of the full hires cube, use fusion_tiled with tiled=True')
+
+        bands, lores_arrays, n_lores = self.lores_bands(m_wavelengths)
+        shape = self.hires.shape[1:]
+
+        hires_store = self.create_store(tile_dir, self.hires.shape, prefix='hires_')
+        hires_arr = np.load(hires_store, mmap_mode='r+')
+        for i, band in enumerate(self.hires):
+            hires_arr[i] = band
+        hires_arr.flush()
+        del hires_arr
+        self.hires = np.load(hires_store, mmap_mode='c')
+
+        index_store = self.create_store(tile_dir, shape, prefix='index_', dtype=np.int32)
+        index_arr = np.load(index_store, mmap_mode='r+')
+        index_arr[:] = self.index
+        index_arr.flush()
+
+        # Bands of <n_lores> are views of the store as in <fusion_tiled>
+        lores_store = self.create_store(tile_dir, (len(bands),) + shape, prefix='lores_')
+        lores_arr = np.load(lores_store, mmap_mode='r+')
+        n_lores = NCExport(self.domain)
+        for i, (band, lores) in enumerate(zip(bands, lores_arrays)):
+            lores_arr[i] = lores
+            n_lores.add_band(lores_arr[i], parameters={'name': band})
+        lores_arr.flush()
+
+        fused_store = self.create_store(tile_dir, (len(bands),) + shape, prefix='fused_')
+        self.shared = (hires_store, lores_store, index_store, fused_store)
+        return bands, n_lores, self.shared
+
+    def close(self):
+        """
+        Remove the memory-mapped stores of the hires cube and of <fusion_tiled> results
+        """
+        if getattr(self, 'hires_store', None) is not None or getattr(self, 'shared', None) is not None:
+            self.hires = None
+            self.shared = None
+        for store in getattr(self, 'stores', []):
+            if os.path.exists(store):
+                os.remove(store)
+        self.stores = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tile_halo(self):
+        """
+        :return: int, overlap of tiles in pixels. It covers the Gaussian smoothing window and
+        one low resolution pixel, so every low resolution pixel inside of a tile core is complete
+        """
+        smooth_radius = int(4.0 * SMOOTH_WS + 0.5)
+        lores_pixel = int(np.ceil(np.sqrt(self.index.size / float(np.unique(self.index).size))))
+        return smooth_radius + lores_pixel
+
+    def fusion_tiled(self, m_wavelengths='full', tile_size=1000, halo=None, processes=1, iterations=20, threads=7,
+                     ofile=None):
+        """
+        Fusion over the full domain by overlapping tiles. Hires and low resolution tiles are read from
+        memory-mapped stores and fused tiles are written into a store, so only one tile per worker is kept
+        in RAM. Requires <tiled=True> in constructor, use it as a context manager to remove the stores:
+
+            with Fusion(m_file, s_file, tiled=True) as fusion:
+                fusion.fusion_tiled(ofile=ofile, processes=4)
+
+        A separate network is trained for each tile (on its core and halo), so the fused field is not
+        the same as of <fusion> over the full domain and can differ slightly at borders of tile cores
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :param tile_size: int, size of tile core in pixels
+        :param halo: int, overlap of tiles in pixels. Default is <tile_halo()>
+        :param processes: int, number of tiles fused in parallel. 1 is used inside of a daemonic process
+        (e.g. a worker of <michigan.batch>)
+        :param iterations: int, number of training iterations
+        :param threads: int, total number of threads of <fuse> calls, they are divided among <processes>
+        :param ofile: str, path for export of fused bands. If None nothing is exported
+        :return: <nansat.nansat.Nansat> objects with low resolution and fused bands. Their bands are backed
+        by the stores and are valid until <close>
+        """
+        if getattr(self, 'hires_store', None) is None:
+            raise ValueError('Tiled fusion requires Fusion(..., tiled=True)')
+
+        if halo is None:
+            halo = self.tile_halo()
+
+        processes = pool_processes(processes)
+        tile_threads = max(1, threads // processes)
+
+        bands = ['Rrs_%s' % wavelength for wavelength in self.wavelengths['modis'][m_wavelengths]]
+        rows, cols = self.domain.shape()
+        store_dir = os.path.dirname(self.hires_store)
+
+        # Low resolution bands are kept in a store as the hires cube, workers read only their tiles
+        lores_store = self.create_store(store_dir, (len(bands), rows, cols), prefix='lores_')
+        lores_arr = np.load(lores_store, mmap_mode='r+')
+        n_lores = NCExport(self.domain)
+        for i, band in enumerate(bands):
+            lores = self.loresfile[band]
+            lores[self.negpix] = np.nan
+            lores_arr[i] = lores
+            n_lores.add_band(lores_arr[i], parameters={'name': band})
+        lores_arr.flush()
+
+        tasks = []
+        for y in range(0, rows, tile_size):
+            for x in range(0, cols, tile_size):
+                core = (y, min(y + tile_size, rows), x, min(x + tile_size, cols))
+                y0, y1, x0, x1 = max(0, y - halo), min(rows, core[1] + halo), max(0, x - halo), min(cols, core[3] + halo)
+                tasks.append((self.hires_store, len(self.hires), lores_store, (y0, y1, x0, x1), core,
+                              self.index[y0:y1, x0:x1], self.negpix[y0:y1, x0:x1],
+                              bands, self.smooth_tiles, self.log_tiles, iterations, tile_threads))
+
+        fused_store = self.create_store(store_dir, (len(bands), rows, cols), prefix='fused_')
+        fused_arr = np.load(fused_store, mmap_mode='r+')
+
+        if processes > 1:
+            pool = Pool(processes)
+            results = pool.imap_unordered(fuse_tile, tasks)
+        else:
+            pool = None
+            results = (fuse_tile(task) for task in tasks)
+
+        try:
+            # Results are written into the output grid as soon as each tile is ready
+            for core, fused in results:
+                fused_arr[:, core[0]:core[1], core[2]:core[3]] = fused
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        fused_arr.flush()
+
+        # Bands are views of the store, the export reads them from disk block by block
+        n_hires = NCExport(self.domain, bands=BAND_SETS['fusion'])
+        for i, band in enumerate(bands):
+            n_hires.add_band(fused_arr[i], parameters={'name': band})
+
+        if ofile is not None:
+            n_hires.export(ofile)
+
+        return n_lores.n, n_hires.n
 
     def crop(self, hires_arr):
         hires_arr = hires_arr[:, :self.cutsize, :self.cutsize]
@@ -139,11 +456,82 @@ class Fusion(Data):
         index = self.index[:self.cutsize, :self.cutsize]
         return hires_arr, negpix, index
 
-    def fusion(self, m_wavelengths='full'):
+    def fusion(self, m_wavelengths='full', ofile=None, model_store=None, mode='train', multi_output=False,
+               nn_structure=NN_STRUCTURE, iterations=20, adaptive=False, tol=0.01, cores=None, threads=7,
+               tile_dir=None):
+        """
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :param ofile: str, path for export of fused bands. If None nothing is exported
+        :param cores: int, total core budget of <fuse> calls. If given, bands are fused in parallel by
+        <michigan.scheduler.FusionScheduler> and the returned bands are backed by stores which are valid
+        until <close>. None fuses bands one after another in this process
+        :param threads: int, threads of each <fuse> call
+        :param tile_dir: str, directory for the stores of <cores>. Default is <CACHE_PATH>
+        :param model_store: <michigan.fusenet.ModelStore> object. If given (or if <multi_output>)
+        <michigan.fusenet.FusionNetwork> is used instead of <fuse>, see <check_network> for their agreement
+        :param mode: str, 'train' - train a new network, 'warm' - continue training of the stored network,
+        'apply' - only apply the stored network
+        :param multi_output: bool, train one network for all MODIS bands (uses <FusionNetwork>, see <check_network>)
+        :param nn_structure: tuple, sizes of hidden layers of <FusionNetwork>
+        :param iterations: int, number of training iterations (max number if <adaptive>)
+        :param adaptive: bool, stop training when validation error stops improving (uses <FusionNetwork>, see
+        <check_network>). Used iterations and validation RMSE of each band are saved in <self.fusion_report>
+        :param tol: float, minimal relative improvement of validation RMSE for <adaptive>
+        :return: <nansat.nansat.Nansat> objects with low resolution and fused bands
+        """
+        self.fusion_report = {}
+        use_fuse = model_store is None and not multi_output and not adaptive
+
+        if use_fuse and cores is not None:
+            from scheduler import FusionScheduler
+
+            scheduler = FusionScheduler(cores=cores, threads=threads, iterations=iterations, tile_dir=tile_dir)
+            scheduler.add_scene(self, m_wavelengths)
+            with stage('fuse', scene=scene_name(self.m_file), cores=cores, iterations=iterations):
+                return scheduler.run(ofiles=[ofile])[0]
+
+        bands, lores_arrays, n_lores = self.lores_bands(m_wavelengths)
+        n_hires = NCExport(self.domain, bands=BAND_SETS['fusion'])
+
+        if use_fuse:
+            from ovl_plugins.fusion.fusion import fuse
+
+            for band, lores in zip(bands, lores_arrays):
+                # hires_fused = fuse(hires, lores, network_name=rgb_band,
+                # iterations=100, threads=7, nn_structure=[5, 10, 7, 3])
+                # TODO: We should use less number of iterations: 15 - 16
+                with stage('fuse', scene=scene_name(self.m_file), band=band, iterations=iterations):
+                    hires_fused = fuse(self.hires, lores, network_name=band, iterations=iterations, threads=threads,
+                                       index=self.index)
+                n_hires.add_band(hires_fused, parameters={'name': band})
+        else:
+            # One network for all bands or one network per band
+            groups = [range(len(bands))] if multi_output else [[i] for i in range(len(bands))]
+            for group in groups:
+                group_bands = [bands[i] for i in group]
+                with stage('fuse', scene=scene_name(self.m_file), band=','.join(group_bands),
+                           iterations=iterations):
+                    fused = self.fuse_network(group_bands, np.array([lores_arrays[i] for i in group]),
+                                              model_store=model_store, mode=mode, nn_structure=nn_structure,
+                                              iterations=iterations, adaptive=adaptive, tol=tol)
+                for i, hires_fused in zip(group, fused):
+                    n_hires.add_band(hires_fused, parameters={'name': bands[i]})
+
+        if ofile is not None:
+            n_hires.export(ofile)
+
+        return n_lores.n, n_hires.n
+
+    def lores_bands(self, m_wavelengths='full'):
+        """
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :return: list of band names, list of low resolution arrays on the grid of <self.hires>
+        and <michigan.export.NCExport> object with these bands
+        """
         bands = ['Rrs_%s' % wavelength for wavelength in self.wavelengths['modis'][m_wavelengths]]
-        n_hires = Nansat(domain=self.domain)
-        n_lores = Nansat(domain=self.domain)
+        n_lores = NCExport(self.domain)
 
+        lores_arrays = []
         for band in bands:
             lores = self.loresfile[band]
 
@@ -153,10 +541,92 @@ class Fusion(Data):
             lores[self.negpix] = np.nan
 
             n_lores.add_band(lores, parameters={'name': band})
-            # hires_fused = fuse(hires, lores, network_name=rgb_band,
-            # iterations=100, threads=7, nn_structure=[5, 10, 7, 3])
-            # TODO: We should use less number of iterations: 15 - 16
-            hires_fused = fuse(self.hires, lores, network_name=band, iterations=20, threads=7, index=self.index)
-            n_hires.add_band(hires_fused, parameters={'name': band})
+            lores_arrays.append(lores)
+
+        return bands, lores_arrays, n_lores
 
-        return n_lores, n_hires
+    def fuse_network(self, bands, lores, model_store=None, mode='train', nn_structure=NN_STRUCTURE, iterations=20,
+                     adaptive=False, tol=0.01):
+        """
+        :param bands: list, names of low resolution bands
+        :param lores: numpy array, low resolution bands (bands, rows, cols) on the grid of <self.hires>
+        :param model_store: <michigan.fusenet.ModelStore> object or None
+        :param mode: str, 'train', 'warm' or 'apply' (see <fusion>)
+        :param nn_structure: tuple, sizes of hidden layers
+        :param iterations: int, number of training iterations (max number if <adaptive>)
+        :param adaptive: bool, stop training when validation error stops improving
+        :param tol: float, minimal relative improvement of validation RMSE
+        :return: numpy array, fused bands (bands, rows, cols)
+        """
+        key = ModelStore.key(bands, self.hires_bands, nn_structure, self.log)
+        network = None
+        if model_store is not None and mode != 'train':
+            network = model_store.get(key)
+
+        if network is None:
+            if mode == 'apply':
+                raise ValueError('There is no stored network for %s' % bands)
+            network = FusionNetwork(nn_structure)
+
+        if mode != 'apply':
+            cells, features, targets = cell_means(self.hires, self.index, lores)
+            if adaptive:
+                report = network.train_adaptive(features, targets, max_iterations=iterations, tol=tol)
+                print '%s: iterations: %d (of %d trained), validation RMSE: %f' % (
+                    ', '.join(bands), report['best_iteration'], report['trained_iterations'], report['rmse'])
+            else:
+                network.train(features, targets, iterations=iterations)
+                used = iterations if cells.size else 0
+                report = {'iterations': used, 'best_iteration': used, 'trained_iterations': used, 'rmse': np.nan}
+
+            for band in bands:
+                self.fusion_report[band] = report
+
+            # A network which is not trained yet (no valid cells) is not stored
+            if model_store is not None and network.x_mean is not None:
+                model_store.put(key, network)
+
+        return network.predict(self.hires)
+
+    def check_network(self, m_wavelengths='full', nn_structure=NN_STRUCTURE, iterations=20, max_nrmse=0.25,
+                      multi_output=False, adaptive=False, tol=0.01):
+        """
+        Compare <michigan.fusenet.FusionNetwork>, which <fusion> uses with <model_store>, <multi_output> or
+        <adaptive>, with <fuse> of ovl_plugins (the default path) on this scene. It should be done on
+        a reference scene before networks are persisted and warm-started. Results are also kept in
+        <self.network_check>
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :param nn_structure: tuple, sizes of hidden layers of <FusionNetwork>
+        :param iterations: int, number of training iterations of both networks (max number for <FusionNetwork>
+        if <adaptive>)
+        :param max_nrmse: float, max RMSE between outputs normalized by std of the <fuse> output
+        :param multi_output: bool, check one network for all bands as <fusion> with <multi_output>
+        :param adaptive: bool, check networks trained with early stopping as <fusion> with <adaptive>
+        :param tol: float, minimal relative improvement of validation RMSE for <adaptive>
+        :return: dict, band -> <michigan.fusenet.compare_fused> result
+        """
+        from ovl_plugins.fusion.fusion import fuse
+
+        self.fusion_report = {}
+        self.network_check = {}
+        bands, lores_arrays, n_lores = self.lores_bands(m_wavelengths)
+        # The same grouping of bands as in <fusion>
+        groups = [range(len(bands))] if multi_output else [[i] for i in range(len(bands))]
+        for group in groups:
+            group_bands = [bands[i] for i in group]
+            with stage('check_network', scene=scene_name(self.m_file), band=','.join(group_bands)):
+                fused = self.fuse_network(group_bands, np.array([lores_arrays[i] for i in group]),
+                                          nn_structure=nn_structure, iterations=iterations, adaptive=adaptive,
+                                          tol=tol)
+                for i, hires_fused in zip(group, fused):
+                    reference = fuse(self.hires, lores_arrays[i], network_name=bands[i], iterations=iterations,
+                                     threads=7, index=self.index)
+                    self.network_check[bands[i]] = compare_fused(hires_fused, reference)
+
+        # No comparable pixels (nan) is a failure too
+        failed = [band for band in bands if not self.network_check[band]['nrmse'] <= max_nrmse]
+        if failed:
+            raise ValueError('FusionNetwork differs from fuse for %s (normalized RMSE: %s)'
+                             % (', '.join(failed), ', '.join('%.3f' % self.network_check[band]['nrmse']
+                                                             for band in failed)))
+        return self.network_check
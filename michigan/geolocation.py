@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def domain_bbox(domain, margin=0.):
+    """
+    :param domain: <nansat.domain.Domain> object
+    :param margin: float, margin in degrees
+    :return: tuple, lon_min, lat_min, lon_max, lat_max
+    """
+    lon, lat = domain.get_corners()
+    return min(lon) - margin, min(lat) - margin, max(lon) + margin, max(lat) + margin
+
+
+def swath_window(latitude, longitude, bbox):
+    """
+    Smallest window of the swath which contains all pixels inside <bbox>
+    :param latitude: numpy array
+    :param longitude: numpy array
+    :param bbox: tuple, lon_min, lat_min, lon_max, lat_max
+    :return: tuple, y_offset, x_offset, y_size, x_size or None if the swath doesn't intersect <bbox>
+    """
+    lon_min, lat_min, lon_max, lat_max = bbox
+    inside = ((longitude >= lon_min) & (longitude <= lon_max) &
+              (latitude >= lat_min) & (latitude <= lat_max))
+    rows = np.flatnonzero(inside.any(axis=1))
+    cols = np.flatnonzero(inside.any(axis=0))
+
+    if rows.size == 0:
+        return None
+
+    return rows[0], cols[0], rows[-1] - rows[0] + 1, cols[-1] - cols[0] + 1
+
+
+def gcp_pixels(shape, gcp_count, latitude=None, longitude=None, bbox=None, density=1):
+    """
+    Rows and columns of swath pixels which are used as GCPs
+    :param shape: tuple, shape of the swath
+    :param gcp_count: int, number of GCPs along each dimension of the swath
+    :param latitude: numpy array, required if <bbox> is given
+    :param longitude: numpy array, required if <bbox> is given
+    :param bbox: tuple, lon_min, lat_min, lon_max, lat_max of the region with dense GCPs
+    :param density: int, GCPs inside <bbox> are <density> times denser along each dimension
+    :return: numpy arrays, rows and columns of GCPs
+    """
+    step0 = max(1, int(float(shape[0]) / gcp_count))
+    step1 = max(1, int(float(shape[1]) / gcp_count))
+    rows, cols = np.meshgrid(np.arange(0, shape[0], step0), np.arange(0, shape[1], step1), indexing='ij')
+    rows, cols = rows.ravel(), cols.ravel()
+
+    window = None
+    if bbox is not None and density > 1:
+        window = swath_window(latitude, longitude, bbox)
+
+    if window is not None:
+        y_off, x_off, y_size, x_size = window
+        dense_step0 = max(1, step0 // density)
+        dense_step1 = max(1, step1 // density)
+        dense_rows, dense_cols = np.meshgrid(np.arange(y_off, y_off + y_size, dense_step0),
+                                             np.arange(x_off, x_off + x_size, dense_step1),
+                                             indexing='ij')
+        # keep one GCP per pixel
+        pixels = np.union1d(rows * shape[1] + cols, dense_rows.ravel() * shape[1] + dense_cols.ravel())
+        rows, cols = pixels // shape[1], pixels % shape[1]
+
+    return rows, cols
+
+
+def make_gcps(latitude, longitude, gcp_count=40, bbox=None, density=1, dx=.5, dy=.5):
+    """
+    Vectorized generation of GCPs from lat/lon arrays of a swath
+    :param latitude: numpy array
+    :param longitude: numpy array
+    :param gcp_count: int, number of GCPs along each dimension of the swath
+    :param bbox: tuple, lon_min, lat_min, lon_max, lat_max of the region with dense GCPs
+    :param density: int, GCPs inside <bbox> are <density> times denser
+    :param dx: float, shift of GCP from pixel corner
+    :param dy: float, shift of GCP from line corner
+    :return: list of <gdal.GCP> objects, longitude and latitude of centre of GCPs
+    """
+    rows, cols = gcp_pixels(latitude.shape, gcp_count, latitude, longitude, bbox, density)
+    lon = longitude[rows, cols].astype(np.float64)
+    lat = latitude[rows, cols].astype(np.float64)
+    # NaN and fill values are rejected by the same comparisons
+    valid = (lon >= -180) & (lon <= 180) & (lat >= -90) & (lat <= 90)
+
+    if not valid.any():
+        raise ValueError('No valid GCPs in lat/lon arrays')
+
+    rows, cols, lon, lat = rows[valid], cols[valid], lon[valid], lat[valid]
+    import gdal
+    gcps = [gdal.GCP(x, y, 0, pixel, line)
+            for x, y, pixel, line in zip(lon.tolist(), lat.tolist(),
+                                         (cols + dx).tolist(), (rows + dy).tolist())]
+
+    return gcps, lon.mean(), lat.mean()
@@ -0,0 +1,317 @@
+"""
+Per-stage instrumentation: wall time, CPU time, peak RSS and bytes read/written of processing stages.
+
+Instrumentation is disabled by default and <stage> costs one attribute check then. It is enabled by
+<configure> or by environment variable <MICHIGAN_INSTRUMENT> (path to JSON-lines file):
+
+    with stage('fuse', scene=m_file, band='Rrs_412'):
+        ...
+
+Tags of outer stages (e.g. scene) are inherited by inner stages.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import threading
+from collections import Counter
+
+
+class JsonLinesSink:
+    """
+    Appends one JSON record per line to a file. Safe for several threads and processes (O_APPEND).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str, path to JSON-lines file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self.lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+
+
+class ListSink:
+    """
+    Keeps records in memory (e.g. for benchmarks or notebooks)
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread with a fixed interval and counts the innermost frames.
+    """
+
+    def __init__(self, thread_id, interval=0.01):
+        """
+        :param thread_id: int, identifier of the profiled thread
+        :param interval: float, sampling interval in seconds
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            code = frame.f_code
+            self.counts['%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno)] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, top=10):
+        """
+        :param top: int, number of reported frames
+        :return: dict, number of samples and the most frequent frames
+        """
+        self._stop.set()
+        self._thread.join()
+        return {'samples': self.samples, 'top': self.counts.most_common(top)}
+
+
+def io_counters():
+    """
+    :return: dict, bytes read and written by the process (/proc/self/io), empty if not available
+    """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (IOError, OSError):
+        pass
+    return counters
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def memory_mb():
+    """
+    :return: tuple, current and peak (since the last <reset_peak>) resident set size of the process, MB
+    """
+    status = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+                    name, value = line.split(':')
+                    status[name] = int(value.split()[0]) / 1024.
+    except (IOError, OSError):
+        pass
+    # ru_maxrss is in KB on Linux, it is the peak of the whole process life
+    peak = status.get('VmHWM', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+    return status.get('VmRSS', peak), peak
+
+
+def reset_peak():
+    """
+    Reset the peak resident set size (VmHWM) of the process to the current one (Linux >= 4.0)
+    :return: bool, False if the peak can't be reset and it is the peak of the whole process life
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class _NullStage:
+    """
+    Stage which does nothing (instrumentation is disabled)
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def tag(self, **tags):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    """
+    Measured stage. Use <stage> to create it.
+    """
+
+    def __init__(self, instrument, name, tags):
+        self.instrument = instrument
+        self.name = name
+        self.tags = tags
+        # Peak RSS observed while the stage is running, MB
+        self.peak = 0.
+
+    def tag(self, **tags):
+        """
+        Add tags while the stage is running (e.g. number of processed pixels)
+        """
+        self.tags.update(tags)
+
+    def __enter__(self):
+        stack = self.instrument.stack()
+        if stack:
+            tags = dict(stack[-1].tags)
+            tags.update(self.tags)
+            self.tags = tags
+            self.path = stack[-1].path + '/' + self.name
+        else:
+            self.path = self.name
+
+        # The peak of the process is reset for this stage, outer stages keep the peak reached so far
+        rss, peak = memory_mb()
+        for outer in stack:
+            outer.peak = max(outer.peak, peak)
+        self.peak_reset = reset_peak()
+        self.rss = rss
+        self.peak = rss if self.peak_reset else peak
+        stack.append(self)
+
+        self.profiler = None
+        if self.instrument.profile and len(stack) == 1:
+            self.profiler = SamplingProfiler(threading.current_thread().ident, self.instrument.interval).start()
+
+        self.io = io_counters()
+        self.cpu = cpu_time()
+        self.wall = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.time() - self.wall
+        cpu = cpu_time() - self.cpu
+        io = io_counters()
+        rss, peak = memory_mb()
+        self.peak = max(self.peak, peak)
+        stack = self.instrument.stack()
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+
+        record = {
+            'stage': self.path,
+            'start': self.wall,
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'start_rss_mb': self.rss,
+            'peak_rss_mb': self.peak,
+            # Memory taken by the stage above the RSS at its start
+            'peak_delta_mb': self.peak - self.rss,
+            'end_rss_mb': rss,
+            # 'process' if the peak can't be reset per stage and it is the peak of the whole process life
+            'peak_scope': 'stage' if self.peak_reset else 'process',
+            'read_bytes': io.get('read_bytes', 0) - self.io.get('read_bytes', 0),
+            'write_bytes': io.get('write_bytes', 0) - self.io.get('write_bytes', 0),
+            'rchar': io.get('rchar', 0) - self.io.get('rchar', 0),
+            'wchar': io.get('wchar', 0) - self.io.get('wchar', 0),
+            'status': 'ok' if exc_type is None else 'failed',
+            'host': self.instrument.host,
+            'pid': os.getpid(),
+        }
+        record.update(self.tags)
+        if self.profiler is not None:
+            record['profile'] = self.profiler.stop()
+
+        self.instrument.sink.write(record)
+        return False
+
+
+class Instrument:
+    """
+    Process-wide instrumentation settings
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sink = None
+        self.profile = False
+        self.interval = 0.01
+        self.host = socket.gethostname()
+        self._local = threading.local()
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+INSTRUMENT = Instrument()
+
+
+def configure(sink=None, path=None, profile=False, interval=0.01):
+    """
+    Enable instrumentation
+    :param sink: object with <write(record)> method, e.g. <ListSink>
+    :param path: str, path to JSON-lines file (used if <sink> is None)
+    :param profile: bool, sample stacks of top level stages
+    :param interval: float, sampling interval of the profiler in seconds
+    :return: sink
+    """
+    INSTRUMENT.sink = sink if sink is not None else JsonLinesSink(path)
+    INSTRUMENT.profile = profile
+    INSTRUMENT.interval = interval
+    INSTRUMENT.enabled = True
+    return INSTRUMENT.sink
+
+
+def disable():
+    INSTRUMENT.enabled = False
+    INSTRUMENT.sink = None
+
+
+def stage(name, **tags):
+    """
+    :param name: str, name of the stage (e.g. 'geolocation', 'fuse')
+    :param tags: identifiers of the stage (scene, band, ...)
+    :return: context manager
+    """
+    if not INSTRUMENT.enabled:
+        return _NULL_STAGE
+    return Stage(INSTRUMENT, name, tags)
+
+
+def scene_name(path):
+    """
+    :param path: str or <nansat.nansat.Nansat> object
+    :return: str, file name which identifies the scene
+    """
+    if isinstance(path, str):
+        return os.path.basename(path.rstrip('/'))
+    return os.path.basename(getattr(path, 'fileName', '') or getattr(path, 'filename', '') or '')
+
+
+if os.environ.get('MICHIGAN_INSTRUMENT'):
+    configure(path=os.environ['MICHIGAN_INSTRUMENT'],
+              profile=os.environ.get('MICHIGAN_PROFILE', '') not in ('', '0'))
@@ -0,0 +1,211 @@
+from collections import OrderedDict
+import os
+import itertools
+
+import numpy as np
+
+from utils import digest, atomic_path
+
+
+class InversionCache:
+    """
+    Bounded (LRU) cache of Boreali inversion results keyed by quantized spectrum, depth, albedo and theta
+    and by the configuration of the inversion (hydro optical model, wavelengths, cpa_limits, mode).
+    Pixels with nearly identical inputs are inverted only once. One cache can be shared by several
+    configurations, their results never collide.
+    """
+
+    def __init__(self, max_size=100000, spectrum_step=1e-5, depth_step=0.1, theta_step=1.):
+        """
+        :param max_size: int, max number of cached results, least recently used are evicted
+        :param spectrum_step: float, quantization step of Rrsw, sr-1
+        :param depth_step: float, quantization step of depth, m
+        :param theta_step: float, quantization step of theta, degrees
+        """
+        self.max_size = max_size
+        self.spectrum_step = spectrum_step
+        self.depth_step = depth_step
+        self.theta_step = theta_step
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def configuration(*items):
+        """
+        :param items: e.g. hydro optical model, wavelengths, cpa_limits and mode of the inversion
+        :return: int, 60 bit identifier of the configuration for <quantize>
+        """
+        return int(digest(*items)[:15], 16)
+
+    def quantize(self, rrsw, depth=None, albedo=None, theta=None, configuration=0):
+        """
+        :param rrsw: numpy array, (pixels, bands) or (bands, ) Rrsw
+        :param depth: numpy array, (pixels, ) or float, None for deep water
+        :param albedo: int, bottom type, None for deep water
+        :param theta: numpy array, (pixels, ) or float, None for zeros
+        :param configuration: int, <configuration> result
+        :return: numpy array, int64 (pixels, bands + 4) quantized keys
+        """
+        rrsw = np.atleast_2d(rrsw)
+        size = rrsw.shape[0]
+        columns = [np.round(rrsw / self.spectrum_step)]
+        for value, step in ((depth, self.depth_step), (theta, self.theta_step)):
+            if value is None:
+                columns.append(np.full((size, 1), -1.))
+            else:
+                columns.append(np.round(np.resize(np.asarray(value, dtype=np.float64), size) / step)[:, None])
+        columns.append(np.full((size, 1), -1. if albedo is None else albedo))
+        keys = np.hstack(columns).astype(np.int64)
+        # The identifier doesn't fit into float64 exactly, it is added as integer
+        return np.hstack([keys, np.full((size, 1), configuration, dtype=np.int64)])
+
+    def get(self, key):
+        """
+        :param key: numpy array, one row of <quantize> result
+        :return: numpy array, cached result or None
+        """
+        key = key.tobytes()
+        if key in self.results:
+            self.hits += 1
+            value = self.results.pop(key)
+            self.results[key] = value
+            return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        :param key: numpy array, one row of <quantize> result
+        :param value: numpy array
+        """
+        key = key.tobytes()
+        self.results.pop(key, None)
+        self.results[key] = value
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def lookup(self, keys):
+        """
+        Vectorized lookup. Pixels with equal keys are looked up once, each pixel is counted as a hit
+        if its result is cached or the same key was already seen among <keys>.
+        :param keys: numpy array, <quantize> result
+        :return: tuple, unique keys, index of the first pixel with each unique key,
+        index of unique key for each pixel, list of cached results
+        (None for missed keys)
+        """
+        unique_keys, first, inverse, counts = np.unique(keys, axis=0, return_index=True,
+                                                        return_inverse=True, return_counts=True)
+        values = []
+        for key, count in zip(unique_keys, counts):
+            value = self.get(key)
+            # Duplicates of the key are served by the same inversion
+            self.hits += count - 1
+            values.append(value)
+        return unique_keys, first, inverse.ravel(), values
+
+    def hit_rate(self):
+        """
+        :return: float, part of requests which were served from the cache
+        """
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.
+
+    def stats(self):
+        """
+        :return: dict, hits, misses, hit rate and size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate(), 'size': len(self.results)}
+
+
+class ForwardLUT:
+    """
+    Precomputed table of deep water Rrsw spectra simulated by the Boreali forward model over a grid
+    of chl, tsm and doc. Pixels whose spectrum is close to a table entry take its concentrations
+    without running the solver (only if asked, see <lut_replace> of <MichiganProcessing.boreali_processing>).
+    The table is simulated once for each model, wavelengths, limits, steps and theta and is saved on disk.
+
+    Table values are approximate: concentrations of a matched pixel are those of the nearest table node,
+    their relative error is up to <max_error> (about 5 % for 60 steps over 0.01..3 mg m-3 of chl, 16 % for
+    20 steps) plus the error allowed by the spectral tolerance of <match>. Use the table only where this
+    accuracy is acceptable (e.g. quick looks), the solver is exact up to its own tolerance.
+    """
+
+    def __init__(self, model, wavelengths, cpa_limits, steps=60, theta=0, cache_path=None):
+        """
+        :param model: Boreali hydro optical model (<Boreali.get_homodel> result)
+        :param wavelengths: list
+        :param cpa_limits: list, limits of chl, tsm and doc (as for <Boreali.process>)
+        :param steps: int, number of grid nodes for each concentration (log spaced). The table has
+        <steps> ** 3 spectra
+        :param theta: float, solar zenith angle of the table
+        :param cache_path: str, directory of saved tables. Default is <CACHE_PATH> of <michigan.dataprep.Data>,
+        empty string means the table is simulated every time
+        """
+        from scipy.spatial import cKDTree
+
+        self.theta = theta
+        self.cpa_limits = cpa_limits
+        self.steps = steps
+        grids = [np.logspace(np.log10(cpa_limits[i * 2]), np.log10(cpa_limits[i * 2 + 1]), steps)
+                 for i in range(3)]
+        self.concentrations = np.array(list(itertools.product(*grids)))
+        self.spectra = self.load_spectra(model, wavelengths, cache_path)
+        self.tree = cKDTree(self.spectra)
+
+    def simulate(self, model, wavelengths):
+        """
+        :return: numpy array, (nodes, bands) spectra of the forward model for all table nodes
+        """
+        from boreali import lm
+
+        spectra = np.empty((len(self.concentrations), len(wavelengths)), dtype=np.float64)
+        for i, c in enumerate(self.concentrations):
+            spectra[i] = lm.get_rrsw_deep(model, c, self.theta, len(wavelengths))[1]
+        return spectra
+
+    def load_spectra(self, model, wavelengths, cache_path=None):
+        """
+        Spectra of the table from <cache_path>. They are simulated (<steps> ** 3 forward model runs) and
+        saved only if there is no saved table for the same model, wavelengths, limits, steps and theta
+        :return: numpy array, (nodes, bands) spectra
+        """
+        if cache_path is None:
+            from dataprep import Data
+            cache_path = Data.CACHE_PATH
+
+        if not cache_path:
+            return self.simulate(model, wavelengths)
+
+        key = digest(np.asarray(model, dtype=np.float64), list(wavelengths), list(self.cpa_limits), self.steps,
+                     float(self.theta))
+        cache_file = os.path.join(cache_path, 'lut_%s.npy' % key)
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
+        spectra = self.simulate(model, wavelengths)
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        with atomic_path(cache_file, '.tmp.npy') as tmp_file:
+            np.save(tmp_file, spectra)
+        return spectra
+
+    def max_error(self):
+        """
+        :return: numpy array, max relative error of chl, tsm and doc of table nodes (half of a log step)
+        """
+        ratio = np.array([self.cpa_limits[i * 2 + 1] / float(self.cpa_limits[i * 2]) for i in range(3)])
+        return ratio ** (0.5 / (self.steps - 1)) - 1
+
+    def match(self, rrsw, tol=1e-4):
+        """
+        :param rrsw: numpy array, (pixels, bands) Rrsw
+        :param tol: float, max RMSE between pixel spectrum and table spectrum
+        :return: numpy arrays, bool (pixels, ) matched pixels and (matched pixels, 4) chl, tsm, doc, rmse
+        """
+        distance, index = self.tree.query(rrsw)
+        rmse = distance / np.sqrt(rrsw.shape[1])
+        matched = rmse <= tol
+        values = np.column_stack([self.concentrations[index[matched]], rmse[matched]])
+        return matched, values
@@ -0,0 +1,112 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils import pool_processes
+
+# Width of the pseudo grid which holds compacted pixels
+CHUNK_WIDTH = 1000
+
+
+def compact_domain(size):
+    """
+    :param size: int, number of pixels
+    :return: <nansat.domain.Domain> object, pseudo grid with at least <size> cells
+    """
+    from nansat import Domain
+
+    cols = min(size, CHUNK_WIDTH)
+    rows = int(np.ceil(size / float(cols)))
+    return Domain('+proj=latlong +datum=WGS84 +ellps=WGS84 +no_defs', '-te 0 0 1 1 -ts %d %d' % (cols, rows))
+
+
+def to_grid(values, shape, fill=np.nan):
+    """
+    :param values: numpy array, (pixels, ) values of compacted pixels
+    :param shape: tuple, shape of pseudo grid
+    :param fill: value of padding cells
+    :return: numpy array, values on pseudo grid
+    """
+    grid = np.empty(shape[0] * shape[1], dtype=np.float32)
+    grid.fill(fill)
+    grid[:values.size] = values
+    return grid.reshape(shape)
+
+
+def invert_chunk(args):
+    """
+    Boreali inversion of compacted valid pixels
+    :param args: tuple, hydro optic name, wavelengths, cpa limits, rrsw (pixels, bands), rrs (pixels, bands)
+    or None, depth (pixels) or None, theta (pixels), threads
+    :return: numpy array, (5, pixels) chl, tsm, doc, mse and Boreali mask
+    """
+    from boreali import Boreali
+    from nansat import Nansat
+
+    hydro_optic, wavelengths, cpa_limits, rrsw, rrs, depth, theta, threads = args
+    size = rrsw.shape[0]
+    domain = compact_domain(size)
+    shape = domain.shape()
+
+    b = Boreali(hydro_optic, wavelengths)
+    n = Nansat(domain=domain)
+    for i, wavelength in enumerate(wavelengths):
+        n.add_band(to_grid(rrsw[:, i], shape), parameters={'name': 'Rrsw_' + str(wavelength),
+                                                          'units': 'sr-1',
+                                                          'wavelength': wavelength})
+        if rrs is not None:
+            n.add_band(to_grid(rrs[:, i], shape), parameters={'name': 'Rrs_' + str(wavelength),
+                                                             'units': 'sr-1',
+                                                             'wavelength': wavelength})
+
+    # padding cells of the pseudo grid are masked
+    mask = to_grid(np.ones(size, dtype=np.float32) * 64, shape, fill=0)
+    if depth is not None:
+        depth = to_grid(depth, shape)
+
+    cpa = b.process(n, cpa_limits, mask=mask, depth=depth, theta=to_grid(theta, shape, fill=0), threads=threads)
+    return np.array([np.asarray(c).ravel()[:size] for c in cpa[:5]], dtype=np.float32)
+
+
+def invert_compact(hydro_optic, wavelengths, cpa_limits, rrsw, rrs=None, depth=None, theta=None,
+                   processes=4, chunk_size=50000):
+    """
+    Boreali inversion of compacted pixels split into chunks over a process pool
+    :param hydro_optic: str, name of hydro optical model
+    :param wavelengths: list
+    :param cpa_limits: list
+    :param rrsw: numpy array, float32 (pixels, bands)
+    :param rrs: numpy array, float32 (pixels, bands) for OSW processing or None
+    :param depth: numpy array, (pixels, ) or None
+    :param theta: numpy array, (pixels, ) or None for zeros
+    :param processes: int, 1 is used inside of a daemonic process (see <michigan.utils.pool_processes>)
+    :param chunk_size: int, max number of pixels in one chunk
+    :return: numpy array, (5, pixels) chl, tsm, doc, mse and Boreali mask
+    """
+    size = rrsw.shape[0]
+    if theta is None:
+        theta = np.zeros(size, dtype=np.float32)
+
+    tasks = []
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        tasks.append((hydro_optic, wavelengths, cpa_limits, rrsw[start:stop],
+                      None if rrs is None else rrs[start:stop],
+                      None if depth is None else depth[start:stop],
+                      theta[start:stop], 1))
+
+    if not tasks:
+        return np.zeros((5, 0), dtype=np.float32)
+
+    processes = pool_processes(processes)
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(invert_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [invert_chunk(task) for task in tasks]
+
+    return np.concatenate(results, axis=1)
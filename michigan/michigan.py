@@ -1,11 +1,19 @@
 from fusion import Fusion
+from fusenet import FusionNetwork
+from dataprep import Data
+from export import NCExport, export_nansat, BAND_SETS
+from inversion import invert_compact
+from extraction import extract_points, spectra
+from classification import BottomClassifier, scene_spectra
+from instrument import stage, scene_name
 import numpy as np
-from nansat import Nansat
-from boreali import Boreali, lm
-from sklearn.cluster import KMeans
 
 
 class MichiganProcessing(Fusion):
+    # Limits of chl, tsm, doc for Boreali and the max number of solver iterations
+    cpa_limits = [0.01, 3,
+                  0.01, 1,
+                  0.01, 1, 10]
 
     def __init__(self, m_file, s_file=None, fuse=False, domain=False, reproject=False, h_mask=30):
         """
@@ -16,6 +24,8 @@ class MichiganProcessing(Fusion):
         :param reproject:
         :param h_mask: int, max depth border 
         """
+        from nansat import Nansat
+
         # TODO: Check out info about inheritance of <__init__> method
 
         if domain:
@@ -26,8 +36,7 @@ class MichiganProcessing(Fusion):
         if fuse:
             try:
                 if h_mask:
-                    Fusion.__init__(self, m_file, s_file)
-                    self.ifile = self.fusion()
+                    self.ifile = self.fused(m_file, s_file)
             except TypeError:
                 print 'Requested Sentinel-2 file was not found'
 
@@ -36,39 +45,100 @@ class MichiganProcessing(Fusion):
             if reproject:
                 self.ifile.reproject(self.domain)
 
+    def fused(self, m_file, s_file, m_wavelengths='full', **fusion_options):
+        """
+        Fused bands of <m_file> and <s_file>. They are taken from <stage_cache> if the same inputs were
+        already fused with the same options, then Sentinel-2 data is not loaded at all
+        :param m_file: str, path to reprojected MODISa file
+        :param s_file: str, path to reprojected Sentinel-2 file
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :param fusion_options: keyword arguments of <Fusion.__init__>
+        :return: <nansat.nansat.Nansat> object with fused bands
+        """
+        from nansat import Nansat
+
+        if s_file is None:
+            raise TypeError('Sentinel-2 file is required for fusion')
+
+        key = self.stage_key('fusion', [m_file, s_file], [Data, Fusion, FusionNetwork, NCExport],
+                             m_wavelengths=m_wavelengths, **fusion_options)
+        if key is not None:
+            path = self.stage_cache.get(key)
+            if path is not None:
+                return Nansat(path)
+
+        Fusion.__init__(self, m_file, s_file, domain=self.domain, **fusion_options)
+        n_hires = self.fusion(m_wavelengths=m_wavelengths)[1]
+
+        if key is not None:
+            return Nansat(self.stage_cache.put_nansat(key, n_hires))
+        return n_hires
+
     def boreali_processing(self, wavelengths_set='1x1km_bands', bottom_type=0, osw_mod='on',
-                           hydro_optic='michigan'):
+                           hydro_optic='michigan', ofile=None, export_bands=BAND_SETS['boreali'],
+                           compact=False, processes=4, chunk_size=50000, cache=None, lut=None, lut_tol=1e-4,
+                           lut_replace=False, cpa_limits=None):
+        """
+        :param wavelengths_set: str, name of MODIS wavelengths set
+        :param bottom_type: int
+        :param osw_mod: str, 'on' for optically shallow water processing
+        :param hydro_optic: str, name of hydro optical model
+        :param ofile: str, path for export of results. If None nothing is exported
+        :param export_bands: list, names of bands for export. None means all bands
+        :param compact: bool, if True only valid pixels are gathered and inverted in chunks by
+        <processes> workers, results are scattered back onto the grid
+        :param processes: int, number of workers in compact mode
+        :param chunk_size: int, max number of pixels in one chunk in compact mode
+        :param cache: <InversionCache> object, results of pixels with the same quantized inputs are reused
+        (compact mode only)
+        :param lut: <ForwardLUT> object, deep water pixels close to the table take table values if the solver
+        gives no solution for them, compact mode without OSW only
+        :param lut_tol: float, max RMSE of spectrum for the table match
+        :param lut_replace: bool, matched pixels are not inverted and take approximate table values
+        (see <ForwardLUT.max_error>) instead of results of the solver
+        :param cpa_limits: list, limits of chl, tsm and doc (see <Boreali.process>). Default is <self.cpa_limits>
+        :return: <nansat.nansat.Nansat> object
+        """
+        from nansat import Nansat
 
         wavelengths = self.wavelengths['modis'][wavelengths_set]
         bathymetry_path = self.BATHYMETRY_PATH
-        cpa_limits = [0.01, 3,
-                      0.01, 1,
-                      0.01, 1, 10]
+        if cpa_limits is None:
+            cpa_limits = self.cpa_limits
 
-        b = Boreali(hydro_optic, wavelengths)
-        theta = np.zeros_like(self.ifile[2])
         custom_n = Nansat(domain=self.ifile)
         band_rrs_numbers = list(map(lambda x: self.ifile._get_band_number('Rrs_' + str(x)), wavelengths))
 
+        # Creating of the mask
+        # All pixels marked as -0.015534 (or NaN out of swath) in img will marked as 0.0 in the mask
+        r2 = self.ifile[2]
+        mask = np.where((r2 != -0.015534) & np.isfinite(r2), np.array(64.0), np.array(0.0))
+        # Validation of mask according to bathymetry data.
+        # If in the bathymetry pixel was marked as np.nan, in mask he will marked as 0.0
+        # else nothing
+        h = self.get_bottom(bathymetry_path=bathymetry_path)
+        mask = np.where(np.isnan(h), np.array(0.), mask)
+
+        rrsw_list = []
+        rrs_list = []
         for index in range(0, len(wavelengths)):
-            rrsw = self.ifile[band_rrs_numbers[index]] / (0.52 + 1.7 * self.ifile[band_rrs_numbers[index]])
+            # Each band is read from the file only once
+            rrs = self.ifile[band_rrs_numbers[index]]
+            rrsw = rrs / (0.52 + 1.7 * rrs)
             custom_n.add_band(rrsw, parameters={'name': 'Rrsw_' + str(wavelengths[index]),
                                                 'units': 'sr-1',
                                                 'wavelength': wavelengths[index]})
 
             # If we want to use OSW mod, we will need to add Rrs data in custom_n obj
             if osw_mod == 'on':
-                custom_n.add_band(self.ifile[band_rrs_numbers[index]], parameters={'name': 'Rrs_' + str(wavelengths[index]),
-                                                                              'units': 'sr-1',
-                                                                              'wavelength': wavelengths[index]})
-        # Creating of the mask
-        # All pixels marked as -0.015534 in img will marked as 0.0 in the mask
-        mask = np.where(self.ifile[2] != np.float(-0.015534), np.array(64.0), np.array(0.0))
-        # Validation of mask according to bathymetry data.
-        # If in the bathymetry pixel was marked as np.nan, in mask he will marked as 0.0
-        # else nothing
-        h = self.get_bottom(bathymetry_path=bathymetry_path)
-        mask = np.where(np.isnan(h), np.array(0.), mask)
+                custom_n.add_band(rrs, parameters={'name': 'Rrs_' + str(wavelengths[index]),
+                                                   'units': 'sr-1',
+                                                   'wavelength': wavelengths[index]})
+
+            if compact:
+                rrsw_list.append(rrsw)
+                rrs_list.append(rrs)
+
         # Adding of mask into custom_n obj
         custom_n.add_band(mask, parameters={'name': 'mask'})
 
@@ -76,11 +146,22 @@ class MichiganProcessing(Fusion):
         # If want to star OSW we will need to add h to Boreali.process
         # else marked it as None
         if osw_mod == 'on':
-            depth = h
+            # Boreali gets its own writable copy of the cached depth field
+            depth = np.array(h)
         else:
             depth = None
 
-        cpa = b.process(custom_n, cpa_limits, mask=custom_n['mask'], depth=depth, theta=theta, threads=4)
+        with stage('inversion', scene=scene_name(self.ifile), compact=compact, osw=osw_mod == 'on'):
+            if compact:
+                cpa = self.boreali_compact(hydro_optic, wavelengths, cpa_limits, mask, rrsw_list,
+                                           rrs_list if osw_mod == 'on' else None, depth,
+                                           processes=processes, chunk_size=chunk_size,
+                                           cache=cache, lut=lut, lut_tol=lut_tol, lut_replace=lut_replace)
+            else:
+                from boreali import Boreali
+                b = Boreali(hydro_optic, wavelengths)
+                theta = np.zeros_like(r2)
+                cpa = b.process(custom_n, cpa_limits, mask=custom_n['mask'], depth=depth, theta=theta, threads=4)
 
         custom_n.add_band(array=cpa[0], parameters={'name': 'chl',
                                                     'long_name': 'Chlorophyl-a',
@@ -98,16 +179,179 @@ class MichiganProcessing(Fusion):
                                                     'long_name': 'L2 Boreali mask',
                                                     'units': '1'})
 
-        #   custom_n.export(final_path + obj.split('/')[-1] + 'cpa_OSW.nc')
+        if ofile is not None:
+            export_nansat(custom_n, ofile, bands=export_bands)
+
         return custom_n
 
+    def boreali_compact(self, hydro_optic, wavelengths, cpa_limits, mask, rrsw_list, rrs_list=None, depth=None,
+                        processes=4, chunk_size=50000, cache=None, lut=None, lut_tol=1e-4, lut_replace=False):
+        """
+        Boreali inversion of valid pixels only. Land, cloud and out of swath pixels are not sent to the solver.
+        Counts of solved, cached and table pixels are kept in <self.inversion_report>.
+        :param hydro_optic: str, name of hydro optical model
+        :param wavelengths: list
+        :param cpa_limits: list
+        :param mask: numpy array, 64 for valid pixels and 0 for others
+        :param rrsw_list: list of numpy arrays, Rrsw for each wavelength
+        :param rrs_list: list of numpy arrays, Rrs for each wavelength (OSW processing) or None
+        :param depth: numpy array or None
+        :param processes: int
+        :param chunk_size: int
+        :param cache: <InversionCache> object or None
+        :param lut: <ForwardLUT> object or None
+        :param lut_tol: float
+        :param lut_replace: bool, table values replace the solver for matched pixels (otherwise they are
+        used only for matched pixels without a solution)
+        :return: list of numpy arrays, chl, tsm, doc, mse and L2 Boreali mask on the grid (nan and 0 for
+        not processed pixels)
+        """
+        valid = mask > 0
+        for rrsw in rrsw_list:
+            valid &= np.isfinite(rrsw)
+        if depth is not None:
+            valid &= np.isfinite(depth)
+
+        rrsw = np.array([arr[valid] for arr in rrsw_list], dtype=np.float32).T
+        rrs = None
+        if rrs_list is not None:
+            rrs = np.array([arr[valid] for arr in rrs_list], dtype=np.float32).T
+        if depth is not None:
+            depth = depth[valid].astype(np.float32)
+
+        values = np.empty((5, rrsw.shape[0]), dtype=np.float32)
+        values.fill(np.nan)
+        todo = np.arange(rrsw.shape[0])
+        report = {'pixels': todo.size, 'table': 0, 'cached': 0, 'solved': 0}
+
+        # Forward model table is computed for deep water only
+        matched = None
+        if lut is not None and depth is None and todo.size:
+            matched, lut_values = lut.match(rrsw, tol=lut_tol)
+            report['table_max_error'] = lut.max_error().tolist()
+            if lut_replace:
+                values[:4, matched] = lut_values.T
+                values[4, matched] = 64
+                todo = todo[~matched]
+                report['table'] = int(matched.sum())
+
+        if cache is not None and todo.size:
+            configuration = cache.configuration(hydro_optic, wavelengths, cpa_limits, rrs is not None)
+            keys = cache.quantize(rrsw[todo], depth=None if depth is None else depth[todo],
+                                  configuration=configuration)
+            unique_keys, first, inverse, cached = cache.lookup(keys)
+            missed = np.array([value is None for value in cached])
+            solve = todo[first[missed]]
+        else:
+            solve = todo
+
+        solved = invert_compact(hydro_optic, wavelengths, cpa_limits, rrsw[solve],
+                                rrs=None if rrs is None else rrs[solve],
+                                depth=None if depth is None else depth[solve],
+                                processes=processes, chunk_size=chunk_size)
+        report['solved'] = int(solve.size)
+
+        if cache is not None and todo.size:
+            # Copies don't keep the whole <solved> array alive after eviction
+            for key, value in zip(unique_keys[missed], solved.T):
+                cache.put(key, value.copy())
+            results = np.empty((len(cached), 5), dtype=np.float32)
+            if not missed.all():
+                results[~missed] = [value for value in cached if value is not None]
+            results[missed] = solved.T
+            values[:, todo] = results[inverse].T
+            report['cached'] = int(todo.size - solve.size)
+            report.update(cache.stats())
+        else:
+            values[:, solve] = solved
+
+        if matched is not None and not lut_replace:
+            # Table values only fill matched pixels which the solver failed on
+            matched = np.flatnonzero(matched)
+            failed = ~np.isfinite(values[0, matched])
+            values[:4, matched[failed]] = lut_values[failed].T
+            values[4, matched[failed]] = 64
+            report['table'] = int(failed.sum())
+
+        self.inversion_report = report
+
+        cpa = []
+        for i in range(5):
+            grid = np.empty(mask.shape, dtype=np.float32)
+            grid.fill(0 if i == 4 else np.nan)
+            grid[valid] = values[i]
+            cpa.append(grid)
+        return cpa
+
     def get_r(self, coords, wavelengths, r_type='Rrs_'):
-        y, x = coords
-        band_numbers = list(map(lambda x: self.ifile._get_band_number(r_type + str(x)), wavelengths))
-        r_list = [self.ifile[band][y][x] for band in band_numbers]
-        return r_list
+        """
+        :param coords: tuple, y, x
+        :param wavelengths: list
+        :param r_type: str, 'Rrs_' or 'Rrsw_' (computed from Rrs)
+        :return: list, values of the pixel
+        """
+        row = extract_points(self.ifile, [coords], wavelengths)[0]
+        return [row[r_type + str(wavelength)] for wavelength in wavelengths]
+
+    def extract_points(self, points, wavelengths_set='1x1km_bands', latlon=False):
+        """
+        :param points: list of tuples, (y, x) or (lat, lon) if <latlon>
+        :param wavelengths_set: str, name of MODIS wavelengths set
+        :param latlon: bool
+        :return: list of dicts, Rrs, Rrsw and depth of the points (see <extraction.extract_points>)
+        """
+        return extract_points(self.ifile, points, self.wavelengths['modis'][wavelengths_set], latlon=latlon,
+                              depth=self.get_bottom(bathymetry_path=self.BATHYMETRY_PATH))
 
-    def boreali_lm(self, coords, wavelengths_set='1x1km_bands', bottom_type=0, show='on', title=None, hydro_optic='michigan'):
+    def boreali_lm_batch(self, points=None, table=None, wavelengths_set='1x1km_bands', bottom_type=0,
+                         hydro_optic='michigan', latlon=False):
+        """
+        Deep and OSW inversion of many points (of one or several scenes) by one call of the solver
+        :param points: list of tuples, (y, x) or (lat, lon) if <latlon>. Used if <table> is None
+        :param table: list of dicts, result of <extract_points> or <extraction.extract> with <depth>
+        :param wavelengths_set: str, name of MODIS wavelengths set
+        :param bottom_type: int, see <boreali_lm>
+        :param hydro_optic: str, name of hydro optical model
+        :param latlon: bool
+        :return: list of dicts, rows of <table> with chl, tsm, doc and rmse of deep and OSW inversion.
+        Points with not valid spectrum or depth are skipped
+        """
+        wavelengths = self.wavelengths['modis'][wavelengths_set]
+        if table is None:
+            table = self.extract_points(points, wavelengths_set=wavelengths_set, latlon=latlon)
+
+        r = spectra(table, wavelengths)
+        depth = np.array([row.get('depth', np.nan) for row in table], dtype=np.float64)
+        valid = np.isfinite(r).all(axis=1) & np.isfinite(depth)
+        table = [row for row, ok in zip(table, valid) if ok]
+        if not table:
+            return []
+
+        from boreali import Boreali, lm
+
+        b = Boreali(hydro_optic, wavelengths)
+        model = b.get_homodel()
+        albedo = b.get_albedo([bottom_type])[0]
+        cpa_limits = self.cpa_limits
+
+        r = r[valid]
+        depth = depth[valid]
+        theta = [0] * len(table)
+        c_deep = np.asarray(lm.get_c_deep(cpa_limits, model, list(r), theta, 4)[1]).reshape(len(table), -1)
+        c_osw = np.asarray(lm.get_c_shal(cpa_limits, model, list(r), theta, list(depth),
+                                         [albedo] * len(table), 4)[1]).reshape(len(table), -1)
+
+        results = []
+        for row, deep, osw in zip(table, c_deep, c_osw):
+            row = dict(row)
+            for i, name in enumerate(['chl', 'tsm', 'doc', 'rmse']):
+                row[name + '_deep'] = float(deep[i])
+                row[name + '_osw'] = float(osw[i])
+            results.append(row)
+        return results
+
+    def boreali_lm(self, coords, wavelengths_set='1x1km_bands', bottom_type=0, show='on', title=None, hydro_optic='michigan',
+                   cache=None):
         """
         :param wavelengths: list.
         :param coords: tuple. i, j 
@@ -115,24 +359,38 @@ class MichiganProcessing(Fusion):
         0 - sand; 1 - sargassum; 2 - silt; 3 - boodlea; 4 - limestone; 
         5 - enteromorpha; 6 - cladophora; 7 - chara; 8 - sand2; 9 - sand3; 10 - charasand;
         11 - cladforaosand; 12 - sandmichi; 13 - cladomichi; 
+        :param cache: <InversionCache> object, deep and OSW results are reused for the same quantized inputs
         """
         wavelengths = self.wavelengths['modis'][wavelengths_set]
         y, x = coords
+        from boreali import Boreali, lm
+
         b = Boreali(hydro_optic, wavelengths)
         model = b.get_homodel()
         theta = 0
         albedoType = bottom_type
-        depth = float(self.get_bottom()[y, x])
+        point = self.extract_points([coords], wavelengths_set=wavelengths_set)[0]
+        depth = point['depth']
         # depth = 7
         albedo = b.get_albedo([albedoType])[0]
 
-        cpa_limits = [0.01, 3,
-                      0.01, 1,
-                      0.01, 1, 10]
+        cpa_limits = self.cpa_limits
 
-        r = self.get_r((y, x), 'Rrsw_', wavelengths)
-        c_deep = lm.get_c_deep(cpa_limits, model, [r], [theta], 4)[1]
-        c_osw = lm.get_c_shal(cpa_limits, model, [r], [theta], [depth], [albedo], 4)[1]
+        r = [point['Rrsw_' + str(wavelength)] for wavelength in wavelengths]
+        cached = None
+        if cache is not None:
+            configuration = cache.configuration(hydro_optic, wavelengths, cpa_limits, 'lm')
+            key = cache.quantize(np.array(r), depth=depth, albedo=albedoType, theta=theta,
+                                 configuration=configuration)[0]
+            cached = cache.get(key)
+
+        if cached is None:
+            c_deep = lm.get_c_deep(cpa_limits, model, [r], [theta], 4)[1]
+            c_osw = lm.get_c_shal(cpa_limits, model, [r], [theta], [depth], [albedo], 4)[1]
+            if cache is not None:
+                cache.put(key, (c_deep, c_osw))
+        else:
+            c_deep, c_osw = cached
 
         # backward case
         rrsw_deep = lm.get_rrsw_deep(model, c_deep[0:3], theta, len(wavelengths))[1]
@@ -164,24 +422,43 @@ class MichiganProcessing(Fusion):
         else:
             return c_osw, c_deep, depth
 
-    def bottom_classification(self, clusters, wavelengths_set='1x1km_bands', h_max=30, h_min=None):
-        # We have to add one more class in classification for a land
-        # TODO: Add capability to get data set by bottom depth
-        k_train_arr = []
-        # all pixels shallower then <h_mask> value should be masked
-        mask = self.get_h_mask(h_max=h_max, h_min=h_min)
-
-        for band in self.wavelengths['modis'][wavelengths_set]:
-            print 'Rrs_%s' % band
-            arr = self.ifile['Rrs_%s' % band]
-            # all 999 pixels will combined in one class
-            arr[np.isnan(arr) == True] = 999
-            arr[np.isnan(mask) == True] = 999
-            k_train_arr.append(arr.ravel())
-
-        k_train_arr = np.array(k_train_arr).T
-
-        kmeans = KMeans(n_clusters=clusters, random_state=0).fit(k_train_arr)
-        arr = kmeans.labels_
-        arr = arr.reshape(self.domain.shape())
-        return arr
+    def bottom_classification(self, clusters, wavelengths_set='1x1km_bands', h_max=30, h_min=None, depth_bins=None,
+                              classifier=None):
+        """
+        Bottom classification of valid pixels (finite Rrs inside of the depth range). Not valid pixels are
+        labelled as -1.
+        :param clusters: int, number of bottom classes
+        :param wavelengths_set: str, name of MODIS wavelengths set
+        :param h_max: float, max depth
+        :param h_min: float, min depth
+        :param depth_bins: list of tuples, (h_min, h_max). If given all bins are classified in one pass
+        and a dict bin -> labels is returned
+        :param classifier: <BottomClassifier> object, fitted (e.g. over a season) or loaded classifier.
+        If given only nearest centroid labelling is done. Default <depth_bins> are bins of the classifier
+        (<h_min> and <h_max> are not used then)
+        :return: numpy array, int labels on the grid, or dict if <depth_bins> or the classifier has several bins
+        """
+        wavelengths = self.wavelengths['modis'][wavelengths_set]
+        if classifier is not None:
+            if depth_bins is None:
+                depth_bins = classifier.depth_bins if len(classifier.depth_bins) > 1 else None
+                bins = list(classifier.depth_bins)
+            else:
+                bins = [tuple(depth_bin) for depth_bin in depth_bins]
+                missing = [depth_bin for depth_bin in bins if depth_bin not in classifier.depth_bins]
+                if missing:
+                    raise ValueError('Depth bins %s are not bins of the classifier %s'
+                                     % (missing, classifier.depth_bins))
+        else:
+            bins = depth_bins if depth_bins is not None else [(h_min, h_max)]
+        spectra = scene_spectra(self.ifile, wavelengths)
+        depth = self.get_bottom(bathymetry_path=self.BATHYMETRY_PATH)
+
+        if classifier is None:
+            # One scene is clustered by full k-means
+            classifier = BottomClassifier(clusters, wavelengths, depth_bins=bins).fit(spectra, depth)
+
+        labels = classifier.predict(spectra, depth)
+        if depth_bins is None:
+            return labels[tuple(bins[0])]
+        return dict((tuple(depth_bin), labels[tuple(depth_bin)]) for depth_bin in bins)
@@ -0,0 +1,250 @@
+"""
+Staged producer/consumer pipeline: the next scenes are loaded (into memory or onto local scratch disk)
+while the current scene is processed, and outputs are written asynchronously:
+
+    pipeline = Pipeline(load=ScratchLoader('/tmp/scratch'), process=run_scene, write=move_output, depth=2)
+    for item, state, value in pipeline.run(scenes):
+        ...
+
+Loading, processing and writing run in separate threads connected by bounded queues. NFS reads,
+GDAL decoding and numpy release GIL, so I/O of one scene overlaps compute of another.
+"""
+import os
+import re
+import fnmatch
+import shutil
+import tempfile
+import threading
+import traceback
+from Queue import Queue
+
+import numpy as np
+
+from utils import atomic_path
+
+# End of stream marker
+_END = object()
+
+
+def data_size(data):
+    """
+    :param data: numpy array, path to file or directory, or dict/list/tuple of them
+    :return: int, bytes in memory (arrays) or on disk (paths)
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(data_size(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(data_size(value) for value in data)
+    if isinstance(data, str) and os.path.isfile(data):
+        return os.path.getsize(data)
+    if isinstance(data, str) and os.path.isdir(data):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(data) for f in files)
+    return 0
+
+
+class Budget:
+    """
+    Ceiling of bytes of loaded but not yet processed items. One item is always allowed,
+    so an item larger than the ceiling doesn't block the pipeline.
+    """
+
+    def __init__(self, limit_mb=None):
+        self.limit = None if limit_mb is None else limit_mb * 1024 * 1024
+        self.used = 0
+        self.items = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            while self.limit is not None and self.items > 0 and self.used >= self.limit:
+                self.condition.wait()
+
+    def add(self, size):
+        with self.condition:
+            self.used += size
+            self.items += 1
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.items -= 1
+            self.condition.notify_all()
+
+
+class Pipeline:
+    """
+    load(item) -> data, process(item, data) -> result, write(item, result) -> value
+    """
+
+    def __init__(self, load, process, write=None, depth=2, memory_limit_mb=None, cleanup=None):
+        """
+        :param load: function, reads inputs of an item (e.g. copies them to local scratch)
+        :param process: function, computes an item
+        :param write: function, stores a result (e.g. moves it to NFS). None returns results as they are
+        :param depth: int, max number of loaded items waiting for processing and results waiting for writing
+        :param memory_limit_mb: float, ceiling of size of loaded items waiting for processing (see <data_size>)
+        :param cleanup: function, called with loaded data when the item is processed (e.g. removes scratch)
+        """
+        self.load = load
+        self.process = process
+        self.write = write
+        self.depth = depth
+        self.budget = Budget(memory_limit_mb)
+        self.cleanup = cleanup
+
+    def _loader(self, items, loaded):
+        for item in items:
+            self.budget.wait()
+            try:
+                data = self.load(item)
+                size = data_size(data)
+                error = None
+            except Exception:
+                data, size, error = None, 0, traceback.format_exc().strip().splitlines()[-1]
+            self.budget.add(size)
+            loaded.put((item, data, size, error))
+        loaded.put(_END)
+
+    def _processor(self, loaded, processed, results):
+        while True:
+            entry = loaded.get()
+            if entry is _END:
+                break
+            item, data, size, error = entry
+            try:
+                if error is not None:
+                    results.put((item, 'failed', error))
+                    continue
+                try:
+                    processed.put((item, self.process(item, data)))
+                except Exception:
+                    results.put((item, 'failed', traceback.format_exc().strip().splitlines()[-1]))
+            finally:
+                if self.cleanup is not None and data is not None:
+                    try:
+                        self.cleanup(data)
+                    except Exception:
+                        pass
+                data = None
+                self.budget.release(size)
+        processed.put(_END)
+
+    def _writer(self, processed, results):
+        while True:
+            entry = processed.get()
+            if entry is _END:
+                break
+            item, result = entry
+            try:
+                value = self.write(item, result) if self.write is not None else result
+                results.put((item, 'done', value))
+            except Exception:
+                results.put((item, 'failed', traceback.format_exc().strip().splitlines()[-1]))
+        results.put(_END)
+
+    def run(self, items):
+        """
+        :param items: iterable of items (e.g. scenes)
+        :return: generator of tuples, item, state ('done' or 'failed'), written value or error message.
+        Items are yielded as soon as they are written
+        """
+        loaded = Queue(maxsize=self.depth)
+        processed = Queue(maxsize=self.depth)
+        results = Queue()
+        threads = [threading.Thread(target=self._loader, args=(items, loaded)),
+                   threading.Thread(target=self._processor, args=(loaded, processed, results)),
+                   threading.Thread(target=self._writer, args=(processed, results))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            entry = results.get()
+            if entry is _END:
+                break
+            yield entry
+
+        for thread in threads:
+            thread.join()
+
+
+class ScratchLoader:
+    """
+    Loader of <Pipeline> which copies input files (or SAFE directories) onto local scratch disk.
+    Only granules and band files which are used for the domain are copied from SAFE directories.
+    """
+
+    def __init__(self, scratch_dir=None, granules=None, bands=None):
+        """
+        :param scratch_dir: str, local directory. Default is the system temporary directory
+        :param granules: list, names of Sentinel-2 granules which cover the domain (e.g. <Data.granules>).
+        None means all granules
+        :param bands: list, Sentinel-2 band codes ('01', '8A', ...). None means all bands
+        """
+        self.scratch_dir = scratch_dir
+        self.granules = granules
+        self.bands = bands
+
+    def ignore(self, directory, names):
+        """
+        Filter of <shutil.copytree>: other granules and band files are not copied
+        :param directory: str
+        :param names: list, names of files in <directory>
+        :return: list, names which are not copied
+        """
+        ignored = []
+        for name in names:
+            if self.granules is not None and os.path.basename(directory) == 'GRANULE':
+                # The same pattern as in <michigan.sentinel2.find_granules>
+                if not any(fnmatch.fnmatch(name, '*_T%s_*' % granule) for granule in self.granules):
+                    ignored.append(name)
+            elif self.bands is not None:
+                band = re.search(r'_B(\w\w)(_60m)?\.jp2$', name)
+                if band is not None and band.group(1) not in self.bands:
+                    ignored.append(name)
+        return ignored
+
+    def __call__(self, paths):
+        """
+        :param paths: tuple, paths to inputs of one scene
+        :return: tuple, local copies of <paths>
+        """
+        if self.scratch_dir is not None and not os.path.isdir(self.scratch_dir):
+            os.makedirs(self.scratch_dir)
+
+        local_dir = tempfile.mkdtemp(prefix='michigan_', dir=self.scratch_dir)
+        local = []
+        for path in paths:
+            path = path.rstrip('/')
+            local_path = os.path.join(local_dir, os.path.split(path)[1])
+            if os.path.isdir(path):
+                shutil.copytree(path, local_path, ignore=self.ignore)
+            else:
+                # Times are preserved, the copy has the same identity for <michigan.stagecache>
+                shutil.copy2(path, local_path)
+            local.append(local_path)
+        return tuple(local)
+
+    @staticmethod
+    def cleanup(local):
+        """
+        :param local: tuple, result of <__call__>
+        """
+        if local:
+            shutil.rmtree(os.path.dirname(local[0]), ignore_errors=True)
+
+
+def move_output(path, output_dir):
+    """
+    Move a file from local scratch into <output_dir> (e.g. on NFS) atomically
+    :param path: str, local file
+    :param output_dir: str
+    :return: str, path to moved file
+    """
+    ofile = os.path.join(output_dir, os.path.split(path)[1])
+    with atomic_path(ofile) as tmp_file:
+        shutil.copy(path, tmp_file)
+    os.remove(path)
+    return ofile
@@ -0,0 +1,99 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from export import NCExport, BAND_SETS
+from utils import pool_processes
+
+
+def fuse_job(args):
+    """
+    Worker of <FusionScheduler>: fuse one band of one scene. The hires cube, low resolution band and index
+    are mapped from the stores of <michigan.fusion.Fusion.share>, the fused band is written into the fused store
+    :param args: tuple, scene number, band number, band name, stores (hires, low resolution, index, fused),
+    iterations, threads
+    :return: tuple, scene number and band number
+    """
+    from ovl_plugins.fusion.fusion import fuse
+
+    scene, band_number, band, stores, iterations, threads = args
+    hires_store, lores_store, index_store, fused_store = stores
+    # Copy-on-write maps: pages are shared by all workers and are copied only if <fuse> writes into them
+    hires = np.load(hires_store, mmap_mode='c')
+    index = np.load(index_store, mmap_mode='c')
+    lores = np.array(np.load(lores_store, mmap_mode='r')[band_number])
+    hires_fused = fuse(hires, lores, network_name=band, iterations=iterations, threads=threads, index=index)
+
+    fused = np.load(fused_store, mmap_mode='r+')
+    fused[band_number] = hires_fused
+    fused.flush()
+    return scene, band_number
+
+
+class FusionScheduler:
+    """
+    Runs <fuse> for all bands of several scenes on one process pool.
+    Number of processes times <threads> of each <fuse> call is not larger than <cores>.
+    Scenes are shared with the workers through memory-mapped stores (see <michigan.fusion.Fusion.share>),
+    so jobs carry only paths and work with any start method of processes.
+    """
+
+    def __init__(self, cores=8, threads=1, iterations=20, tile_dir=None):
+        """
+        :param cores: int, total core budget
+        :param threads: int, threads of each <fuse> call
+        :param iterations: int, number of training iterations
+        :param tile_dir: str, directory for the stores. Default is <CACHE_PATH> of <michigan.fusion.Fusion>
+        """
+        self.cores = cores
+        self.threads = min(threads, cores)
+        self.iterations = iterations
+        self.tile_dir = tile_dir
+        self.scenes = []
+
+    def add_scene(self, fusion, m_wavelengths='full'):
+        """
+        Move the scene into stores, the hires cube is not kept in memory of this process after that
+        :param fusion: <michigan.fusion.Fusion> object
+        :param m_wavelengths: str, name of MODIS wavelengths set
+        :return: int, number of the scene
+        """
+        bands, n_lores, stores = fusion.share(m_wavelengths, tile_dir=self.tile_dir)
+        self.scenes.append((fusion, bands, n_lores, stores))
+        return len(self.scenes) - 1
+
+    def run(self, ofiles=None):
+        """
+        :param ofiles: list, paths for export of fused bands of each scene (None items are not exported)
+        :return: list of tuples (<nansat.nansat.Nansat> with low resolution bands, <nansat.nansat.Nansat>
+        with fused bands) in order of scenes. Bands are in the same order as in <Fusion.fusion>, they are
+        backed by the stores and are valid until <Fusion.close>
+        """
+        jobs = []
+        for scene, (fusion, bands, n_lores, stores) in enumerate(self.scenes):
+            for band_number, band in enumerate(bands):
+                jobs.append((scene, band_number, band, stores, self.iterations, self.threads))
+
+        processes = pool_processes(max(1, self.cores // self.threads))
+        if processes > 1:
+            pool = Pool(processes)
+            try:
+                pool.map(fuse_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                fuse_job(job)
+
+        output = []
+        for scene, (fusion, bands, n_lores, stores) in enumerate(self.scenes):
+            fused_arr = np.load(stores[3], mmap_mode='r')
+            n_hires = NCExport(fusion.domain, bands=BAND_SETS['fusion'])
+            for i, band in enumerate(bands):
+                n_hires.add_band(fused_arr[i], parameters={'name': band})
+            if ofiles is not None and ofiles[scene] is not None:
+                n_hires.export(ofiles[scene])
+            output.append((n_lores.n, n_hires.n))
+
+        return output
@@ -0,0 +1,208 @@
+import os
+import re
+import glob
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from utils import domain_spec, spec_domain, pool_processes
+
+
+class Granule:
+    """
+    One granule of Sentinel-2 SAFE product. Band files are found and the footprint is computed only once.
+    """
+
+    def __init__(self, gdir, s2_user=False):
+        """
+        :param gdir: str, path to granule directory
+        :param s2_user: bool, is it corrected (L2A) granule with <R60m> subdirectory
+        """
+        self.gdir = gdir
+        self.s2_user = s2_user
+
+        if s2_user:
+            pattern = os.path.join(gdir, 'IMG_DATA', 'R60m', '*_B*_60m.jp2')
+        else:
+            pattern = os.path.join(gdir, 'IMG_DATA', '*_B*.jp2')
+
+        # {'01': path to B01 file, ...}
+        self.band_files = {}
+        for bfile in glob.glob(pattern):
+            band = re.search(r'_B(\w\w)(_60m)?\.jp2$', bfile)
+            if band is not None:
+                self.band_files[band.group(1)] = bfile
+
+        self._footprint = None
+
+    def footprint(self):
+        """
+        :return: tuple, lon and lat of corners, projection of granule
+        """
+        if self._footprint is None:
+            from nansat import Nansat
+            n = Nansat(self.band_files['01'])
+            lon, lat = n.get_corners()
+            self._footprint = lon, lat, n.vrt.get_projection()
+
+        return self._footprint
+
+
+def find_granules(ifile, granules, s2_user=False):
+    """
+    :param ifile: str, path to SAFE product
+    :param granules: list, names of granules (e.g. '16TER')
+    :param s2_user: bool, is it corrected product
+    :return: list of <Granule> objects
+    """
+    gdirs = []
+    for granule in granules:
+        gdirs += sorted(glob.glob(os.path.join(ifile, 'GRANULE', '*_T%s_*' % granule)))
+
+    return [Granule(gdir, s2_user=s2_user) for gdir in gdirs]
+
+
+def _srs(wkt):
+    import osr
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    # GDAL 3 uses lat/lon axis order for geographic CRS by default
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def read_window(ds, domain, margin=2, edge_points=21):
+    """
+    Window of granule which covers <domain> and the decimation factor for reading it
+    :param ds: <gdal.Dataset> object, granule band
+    :param domain: <nansat.domain.Domain> object
+    :param margin: int, margin of the window in pixels of the decimated (read) granule
+    :param edge_points: int, number of points along each edge of the domain used for transformation
+    :return: tuple, x_offset, y_offset, x_size, y_size, decimation factor or None if there is no overlap
+    """
+    d_gt = domain.vrt.dataset.GetGeoTransform()
+    rows, cols = domain.shape()
+    # Points along the border of the domain in coordinates of the domain
+    steps = np.linspace(0, 1, edge_points)
+    px = np.concatenate([steps * cols, steps * cols, np.zeros(edge_points), np.ones(edge_points) * cols])
+    py = np.concatenate([np.zeros(edge_points), np.ones(edge_points) * rows, steps * rows, steps * rows])
+    x = d_gt[0] + px * d_gt[1] + py * d_gt[2]
+    y = d_gt[3] + px * d_gt[4] + py * d_gt[5]
+
+    import osr
+    transformation = osr.CoordinateTransformation(_srs(domain.vrt.get_projection()), _srs(ds.GetProjection()))
+    points = np.array(transformation.TransformPoints(list(zip(x.tolist(), y.tolist()))))[:, :2]
+
+    # Domain border -> pixel/line of the granule (north-up granules)
+    g_gt = ds.GetGeoTransform()
+    pixels = (points[:, 0] - g_gt[0]) / g_gt[1]
+    lines = (points[:, 1] - g_gt[3]) / g_gt[5]
+
+    # Size of domain pixel in pixels of the granule. Data is decoded at the resolution of the domain only
+    domain_res = max((pixels.max() - pixels.min()) / cols, (lines.max() - lines.min()) / rows)
+    factor = max(1, int(np.floor(domain_res)))
+
+    margin *= factor
+    x_off = max(0, int(np.floor(pixels.min())) - margin)
+    y_off = max(0, int(np.floor(lines.min())) - margin)
+    x_end = min(ds.RasterXSize, int(np.ceil(pixels.max())) + margin)
+    y_end = min(ds.RasterYSize, int(np.ceil(lines.max())) + margin)
+
+    if x_end <= x_off or y_end <= y_off:
+        return None
+
+    return x_off, y_off, x_end - x_off, y_end - y_off, factor
+
+
+def read_band(bfile, domain, eResampleAlg=1):
+    """
+    Decode only the part of granule band which covers <domain> at a resolution not higher than
+    resolution of <domain> (JPEG2000 resolution levels are used by GDAL, decimated pixels are averaged),
+    and warp it onto <domain>
+    :param bfile: str, path to jp2 file
+    :param domain: <nansat.domain.Domain> object
+    :param eResampleAlg: int, resampling algorithm for warping, 1 is Bilinear
+    :return: numpy array, float32 array on <domain> or None if the granule doesn't cover the domain
+    """
+    import gdal
+    from nansat import Nansat
+    ds = gdal.Open(bfile)
+    window = read_window(ds, domain)
+    if window is None:
+        return None
+
+    x_off, y_off, x_size, y_size, factor = window
+    buf_xsize = max(1, x_size // factor)
+    buf_ysize = max(1, y_size // factor)
+    data = ds.GetRasterBand(1).ReadAsArray(x_off, y_off, x_size, y_size,
+                                           buf_xsize=buf_xsize, buf_ysize=buf_ysize,
+                                           resample_alg=gdal.GRIORA_Average).astype(np.float32)
+
+    gt = ds.GetGeoTransform()
+    x_min = gt[0] + x_off * gt[1]
+    y_max = gt[3] + y_off * gt[5]
+    x_max = x_min + x_size * gt[1]
+    y_min = y_max + y_size * gt[5]
+    window_domain = spec_domain((ds.GetProjection(), '-te %r %r %r %r -ts %d %d' % (
+        x_min, y_min, x_max, y_max, buf_xsize, buf_ysize)))
+
+    n = Nansat(domain=window_domain)
+    n.add_band(data, parameters={'name': 'data'})
+    n.reproject(domain, eResampleAlg=eResampleAlg, addmask=False)
+    return n['data'].astype(np.float32)
+
+
+def warp_band(args):
+    """
+    Worker of <mosaic>: decode one band of one granule and warp it onto the domain
+    :param args: tuple, band index, path to jp2 file and <domain_spec> of the target domain
+    :return: tuple, band index and float32 array on the domain (None if there is no overlap)
+    """
+    band_index, bfile, spec = args
+    return band_index, read_band(bfile, spec_domain(spec))
+
+
+def mosaic(granules, domain, bands, processes=4, pool_type='thread'):
+    """
+    Mosaic of granules on <domain>. All (band, granule) pairs are decoded and warped in parallel.
+    Valid (> 0) pixels of later granules overwrite earlier ones as in sequential stitching.
+    :param granules: list of <Granule> objects
+    :param domain: <nansat.domain.Domain> object
+    :param bands: list, band codes ('01', '02', ...)
+    :param processes: int, number of workers
+    :param pool_type: str, 'thread' or 'process'. Threads are used inside of a daemonic process
+    (e.g. a worker of <michigan.batch>) which can't have children
+    :return: numpy array, float32 cube (bands, rows, cols) filled by nan out of granules
+    """
+    cube = np.empty((len(bands),) + tuple(domain.shape()), dtype=np.float32)
+    cube.fill(np.nan)
+
+    spec = domain_spec(domain)
+    tasks = []
+    for band_index, band in enumerate(bands):
+        for granule in granules:
+            if band in granule.band_files:
+                tasks.append((band_index, granule.band_files[band], spec))
+            else:
+                print "Band <%s> doesn't exist in <%s>" % (band, granule.gdir)
+
+    if pool_type == 'process' and pool_processes(processes) > 1:
+        pool = Pool(processes)
+    else:
+        # GDAL releases GIL while JPEG2000 decoding and warping
+        pool = ThreadPool(processes)
+
+    try:
+        # <imap> keeps order of tasks, so granules are composited in the same order as they are listed
+        for band_index, bdata in pool.imap(warp_band, tasks):
+            if bdata is None:
+                continue
+            valid = bdata > 0
+            cube[band_index][valid] = bdata[valid]
+    finally:
+        pool.close()
+        pool.join()
+
+    return cube
@@ -0,0 +1,257 @@
+"""
+Content-addressed on-disk cache of outputs of pipeline stages (geolocation, downscaling, fusion).
+
+An output is keyed by identity of input files (name, size, mtime), parameters of the stage,
+the domain and a digest of the source code of the stage. Changed inputs, parameters or code give a new key,
+so stale outputs are never reused. Least recently used outputs are evicted when the cache exceeds its size:
+
+    cache = StageCache('./cache/stages', max_size_mb=20000)
+    key = cache.key('fusion', [m_file, s_file], code_version(Fusion), domain_key(domain), h_mask=9999)
+    path = cache.get(key)
+
+The cache is enabled for <michigan.dataprep.Data> and its subclasses by environment variable
+<MICHIGAN_STAGE_CACHE> (directory) and optionally <MICHIGAN_STAGE_CACHE_MB> (max size, MB).
+"""
+import os
+import sys
+import time
+import errno
+import shutil
+import types
+
+from utils import digest, atomic_path
+
+# <digest> of source files: path -> (mtime, digest)
+_sources = {}
+
+
+def file_identity(path):
+    """
+    :param path: str, path to file or directory (e.g. Sentinel-2 SAFE)
+    :return: tuple, name, size and modification time (s). Sizes and times of all files are used for
+    directories. The directory of the file is not used, so copies with preserved times (e.g. on local scratch)
+    are the same. Fractions of seconds are dropped, they are not kept exactly by copying and <os.utime>
+    """
+    path = path.rstrip('/')
+    name = os.path.basename(path)
+    if not os.path.isdir(path):
+        return name, os.path.getsize(path), int(os.path.getmtime(path))
+
+    size, mtime = 0, 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            st = os.stat(os.path.join(root, f))
+            size += st.st_size
+            mtime = max(mtime, int(st.st_mtime))
+    return name, size, mtime
+
+
+def code_version(*objects):
+    """
+    :param objects: modules, classes or functions which implement a stage
+    :return: str, digest of source files of their modules
+    """
+    paths = set()
+    for obj in objects:
+        module = obj if isinstance(obj, types.ModuleType) else sys.modules[obj.__module__]
+        paths.add(os.path.splitext(os.path.abspath(module.__file__))[0] + '.py')
+
+    digests = []
+    for path in sorted(paths):
+        mtime = os.path.getmtime(path)
+        if path not in _sources or _sources[path][0] != mtime:
+            with open(path, 'rb') as f:
+                _sources[path] = (mtime, digest(f.read()))
+        digests.append(_sources[path][1])
+    return digest(*digests)
+
+
+class StageCache:
+    """
+    Directory of stage outputs named <stage>_<key><suffix>. Access time of an entry is its last use.
+    Modification time of an entry is the time of the original output, so a restored output has the same
+    identity as the original one and keys of downstream stages don't change.
+    """
+
+    def __init__(self, root, max_size_mb=None):
+        """
+        :param root: str, cache directory
+        :param max_size_mb: float, max total size of entries. None means unbounded
+        """
+        self.root = root
+        self.max_size = None if max_size_mb is None else max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage, inputs, *versions, **params):
+        """
+        :param stage: str, name of the stage
+        :param inputs: list, paths to input files or directories
+        :param versions: str, e.g. <code_version> and <michigan.utils.domain_key> results
+        :param params: parameters of the stage
+        :return: str, key of the entry
+        """
+        return '%s_%s' % (stage, digest([file_identity(path) for path in inputs], versions,
+                                        sorted(params.items())))
+
+    def path(self, key, suffix='.nc'):
+        return os.path.join(self.root, key + suffix)
+
+    def get(self, key, suffix='.nc'):
+        """
+        :param key: str, <key> result
+        :param suffix: str
+        :return: str, path to the cached output or None
+        """
+        path = self.path(key, suffix)
+        try:
+            touch(path)
+        except OSError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return path
+
+    def put(self, key, ofile, suffix='.nc'):
+        """
+        Store a copy of <ofile> and evict least recently used entries
+        :param key: str, <key> result
+        :param ofile: str, path to stage output
+        :param suffix: str
+        :return: str, path to the cached output
+        """
+        self.makedirs()
+        path = self.path(key, suffix)
+        place(ofile, path)
+        touch(path)
+        self.evict(keep=path)
+        return path
+
+    def put_nansat(self, key, n, bands=None):
+        """
+        Export <n> directly into the cache
+        :param key: str, <key> result
+        :param n: <nansat.nansat.Nansat> object
+        :param bands: list, names of bands for export. None means all bands
+        :return: str, path to the cached output
+        """
+        from export import export_nansat
+
+        self.makedirs()
+        path = self.path(key)
+        export_nansat(n, path, bands=bands)
+        touch(path)
+        self.evict(keep=path)
+        return path
+
+    def restore(self, key, ofile, suffix='.nc'):
+        """
+        :param key: str, <key> result
+        :param ofile: str, path where the stage writes its output
+        :param suffix: str
+        :return: bool, True if the cached output was placed into <ofile>
+        """
+        path = self.get(key, suffix)
+        if path is None:
+            return False
+
+        place(path, ofile)
+        return True
+
+    def makedirs(self):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def entries(self):
+        """
+        :return: list of tuples, last use, size and path of each entry, least recently used first
+        """
+        if not os.path.isdir(self.root):
+            return []
+
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            # Temporary files of concurrent writers are not entries
+            if name.startswith('.') or '.tmp' in name:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits into <max_size>
+        :param keep: str, path to an entry which is never removed (e.g. just stored)
+        :return: int, number of removed entries
+        """
+        if self.max_size is None:
+            return 0
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for atime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed by another process
+                pass
+            size -= entry_size
+            removed += 1
+        return removed
+
+    def stats(self):
+        """
+        :return: dict, hits, misses, number of entries and their total size (MB)
+        """
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+                'size_mb': sum(entry[1] for entry in entries) / 1024. / 1024.}
+
+
+def touch(path):
+    """
+    Mark an entry as recently used. Its modification time is kept
+    :param path: str
+    """
+    os.utime(path, (time.time(), os.stat(path).st_mtime))
+
+
+def place(src, dst):
+    """
+    Hard link (or copy with times if linking is impossible) <src> to <dst> atomically
+    :param src: str
+    :param dst: str
+    """
+    with atomic_path(dst) as tmp_file:
+        try:
+            os.link(src, tmp_file)
+        except OSError:
+            shutil.copy2(src, tmp_file)
+
+
+def from_environ():
+    """
+    :return: <StageCache> object configured by <MICHIGAN_STAGE_CACHE> and <MICHIGAN_STAGE_CACHE_MB>
+    or None if the cache is disabled
+    """
+    root = os.environ.get('MICHIGAN_STAGE_CACHE')
+    if not root:
+        return None
+
+    max_size_mb = os.environ.get('MICHIGAN_STAGE_CACHE_MB')
+    return StageCache(root, max_size_mb=float(max_size_mb) if max_size_mb else None)
@@ -0,0 +1,431 @@
+"""
+Parameter sweep of fusion and Boreali on one scene.
+
+The scene is loaded and masked once, then every combination of the parameter grid is evaluated by a pool
+of forked processes which share the loaded arrays read-only (copy-on-write):
+
+    python -m michigan.sweep fusion --m-file A2016247184000.L2_LAC_OC.nc_reprojected.nc \\
+        --s-file S2A_..._reprojected.nc --param "iterations=[10, 20, 40]" \\
+        --param "nn_structure=[(10, 7), (5, 10, 7, 3)]" --param "m_wavelengths=['1x1km_bands', 'blue_off']" \\
+        --param "h_mask=[9999, 30]" --param "smooth=[False, True]" --param "method=['fuse', 'network']" \
+        --output fusion_sweep.csv --processes 8
+
+    python -m michigan.sweep boreali --m-file fused.nc --param "osw_mod=['on', 'off']" \\
+        --param "cpa_limits=[[0.01, 3, 0.01, 1, 0.01, 1, 10], [0.01, 10, 0.01, 5, 0.01, 2, 10]]"
+
+Fusion is scored against holdout low resolution pixels: a fixed random part of MODIS pixels is never
+used for training and RMSE, bias and R2 of fused bands averaged over them are reported. The <method>
+parameter selects the fusion path: 'fuse' is <ovl_plugins> fuse as used by default by <Fusion.fusion>
+(production path), 'network' is <michigan.fusenet.FusionNetwork> as used with <model_store>,
+<multi_output> or <adaptive>. <multi_output> applies to 'network' only, it is empty in rows of 'fuse'.
+Boreali is scored by the fit error (mse) of the solver and the part of pixels solved inside of the
+concentration limits.
+Each row of the results table has the parameters, the metrics and timings of the combination.
+"""
+import csv
+import sys
+import time
+import argparse
+import itertools
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+
+from batch import parse_options
+from utils import atomic_path
+
+# Default grids. Values of each parameter are combined with values of all other parameters
+FUSION_GRID = {
+    'method': ['fuse'],
+    'm_wavelengths': ['1x1km_bands'],
+    # None is the default structure of the method
+    'nn_structure': [None],
+    'iterations': [20],
+    'multi_output': [True],
+    'h_mask': [9999],
+    'smooth': [False],
+    'log': [False],
+}
+
+BOREALI_GRID = {
+    'wavelengths_set': ['1x1km_bands'],
+    # None is <MichiganProcessing.cpa_limits>
+    'cpa_limits': [None],
+    'osw_mod': ['on'],
+}
+
+# Parameters which are used only by some fusion methods. They are None in rows of other methods, so these
+# methods are not evaluated once for each value
+METHOD_PARAMS = {
+    'multi_output': ['network'],
+}
+
+# Threads of each <fuse> call. Combinations are evaluated by processes in parallel
+FUSE_THREADS = 1
+
+# Scene loaded by <load_fusion> or <load_boreali>. It is set before the pool is forked,
+# so workers read it without copying
+_shared = {}
+
+
+def combinations(grid):
+    """
+    :param grid: dict, parameter name -> list of values
+    :return: list of dicts, all combinations of values
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def fusion_combinations(grid):
+    """
+    :param grid: dict, parameter name -> list of values
+    :return: list of dicts, combinations of values without parameters which the method doesn't use
+    (see <METHOD_PARAMS>)
+    """
+    seen = set()
+    unique = []
+    for params in combinations(grid):
+        for name, methods in METHOD_PARAMS.items():
+            if params['method'] not in methods:
+                params[name] = None
+        key = tuple(sorted(params.items()))
+        if key not in seen:
+            seen.add(key)
+            unique.append(params)
+    return unique
+
+
+def load_fusion(m_file, s_file, domain=None, wavelengths_sets=('1x1km_bands',), mask=True, skip=True,
+                cut=True, holdout=0.2, seed=0):
+    """
+    Load and mask a scene for <evaluate_fusion>. Masks which don't depend on the grid (out of swath,
+    land, clouds) are applied here, the depth mask is applied for each <h_mask> of the grid.
+    :param m_file: str, path to reprojected MODISa file
+    :param s_file: str, path to reprojected Sentinel-2 file
+    :param domain: <nansat.domain.Domain> object
+    :param wavelengths_sets: list, names of MODIS wavelengths sets of the grid
+    :param mask: bool, see <Fusion>
+    :param skip: bool, see <Fusion>
+    :param cut: bool, see <Fusion>
+    :param holdout: float, part of low resolution pixels which are not used for training
+    :param seed: int
+    :return: dict
+    """
+    from fusion import Fusion
+
+    fusion = Fusion(m_file, s_file, domain=domain, mask=mask, skip=skip, cut=False, h_mask=9999)
+    modis = fusion.wavelengths['modis']
+    lores = {}
+    for wavelength in sorted(set(w for name in wavelengths_sets for w in modis[name])):
+        band = fusion.loresfile['Rrs_%s' % wavelength]
+        band[fusion.negpix] = np.nan
+        lores[wavelength] = band
+
+    # Held out pixels are the same for all combinations
+    holdout_cells = np.random.RandomState(seed).rand(int(np.nanmax(fusion.index)) + 1) < holdout
+    return {'hires': fusion.hires, 'lores': lores, 'index': fusion.index, 'negpix': fusion.negpix,
+            'bottom': np.array(fusion.get_bottom()), 'cutsize': fusion.cutsize if cut else None,
+            'wavelengths': modis, 'holdout': holdout_cells, 'seed': seed}
+
+
+def evaluate_fusion(params):
+    """
+    Fuse the shared scene with <params> and score fused bands on holdout pixels
+    :param params: dict, one combination of <FUSION_GRID> parameters
+    :return: dict, metrics
+    """
+    from fusion import smooth_hires
+
+    data = _shared
+    hires = np.array(data['hires'])
+    if params['h_mask'] != 9999:
+        # As <Fusion.get_h_mask>: land and pixels deeper than <h_mask> are masked
+        with np.errstate(invalid='ignore'):
+            hires[:, ~(data['bottom'] <= params['h_mask'])] = np.nan
+    if params['smooth']:
+        hires = smooth_hires(hires, data['negpix'])
+    if params['log']:
+        hires += 1
+        np.log10(hires, out=hires)
+
+    index = data['index']
+    wavelengths = data['wavelengths'][params['m_wavelengths']]
+    size = data['cutsize']
+    if size is not None:
+        hires = hires[:, :size, :size]
+        index = index[:size, :size]
+    lores = np.array([data['lores'][wavelength][:size, :size] for wavelength in wavelengths])
+
+    start = time.time()
+    if params['method'] == 'fuse':
+        prediction, truth, metrics = fuse_holdout(params, hires, lores, index, wavelengths)
+    elif params['method'] == 'network':
+        prediction, truth, metrics = network_holdout(params, hires, lores, index, wavelengths)
+    else:
+        raise ValueError('Unknown fusion method <%s>' % params['method'])
+    metrics['train_s'] = time.time() - start
+
+    errors = prediction - truth
+    for i, wavelength in enumerate(wavelengths):
+        metrics['rmse_%s' % wavelength] = np.sqrt(np.mean(errors[:, i] ** 2))
+    metrics['rmse'] = np.sqrt(np.mean(errors ** 2))
+    metrics['bias'] = np.mean(errors)
+    metrics['r2'] = np.mean(1 - np.sum(errors ** 2, axis=0) / np.sum((truth - truth.mean(axis=0)) ** 2, axis=0))
+    return metrics
+
+
+def holdout_cells(cells):
+    """
+    :param cells: numpy array, numbers of low resolution pixels
+    :return: numpy array, bool, True for held out pixels
+    """
+    test = _shared['holdout'][cells.astype(np.int64)]
+    if not test.any() or test.all():
+        raise ValueError('No pixels for training or testing')
+    return test
+
+
+def fuse_holdout(params, hires, lores, index, wavelengths):
+    """
+    Production fusion path: <ovl_plugins> fuse of each band. Held out low resolution pixels are set to NaN
+    before fusion (as out-of-swath pixels), fused bands are averaged over them and compared with MODIS
+    :return: numpy arrays, predicted and true values (test pixels, bands) and dict of counts
+    """
+    from ovl_plugins.fusion.fusion import fuse
+    from fusenet import cell_means
+
+    cells, features, truth = cell_means(hires, index, lores)
+    test = holdout_cells(cells)
+
+    held_out = _shared['holdout'][np.nan_to_num(index).astype(np.int64)]
+    options = {} if params['nn_structure'] is None else {'nn_structure': list(params['nn_structure'])}
+    fused = np.empty(lores.shape, dtype=np.float32)
+    for i, wavelength in enumerate(wavelengths):
+        lores_train = np.array(lores[i])
+        lores_train[held_out] = np.nan
+        fused[i] = fuse(hires, lores_train, network_name='Rrs_%s' % wavelength, iterations=params['iterations'],
+                        threads=FUSE_THREADS, index=index, **options)
+
+    # Fused values of each held out pixel are averaged over its hires pixels
+    fused_cells, fused_means, fused_truth = cell_means(fused, index, lores)
+    fused_test = np.in1d(fused_cells, cells[test])
+    return fused_means[fused_test], fused_truth[fused_test], {'train_pixels': int((~test).sum()),
+                                                              'test_pixels': int(fused_test.sum())}
+
+
+def network_holdout(params, hires, lores, index, wavelengths):
+    """
+    <michigan.fusenet.FusionNetwork> path (<Fusion.fusion> with <model_store>, <multi_output> or <adaptive>)
+    :return: numpy arrays, predicted and true values (test pixels, bands) and dict of counts
+    """
+    from fusenet import FusionNetwork, NN_STRUCTURE, cell_means
+
+    cells, features, targets = cell_means(hires, index, lores)
+    test = holdout_cells(cells)
+
+    nn_structure = NN_STRUCTURE if params['nn_structure'] is None else params['nn_structure']
+    groups = [range(len(wavelengths))] if params['multi_output'] else [[i] for i in range(len(wavelengths))]
+    prediction = np.empty((int(test.sum()), len(wavelengths)))
+    for group in groups:
+        network = FusionNetwork(nn_structure, random_state=_shared['seed'])
+        network.train(features[~test], targets[~test][:, group], iterations=params['iterations'])
+        prediction[:, group] = network.predict_features(features[test])
+    return prediction, targets[test], {'train_pixels': int((~test).sum()), 'test_pixels': int(test.sum())}
+
+
+def load_boreali(m_file, domain=None, wavelengths_sets=('1x1km_bands',), max_pixels=20000, seed=0):
+    """
+    Load valid pixels of a scene for <evaluate_boreali>. The mask is the same as in
+    <MichiganProcessing.boreali_processing>
+    :param m_file: str, path to reprojected MODISa (or fused) file
+    :param domain: <nansat.domain.Domain> object
+    :param wavelengths_sets: list, names of MODIS wavelengths sets of the grid
+    :param max_pixels: int, max number of randomly sampled valid pixels. None means all valid pixels
+    :param seed: int
+    :return: dict
+    """
+    from michigan import MichiganProcessing
+
+    processing = MichiganProcessing(m_file, domain=domain or False)
+    modis = processing.wavelengths['modis']
+    r2 = processing.ifile[2]
+    h = processing.get_bottom(bathymetry_path=processing.BATHYMETRY_PATH)
+    valid = (r2 != -0.015534) & np.isfinite(r2) & np.isfinite(h)
+
+    rrs = {}
+    for wavelength in sorted(set(w for name in wavelengths_sets for w in modis[name])):
+        rrs[wavelength] = processing.ifile['Rrs_%s' % wavelength]
+        valid &= np.isfinite(rrs[wavelength])
+
+    pixels = np.flatnonzero(valid)
+    if max_pixels is not None and pixels.size > max_pixels:
+        pixels = np.sort(np.random.RandomState(seed).choice(pixels, max_pixels, replace=False))
+
+    return {'rrs': dict((w, band.ravel()[pixels].astype(np.float32)) for w, band in rrs.items()),
+            'depth': h.ravel()[pixels].astype(np.float32), 'wavelengths': modis,
+            'cpa_limits': processing.cpa_limits}
+
+
+def evaluate_boreali(params, hydro_optic='michigan'):
+    """
+    Boreali inversion of the shared pixels with <params>
+    :param params: dict, one combination of <BOREALI_GRID> parameters
+    :param hydro_optic: str, name of hydro optical model
+    :return: dict, metrics
+    """
+    from inversion import invert_compact
+    from extraction import rrs_to_rrsw
+
+    data = _shared
+    wavelengths = data['wavelengths'][params['wavelengths_set']]
+    cpa_limits = params['cpa_limits'] or data['cpa_limits']
+    rrs = np.array([data['rrs'][wavelength] for wavelength in wavelengths]).T
+    osw = params['osw_mod'] == 'on'
+
+    start = time.time()
+    # Workers of the sweep are daemonic processes, they can't have own pools
+    values = invert_compact(hydro_optic, wavelengths, cpa_limits, rrs_to_rrsw(rrs), rrs=rrs if osw else None,
+                            depth=data['depth'] if osw else None, processes=1)
+    metrics = {'inversion_s': time.time() - start, 'pixels': rrs.shape[0]}
+
+    solved = np.isfinite(values[:4]).all(axis=0)
+    metrics['solved'] = solved.mean() if solved.size else np.nan
+    if solved.any():
+        cpa, mse = values[:3, solved], values[3, solved]
+        metrics['mse_median'] = np.median(mse)
+        metrics['mse_mean'] = np.mean(mse)
+        # Solutions on a limit mean that the limits are too narrow
+        limits = np.array(cpa_limits[:6], dtype=np.float64).reshape(3, 2)
+        on_limit = np.zeros(cpa.shape[1], dtype=bool)
+        for i, name in enumerate(('chl', 'tsm', 'doc')):
+            metrics['%s_median' % name] = np.median(cpa[i])
+            on_limit |= np.isclose(cpa[i], limits[i, 0], rtol=1e-3) | np.isclose(cpa[i], limits[i, 1], rtol=1e-3)
+        metrics['on_limit'] = on_limit.mean()
+    return metrics
+
+
+EVALUATE = {'fusion': evaluate_fusion, 'boreali': evaluate_boreali}
+
+
+def run_combination(task):
+    """
+    Worker of <run_sweep>
+    :param task: tuple, kind of sweep and parameters
+    :return: dict, row of the results table
+    """
+    kind, params = task
+    row = dict(params)
+    start = time.time()
+    try:
+        row.update(EVALUATE[kind](params))
+        row['status'] = 'ok'
+    except Exception:
+        row.update(status='failed', error=traceback.format_exc().strip().splitlines()[-1])
+    row['total_s'] = time.time() - start
+    return row
+
+
+def run_sweep(kind, grid, load_options, processes=4, ofile=None):
+    """
+    :param kind: str, 'fusion' or 'boreali'
+    :param grid: dict, parameter name -> list of values. Missing parameters are taken from the default grid
+    :param load_options: dict, keyword arguments of <load_fusion> or <load_boreali>
+    :param processes: int
+    :param ofile: str, path to CSV file with results or None
+    :return: list of dicts, rows of the results table
+    """
+    global _shared
+
+    defaults = FUSION_GRID if kind == 'fusion' else BOREALI_GRID
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError('Unknown parameters: %s' % ', '.join(sorted(unknown)))
+    grid = dict(defaults, **grid)
+    if kind == 'fusion':
+        grid['nn_structure'] = [None if structure is None else tuple(structure)
+                                for structure in grid['nn_structure']]
+        sets = grid['m_wavelengths']
+    else:
+        sets = grid['wavelengths_set']
+
+    start = time.time()
+    load = load_fusion if kind == 'fusion' else load_boreali
+    _shared = load(wavelengths_sets=sets, **load_options)
+    load_s = time.time() - start
+    print 'loaded in %.1f s' % load_s
+
+    tasks = [(kind, params) for params in (fusion_combinations(grid) if kind == 'fusion' else combinations(grid))]
+    table = []
+    # The pool is forked after loading, workers share <_shared>
+    pool = Pool(processes)
+    try:
+        for row in pool.imap(run_combination, tasks):
+            row['load_s'] = load_s
+            table.append(row)
+            print '%d/%d %s %.1f s' % (len(table), len(tasks), row['status'], row['total_s'])
+    finally:
+        pool.close()
+        pool.join()
+        _shared = {}
+
+    if ofile is not None:
+        write_table(table, sorted(grid), ofile)
+    return table
+
+
+def write_table(table, params, ofile):
+    """
+    :param table: list of dicts, rows
+    :param params: list, names of parameters, they are the first columns
+    :param ofile: str, path to CSV file
+    """
+    names = set()
+    for row in table:
+        names.update(row)
+    columns = list(params) + ['status'] + sorted(names - set(params) - {'status'})
+
+    with atomic_path(ofile) as tmp_file:
+        with open(tmp_file, 'wb') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(table)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Parameter sweep of fusion or Boreali on one scene')
+    parser.add_argument('kind', choices=sorted(EVALUATE))
+    parser.add_argument('--m-file', required=True, help='reprojected MODISa file (fused file for Boreali)')
+    parser.add_argument('--s-file', help='reprojected Sentinel-2 file (fusion only)')
+    parser.add_argument('--param', action='append', help='KEY=[VALUES] list of values of a grid parameter '
+                                                         '(can be repeated)')
+    parser.add_argument('--output', default='sweep.csv', help='path to CSV file with results')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--holdout', type=float, default=0.2, help='part of held out MODIS pixels (fusion)')
+    parser.add_argument('--no-mask', action='store_true', help='no land and cloud mask (fusion)')
+    parser.add_argument('--max-pixels', type=int, default=20000, help='number of sampled pixels (Boreali)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(args)
+
+    grid = parse_options(args.param)
+    for name, values in grid.items():
+        if not isinstance(values, list):
+            parser.error('values of <%s> should be a list' % name)
+
+    if args.kind == 'fusion':
+        if args.s_file is None:
+            parser.error('--s-file is required for fusion')
+        load_options = {'m_file': args.m_file, 's_file': args.s_file, 'mask': not args.no_mask,
+                        'holdout': args.holdout, 'seed': args.seed}
+    else:
+        load_options = {'m_file': args.m_file, 'max_pixels': args.max_pixels, 'seed': args.seed}
+
+    table = run_sweep(args.kind, grid, load_options, processes=args.processes, ofile=args.output)
+    failed = sum(row['status'] != 'ok' for row in table)
+    print 'combinations: %d, failed: %d, results: %s' % (len(table), failed, args.output)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os
+import socket
+import hashlib
+from contextlib import contextmanager
+from multiprocessing import current_process
+
+import numpy as np
+
+
+def domain_key(domain):
+    """
+    :param domain: <nansat.domain.Domain> or <nansat.nansat.Nansat> object
+    :return: str, hash which is unique for projection, geotransform and shape of the grid
+    """
+    projection = domain.vrt.get_projection()
+    geo_transform = domain.vrt.dataset.GetGeoTransform()
+    shape = domain.shape()
+    return digest(projection, geo_transform, shape)
+
+
+def on_domain(n, domain):
+    """
+    :param n: <nansat.nansat.Nansat> object
+    :param domain: <nansat.domain.Domain> object
+    :return: bool, True if <n> is already on the grid of <domain> and reprojection can be skipped
+    """
+    return domain_key(n) == domain_key(domain)
+
+
+def digest(*items):
+    """
+    :param items: str, numbers, tuples or numpy arrays
+    :return: str, sha1 hex digest of all <items>
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            sha.update(str(item.shape).encode('utf-8'))
+            sha.update(str(item.dtype).encode('utf-8'))
+            sha.update(np.ascontiguousarray(item).tobytes())
+        else:
+            sha.update(repr(item).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def domain_spec(domain):
+    """
+    Picklable description of a domain (e.g. for workers of a process pool)
+    :param domain: <nansat.domain.Domain> object
+    :return: tuple, projection (WKT) and extent string for <nansat.domain.Domain>
+    """
+    geo_transform = domain.vrt.dataset.GetGeoTransform()
+    rows, cols = domain.shape()
+    x_min, y_max = geo_transform[0], geo_transform[3]
+    x_max = x_min + geo_transform[1] * cols
+    y_min = y_max + geo_transform[5] * rows
+    return domain.vrt.get_projection(), '-te %r %r %r %r -ts %d %d' % (x_min, y_min, x_max, y_max, cols, rows)
+
+
+def tmp_name(path, suffix='.tmp'):
+    """
+    Temporary name for writing <path> before atomic rename. The name is unique for the host and process,
+    so writers on different nodes of a shared filesystem don't collide.
+    :param path: str
+    :param suffix: str, e.g. '.tmp.npy' for files whose extension is added by numpy
+    :return: str
+    """
+    return '%s.%s.%d%s' % (path, socket.gethostname(), os.getpid(), suffix)
+
+
+def pool_processes(processes):
+    """
+    :param processes: int, requested number of worker processes of a stage
+    :return: int, <processes> or 1 inside of a daemonic process (e.g. a worker of <michigan.batch>),
+    which is not allowed to have children
+    """
+    return 1 if current_process().daemon else processes
+
+
+@contextmanager
+def atomic_path(path, suffix='.tmp'):
+    """
+    Atomic write of <path>: the block writes into a temporary file (see <tmp_name>) which is renamed to <path>
+    if the block succeeds and removed otherwise, so readers never see a partially written file:
+
+        with atomic_path(ofile) as tmp_file:
+            n.export(tmp_file)
+
+    :param path: str
+    :param suffix: str, e.g. '.tmp.npy' for files whose extension is added by numpy
+    :return: str, temporary path
+    """
+    tmp_path = tmp_name(path, suffix)
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, path)
+
+
+class LazyDomain(object):
+    """
+    Class attribute with a domain which is built on first access and cached (e.g. <Data.sbd_dom>).
+    Importing a module with such attribute doesn't need nansat/GDAL.
+    """
+
+    def __init__(self, srs, extent):
+        """
+        :param srs: str, projection of <nansat.domain.Domain>
+        :param extent: str, extent string of <nansat.domain.Domain>
+        """
+        self.spec = srs, extent
+        self.domain = None
+
+    def __get__(self, obj, cls=None):
+        if self.domain is None:
+            self.domain = spec_domain(self.spec)
+        return self.domain
+
+
+def spec_domain(spec):
+    """
+    :param spec: tuple, result of <domain_spec>
+    :return: <nansat.domain.Domain> object
+    """
+    from nansat import Domain
+    return Domain(*spec)
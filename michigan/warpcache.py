@@ -0,0 +1,131 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import digest, domain_key, atomic_path
+
+
+class SwathLookup:
+    """
+    Lookup table from cells of a target grid to pixels of a MODIS L2 swath.
+    It is a result of one warp of the <index> band. Any other band of the same
+    swath can be regridded with <regrid> without GDAL warping.
+    """
+
+    def __init__(self, shape, swath_shape, dst, src):
+        """
+        :param shape: tuple, shape of the target grid
+        :param swath_shape: tuple, shape of the swath
+        :param dst: numpy array, flat positions of covered cells of the target grid
+        :param src: numpy array, flat positions of relevant swath pixels
+        """
+        self.shape = tuple(shape)
+        self.swath_shape = tuple(swath_shape)
+        self.dst = dst
+        self.src = src
+
+    @classmethod
+    def from_index(cls, index, swath_shape):
+        """
+        :param index: numpy array, reprojected band of swath pixel numbers started from 1. 0 is out of swath
+        :param swath_shape: tuple, shape of the swath
+        :return: <SwathLookup> object
+        """
+        dst = np.flatnonzero(index > 0).astype(np.int32)
+        src = (index.ravel()[dst] - 1).astype(np.int32)
+        return cls(index.shape, swath_shape, dst, src)
+
+    def index(self):
+        """
+        :return: numpy array, int32 grid of swath pixel numbers (as in the exported <index> band)
+        """
+        index = np.zeros(self.shape, dtype=np.int32)
+        index.ravel()[self.dst] = self.src
+        return index
+
+    def regrid(self, swath_arr, fill=np.nan):
+        """
+        Nearest neighbour regridding of a swath band by vectorized gather
+        :param swath_arr: numpy array, band of the swath
+        :param fill: value for cells out of swath
+        :return: numpy array
+        """
+        if swath_arr.shape != self.swath_shape:
+            raise ValueError('Swath shape %s does not match the lookup %s' % (swath_arr.shape, self.swath_shape))
+
+        dtype = np.result_type(swath_arr.dtype, np.min_scalar_type(fill))
+        grid = np.empty(self.shape, dtype=dtype)
+        grid.fill(fill)
+        grid.ravel()[self.dst] = swath_arr.ravel()[self.src]
+        return grid
+
+
+class WarpCache:
+    """
+    Process-wide (and optionally on disk) storage of <SwathLookup> objects.
+    Lookups are keyed on the swath geometry (lat/lon), the target domain and warp options.
+    Each lookup holds two int32 arrays of the size of the domain, so only <max_entries> most recently
+    used lookups are kept in memory.
+    """
+
+    def __init__(self, cache_path=None, max_entries=2):
+        """
+        :param cache_path: str, directory for .npz files. If None lookups are kept only in memory
+        :param max_entries: int, max number of lookups in memory
+        """
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.lookups = OrderedDict()
+
+    def _remember(self, key, lookup):
+        self.lookups.pop(key, None)
+        self.lookups[key] = lookup
+        while len(self.lookups) > self.max_entries:
+            self.lookups.popitem(last=False)
+
+    @staticmethod
+    def key(latitude, longitude, domain, *options):
+        """
+        :param latitude: numpy array, latitudes of the swath
+        :param longitude: numpy array, longitudes of the swath
+        :param domain: <nansat.domain.Domain> object
+        :param options: any other warp parameters (e.g. gcp_count)
+        :return: str
+        """
+        return digest(latitude, longitude, domain_key(domain), options)
+
+    def _path(self, key):
+        return os.path.join(self.cache_path, 'swath_%s.npz' % key)
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: <SwathLookup> object or None
+        """
+        if key in self.lookups:
+            lookup = self.lookups[key]
+            self._remember(key, lookup)
+            return lookup
+
+        if self.cache_path is not None and os.path.exists(self._path(key)):
+            data = np.load(self._path(key))
+            lookup = SwathLookup(tuple(data['shape']), tuple(data['swath_shape']), data['dst'], data['src'])
+            self._remember(key, lookup)
+            return lookup
+
+        return None
+
+    def put(self, key, lookup):
+        """
+        :param key: str
+        :param lookup: <SwathLookup> object
+        """
+        self._remember(key, lookup)
+
+        if self.cache_path is not None:
+            if not os.path.isdir(self.cache_path):
+                os.makedirs(self.cache_path)
+            with atomic_path(self._path(key), '.tmp.npz') as tmp_path:
+                np.savez(tmp_path, shape=lookup.shape, swath_shape=lookup.swath_shape, dst=lookup.dst,
+                         src=lookup.src)
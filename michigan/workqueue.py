@@ -0,0 +1,235 @@
+"""
+Coordinator-free work queue on a shared filesystem (e.g. NFS). Several processes on several nodes
+claim scenes through lease files:
+
+    queue = WorkQueue('/nfs0/data_ocolor/michigan/queue/geolocation')
+    lease = queue.claim(key)
+    if lease is not None:
+        try:
+            ...  # write the output under a temporary name
+            if lease.valid():
+                ...  # publish the output (rename)
+            lease.release(done=True)
+        except Exception:
+            lease.release(done=False)
+            raise
+
+A lease is created atomically (O_CREAT | O_EXCL) and kept alive by a heartbeat thread which touches it.
+A lease which was not touched for <lease_seconds> is expired and can be stolen: the stealer renames it
+(only one rename succeeds) and creates a new one. Finished work is marked by a <done> file.
+A worker whose lease was stolen (<Lease.lost>) must not publish its output.
+Ages of leases are compared with the clock of the file server, not with clocks of nodes.
+"""
+import os
+import re
+import time
+import errno
+import socket
+import threading
+
+from utils import digest, tmp_name, atomic_path
+
+
+def worker_name():
+    """
+    :return: str, identifier of this process on this host
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def task_key(*items):
+    """
+    :param items: str, e.g. stage and input paths
+    :return: str, file-system safe key with a readable prefix
+    """
+    name = re.sub(r'[^\w.-]', '_', os.path.split(str(items[-1]).rstrip('/'))[-1])[:80]
+    return '%s_%s' % (name, digest(*items)[:12])
+
+
+class Lease:
+    """
+    Claimed task. The lease file is touched by a heartbeat thread until <release>.
+    """
+
+    def __init__(self, queue, key):
+        """
+        :param queue: <WorkQueue> object
+        :param key: str
+        """
+        self.queue = queue
+        self.key = key
+        self.path = queue.lease_path(key)
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.heartbeat):
+            if not self.owned():
+                # The lease was stolen (e.g. the node was stalled longer than <lease_seconds>)
+                self.lost = True
+                return
+            try:
+                os.utime(self.path, None)
+            except OSError:
+                self.lost = True
+                return
+
+    def owned(self):
+        """
+        :return: bool, True if the lease file still belongs to this worker
+        """
+        try:
+            with open(self.path) as f:
+                return f.read().split('\n')[0] == self.queue.worker
+        except IOError:
+            return False
+
+    def valid(self):
+        """
+        :return: bool, True if the lease was not stolen, the output of the task can be published
+        """
+        return not self.lost and self.owned()
+
+    def release(self, done=True):
+        """
+        :param done: bool, mark the task as done. Otherwise the task can be claimed again at once
+        :return: bool, False if the lease was stolen meanwhile, then the task is not marked as done
+        """
+        self._stop.set()
+        self._thread.join()
+        if not self.valid():
+            return False
+
+        if done:
+            self.queue.mark_done(self.key)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        return True
+
+
+class WorkQueue:
+    """
+    Directory on a shared filesystem with <leases> and <done> subdirectories
+    """
+
+    def __init__(self, root, lease_seconds=600, heartbeat=None, worker=None):
+        """
+        :param root: str, directory shared by all workers
+        :param lease_seconds: float, lease which was not touched for this time is expired
+        :param heartbeat: float, interval of touching of leases. Default is 1/4 of <lease_seconds>
+        :param worker: str, identifier of the worker. Default is host:pid
+        """
+        self.root = root
+        self.lease_seconds = lease_seconds
+        self.heartbeat = heartbeat if heartbeat is not None else lease_seconds / 4.
+        self.worker = worker or worker_name()
+        for subdir in ('leases', 'done'):
+            path = os.path.join(root, subdir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def lease_path(self, key):
+        return os.path.join(self.root, 'leases', key + '.lease')
+
+    def done_path(self, key):
+        return os.path.join(self.root, 'done', key + '.done')
+
+    def is_done(self, key):
+        return os.path.exists(self.done_path(key))
+
+    def mark_done(self, key):
+        with atomic_path(self.done_path(key)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                f.write('%s\n%f\n' % (self.worker, time.time()))
+
+    def server_time(self):
+        """
+        :return: float, current time of the file server (mtime of a freshly touched file)
+        """
+        path = os.path.join(self.root, 'leases', '.clock.%s' % self.worker.replace(':', '_'))
+        with open(path, 'a'):
+            os.utime(path, None)
+        try:
+            return os.stat(path).st_mtime
+        finally:
+            os.remove(path)
+
+    def _create(self, key):
+        try:
+            fd = os.open(self.lease_path(key), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        try:
+            os.write(fd, ('%s\n%f\n' % (self.worker, time.time())).encode('utf-8'))
+        finally:
+            os.close(fd)
+        return True
+
+    def _steal(self, key):
+        """
+        Remove the lease of <key> if it is expired
+        :return: bool, True if the expired lease was removed by this worker
+        """
+        path = self.lease_path(key)
+        try:
+            age = self.server_time() - os.stat(path).st_mtime
+        except OSError:
+            # The lease was released meanwhile
+            return True
+        if age < self.lease_seconds:
+            return False
+
+        # Only one of concurrent stealers succeeds in renaming
+        stale = tmp_name(path, '.stale')
+        try:
+            os.rename(path, stale)
+        except OSError:
+            return False
+        # The lease could be touched between stat and rename, then it is put back
+        if self.server_time() - os.stat(stale).st_mtime < self.lease_seconds:
+            try:
+                os.link(stale, path)
+            except OSError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    def claim(self, key):
+        """
+        :param key: str, see <task_key>
+        :return: <Lease> object or None if the task is done or claimed by another worker
+        """
+        if self.is_done(key):
+            return None
+
+        if not self._create(key):
+            if not self._steal(key) or not self._create(key):
+                return None
+
+        # The task could be finished between the check and the creation of the lease
+        if self.is_done(key):
+            os.remove(self.lease_path(key))
+            return None
+
+        return Lease(self, key)
+
+    def status(self):
+        """
+        :return: dict, numbers of active leases and done tasks
+        """
+        leases = [f for f in os.listdir(os.path.join(self.root, 'leases')) if f.endswith('.lease')]
+        done = [f for f in os.listdir(os.path.join(self.root, 'done')) if f.endswith('.done')]
+        return {'leases': len(leases), 'done': len(done)}